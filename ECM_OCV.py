@@ -1,5 +1,9 @@
+import contextlib
 from cycling import Cycling
-import time
+from buffer import CC_FIELDS
+from capacity import add_capacity_columns
+from recipe import CC, Recipe, Rest
+from stream_writer import CSVStreamWriter, read_stream
 
 #Input parameters
 #--------------------------------------------------------
@@ -31,25 +35,29 @@ cycle1 = Cycling(t_wait_init= t_wait_init,
                  I_dis= I_dis)
 
 """
-Step 1: Discharge step 
-##Fully discharge the battery at C/30 after waiting for 2 hours
+Recipe of the OCV test, each step after a wait of t_wait:
+Step 1: fully discharge the battery at C/30
+Step 2: CC-charge at C/30, the voltage measured by the e-load (written to filename_charge)
+Step 3: CC-discharge at C/30 (written to filename_discharge)
+Only step 3 runs (without the wait) unless full_test is True.
 """
-# time.sleep(t_wait)
-# cycle1.discharge_CC(return_output= False)
+full_test = False # runs steps 1 and 2 too (about 60 more hours), overwriting filename_charge
 
-"""
-Step 2: CC-charging
-##Fully charge battery at C/30 after waiting for 2 hours
-"""
-# time.sleep(t_wait)
-# df = cycle1.charge_CC(measuring_instrument= 'eload',return_output= True)
-# df.to_csv(f'data/{filename_charge}.csv', index= False)
-
-"""
-Step 3: CC-discharging
-##Fully discharge battery after waiting for 2 hours
-"""
-# time.sleep(t_wait)
-df = cycle1.discharge_CC(return_output= True)
-df.to_csv(f'data/{filename_discharge}.csv', index= False)
+with CSVStreamWriter(f'data/{filename_discharge}.csv', fields= CC_FIELDS) as discharge_writer, \
+        (CSVStreamWriter(f'data/{filename_charge}.csv', fields= CC_FIELDS) if full_test
+         else contextlib.nullcontext()) as charge_writer:
+    steps = [CC(I_dis, V_cut, direction= 'discharge', sinks= (discharge_writer,))]
+    if full_test:
+        steps = [Rest(t_wait, 'wait'),
+                 CC(I_dis, V_cut, direction= 'discharge'),
+                 Rest(t_wait, 'wait'),
+                 CC(I_charge, V_upper, direction= 'charge', sense= 'load', sinks= (charge_writer,)),
+                 Rest(t_wait, 'wait'),
+                 *steps]
+    cycle1.run(Recipe('ECM_OCV', steps), return_output= False)
 
+# the streamed rows hold the raw t, V, I: the capacity columns are added once the run is over, in a separate
+# file so that the streamed one stays intact
+for filename in ([filename_charge, filename_discharge] if full_test else [filename_discharge]):
+    df = add_capacity_columns(read_stream(f'data/{filename}.csv'))
+    df.to_csv(f'data/{filename}_capacity.csv', index= False)
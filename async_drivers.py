@@ -0,0 +1,175 @@
+import asyncio
+import functools
+import clock
+from buffer import ColumnBuffer, CC_FIELDS
+from capacity import add_capacity_columns
+from recipe import V_TOLERANCE
+from records import emit
+from scheduler import DeadlineScheduler
+
+
+class AsyncInstrument:
+    """
+    ------------------------------
+    Asyncio wrapper of a synchronous instrument (PSU or E_load).
+    ------------------------------
+    The blocking VISA calls of the wrapped instrument run in an executor, so several instruments can be
+    sampled concurrently from one event loop. Every method of the wrapped instrument is available as a
+    coroutine (e.g. await load.set_CC(1.5)). The calls to one instrument are serialized by a lock because
+    its VISA session does not accept concurrent queries.
+    The synchronous instrument stays available as the instrument attribute.
+    """
+    def __init__(self, instrument, executor = None):
+        """
+        Constructor of the wrapper.
+        :param instrument: PSU or E_load instance
+        :param executor: concurrent.futures executor running the VISA calls. Uses the event loop's default if None.
+        """
+        self.instrument = instrument
+        self.executor = executor
+        self._lock = asyncio.Lock()
+
+    async def call(self, method, *args, **kwargs):
+        """
+        Runs a blocking method of the instrument in the executor.
+        :param method: callable
+        :return: the method's return value
+        """
+        async with self._lock:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(method, *args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self.instrument, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return await self.call(attr, *args, **kwargs)
+        return method
+
+
+class AsyncPSU(AsyncInstrument):
+    """
+    Asyncio wrapper of PSU. The fixed pacing delays are awaited with clock.async_sleep instead of blocking
+    an executor thread.
+    """
+    async def wait_ready(self):
+        if self.instrument.pacing == 'adaptive':
+            await self.call(self.instrument.wait_ready)
+        else:
+            await clock.async_sleep(self.instrument.delay)
+
+    async def wait_output_on(self):
+        if self.instrument.pacing == 'adaptive':
+            await self.call(self.instrument.wait_output_on)
+        else:
+            await clock.async_sleep(self.instrument.init_delay)
+
+    # the commands go through the synchronous methods, which hold the session lock (see visa_session.exclusive)
+    # so that they do not interleave with another thread's exchanges (e.g. a Watchdog's poll)
+    async def set_psu_VI(self, V_upper, I_charge):
+        await self.call(self.instrument.set_psu_VI, V_upper, I_charge)
+
+    async def turn_psu_on(self):
+        await self.call(self.instrument.turn_psu_on)
+
+    async def turn_psu_off(self):
+        await self.call(self.instrument.turn_psu_off)
+
+    async def sample(self):
+        """
+        :return: Sample(V, I, W, status) where status is 'CC' or 'CV'
+        """
+        sample = await self.call(self.instrument.read_sample)
+        if self.instrument.pacing == 'fixed' and self.instrument.combined_queries:
+            await clock.async_sleep(self.instrument.delay)
+        return sample
+
+    async def CC_charge(self, dt, V_upper, I_charge, measuring_instr = None, return_output = True,
+                        sinks = (), cycle_no = 1, t_offset = 0):
+        """
+        Asyncio version of PSU.CC_charge. The psu sample and the voltage reading of the measuring
+        instrument are taken concurrently, each instrument being locked for its own exchange only, and the
+        deadlines are awaited without blocking the event loop. The charge ends when the psu's voltage reaches
+        V_upper (within V_TOLERANCE). The psu is turned off when the charge ends, also when the task is cancelled.
+        :param dt: time increment where the measurements should be taken
+        :param V_upper: The battery's upper terminal voltage
+        :param I_charge: The battery's charging current
+        :param measuring_instr: AsyncE_load measuring the voltage, or None to use the psu's voltage
+        :param return_output: If or not to return the charging cycle information
+        :param sinks: objects with an append(row) method (e.g. ColumnBuffer) that receive each sample as a row
+        :param cycle_no: cycle number written in the rows passed to the sinks
+        :param t_offset: time offset added to the times written in the rows passed to the sinks
+        :return: pandas DataFrame containing current, voltage, status, and capacities
+        """
+        await self.set_psu_VI(V_upper= V_upper, I_charge= I_charge)
+        if return_output:
+            buffer = ColumnBuffer(CC_FIELDS)
+            sinks = (*sinks, buffer)
+        sinks = (*sinks, self.instrument.telemetry.channel(self.instrument.id))
+
+        await self.turn_psu_on()
+        try:
+            await self.wait_output_on()
+            scheduler = self.instrument.scheduler = DeadlineScheduler(dt, stop_event= self.instrument.stop_event)
+            scheduler.start()
+            while True:
+                t = scheduler.elapsed()
+                if measuring_instr is None:
+                    V_psu, I, _, status = await self.sample()
+                    V = V_psu
+                else:
+                    (V_psu, I, _, status), V = await asyncio.gather(self.sample(), measuring_instr.measureV())
+                emit(sinks, {'cycle_no': cycle_no, 'status': f'{status}_charge', 't': t_offset + t, 'V': V, 'I': I})
+                if V_psu >= V_upper - V_TOLERANCE:
+                    break
+                await scheduler.async_wait()
+        finally:
+            await self.turn_psu_off()
+
+        if return_output:
+            return add_capacity_columns(buffer.to_dataframe())
+
+
+class AsyncE_load(AsyncInstrument):
+    """
+    Asyncio wrapper of E_load.
+    """
+    async def CC_discharge(self, dt, V_lower, I_dis, return_output = True, sinks = (), cycle_no = 1, t_offset = 0):
+        """
+        Asyncio version of E_load.CC_discharge. The load is locked for each exchange only, and the deadlines are
+        awaited without blocking the event loop. The load is turned off when the discharge ends, also when the
+        task is cancelled.
+        :param dt: time increment to take the measurement readings
+        :param V_lower: battery's lower terminal voltage
+        :param I_dis: battery's discharge current
+        :param return_output: If or not to return the discharge information
+        :param sinks: objects with an append(row) method (e.g. ColumnBuffer) that receive each sample as a row
+        :param cycle_no: cycle number written in the rows passed to the sinks
+        :param t_offset: time offset added to the times written in the rows passed to the sinks
+        :return: pandas DataFrame containing current, voltage, status, and capacities
+        """
+        if return_output:
+            buffer = ColumnBuffer(CC_FIELDS)
+            sinks = (*sinks, buffer)
+        sinks = (*sinks, self.instrument.telemetry.channel(self.instrument.id))
+
+        await self.set_CC(I_dis)
+        await self.turn_on_load()
+        try:
+            scheduler = self.instrument.scheduler = DeadlineScheduler(dt, stop_event= self.instrument.stop_event)
+            scheduler.start()
+            while True:
+                t = scheduler.elapsed()
+                V, I, _, _ = await self.sample()
+                emit(sinks, {'cycle_no': cycle_no, 'status': 'CC_discharge', 't': t_offset + t, 'V': V, 'I': I})
+                if V < V_lower:
+                    break
+                await scheduler.async_wait()
+        finally:
+            await self.turn_off_load()
+
+        if return_output:
+            return add_capacity_columns(buffer.to_dataframe())
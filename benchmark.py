@@ -0,0 +1,300 @@
+"""
+Benchmark suite of the sampling loops, run against the simulated instruments (see simulator.py).
+-----------------------------------------------------------------------------------------------
+Reported per entry point (PSU.cycle, PSU.CC_charge, E_load.cycle, E_load.CC_discharge, Cycling.cycle):
+* samples/s achieved by the host and the percentiles of the wall time between two samples. The protocols run
+  on the virtual clock, so the instruments' pacing and dt cost nothing and only the host overhead and the
+  optional real instrument latency (--latency) are measured.
+* breakdown of the host time spent in pandas, print, telemetry publishing, the simulated instruments, the loop
+  bodies and the post-hoc capacity integration, from a profiled run.
+* memory growth per 1M samples (tracemalloc).
+* timing drift and jitter of a loop paced on the real clock (--drift-dt).
+* scaling of Cycling.cycle with the number of cycles.
+-----------------------------------------------------------------------------------------------
+Usage:
+python benchmark.py --save-baseline bench_baseline.json
+python benchmark.py --compare bench_baseline.json --tolerance 0.2
+The comparison exits with status 1 if a metric regressed by more than the tolerance.
+"""
+import argparse
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import numpy as np
+import clock
+from cycling import Cycling
+from e_load import E_load
+from psu import PSU
+from scheduler import StopRequested
+from simulator import simulated_pool, SimCell, SIM_PSU_ID, SIM_LOAD_ID
+
+# protocol settings, in simulated time
+DT = 1.0
+V_UPPER = 3.65
+V_CUT = 2.0
+I_CC = 1.5
+I_CUT = 0.05
+T_WAIT = 60
+
+
+class RealLatency:
+    """
+    Wraps a simulated instrument and adds a real (wall clock) latency to each exchange.
+    """
+    def __init__(self, resource, latency):
+        self._resource = resource
+        self._latency = latency
+
+    def __getattr__(self, name):
+        return getattr(self._resource, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._resource, name, value)
+
+    def write(self, command):
+        time.sleep(self._latency)
+        self._resource.write(command)
+
+    def query(self, command):
+        time.sleep(self._latency)
+        return self._resource.query(command)
+
+
+class WallTimer:
+    """
+    Sink recording the wall time at which each row is produced.
+    """
+    def __init__(self):
+        self.times = []
+
+    def append(self, row):
+        self.times.append(time.perf_counter())
+
+
+class StopAfter:
+    """
+    Sink setting a stop event after n rows.
+    """
+    def __init__(self, n, stop_event):
+        self.n = n
+        self.stop_event = stop_event
+        self.rows = []
+
+    def append(self, row):
+        self.rows.append(row['t'])
+        if len(self.rows) >= self.n:
+            self.stop_event.set()
+
+
+def make_pool(soc, latency):
+    pool = simulated_pool(SimCell(soc= soc))
+    if latency > 0:
+        resources = pool.resource_manager.resources
+        for id in resources:
+            resources[id] = RealLatency(resources[id], latency)
+    return pool
+
+
+def entry_points(latency, cycles = 1):
+    """
+    :return: dictionary of entry point names and functions running them with the given sinks
+    """
+    def psu_cycle(sinks):
+        PSU(SIM_PSU_ID, pool= make_pool(0.0, latency)).cycle(DT, V_UPPER, I_CC, I_CUT, sinks= sinks)
+
+    def psu_CC_charge(sinks):
+        PSU(SIM_PSU_ID, pool= make_pool(0.0, latency)).CC_charge(DT, V_UPPER, I_CC, sinks= sinks)
+
+    def e_load_cycle(sinks):
+        E_load(SIM_LOAD_ID, pool= make_pool(1.0, latency)).cycle(T_WAIT, V_CUT, I_CUT, I_CC, DT, 0, sinks= sinks)
+
+    def e_load_CC_discharge(sinks):
+        E_load(SIM_LOAD_ID, pool= make_pool(1.0, latency)).CC_discharge(DT, V_CUT, I_CC, sinks= sinks)
+
+    def cycling_cycle(sinks):
+        Cycling(0, SIM_PSU_ID, SIM_LOAD_ID, cycles, DT, V_UPPER, I_CC, I_CUT, T_WAIT, V_CUT, I_CC,
+                pool= make_pool(0.0, latency)).cycle(sinks= sinks)
+
+    return {
+        'PSU.cycle': psu_cycle,
+        'PSU.CC_charge': psu_CC_charge,
+        'E_load.cycle': e_load_cycle,
+        'E_load.CC_discharge': e_load_CC_discharge,
+        'Cycling.cycle': cycling_cycle,
+    }
+
+
+@contextlib.contextmanager
+def virtual_time(quiet = True):
+    """
+    Runs the block on the virtual clock, with the loops' console output discarded.
+    """
+    previous = clock.set_clock(clock.VirtualClock())
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull if quiet else sys.stdout):
+            yield
+    finally:
+        clock.set_clock(previous)
+
+
+def throughput(run):
+    """
+    :return: samples/s, percentiles of the wall time between samples in ms, number of samples
+    """
+    timer = WallTimer()
+    with virtual_time():
+        t0 = time.perf_counter()
+        run((timer,))
+        wall = time.perf_counter() - t0
+    intervals = np.diff(timer.times) * 1000
+    p50, p90, p99 = np.percentile(intervals, [50, 90, 99]) if len(intervals) else (np.nan,) * 3
+    return {'samples': len(timer.times), 'samples_per_s': len(timer.times) / wall,
+            'latency_p50 [ms]': p50, 'latency_p90 [ms]': p90, 'latency_p99 [ms]': p99}
+
+
+PROFILE_GROUPS = (
+    ('pandas', lambda path, name: 'pandas' in path),
+    ('print', lambda path, name: name == '<built-in method builtins.print>'),
+    ('telemetry', lambda path, name: path.endswith('telemetry.py') or path.endswith('queue.py')),
+    ('instruments', lambda path, name: path.endswith('simulator.py') or path.endswith('benchmark.py')),
+    ('loop_bodies', lambda path, name: path.endswith(('psu.py', 'e_load.py', 'cycling.py', 'recipe.py'))),
+    ('sinks', lambda path, name: path.endswith(('records.py', 'buffer.py'))),
+    ('scheduling', lambda path, name: path.endswith(('scheduler.py', 'clock.py'))),
+    ('capacity', lambda path, name: path.endswith('capacity.py')),
+)
+
+
+def breakdown(run):
+    """
+    :return: share of the host time (own time of the functions) spent in each group of PROFILE_GROUPS
+    """
+    profiler = cProfile.Profile()
+    with virtual_time():
+        profiler.runcall(run, ())
+    stats = pstats.Stats(profiler, stream= io.StringIO()).stats
+    total = sum(tottime for _, _, tottime, _, _ in stats.values())
+    shares = {group: 0.0 for group, _ in PROFILE_GROUPS}
+    for (path, _, name), (_, _, tottime, _, _) in stats.items():
+        for group, matches in PROFILE_GROUPS:
+            if matches(path, name):
+                shares[group] += tottime
+                break
+    return {f'share_{group}': t / total for group, t in shares.items()}
+
+
+def memory_per_million(run):
+    """
+    :return: memory growth in MB per 1M samples, including the list of sample times kept by WallTimer
+    """
+    timer = WallTimer()
+    with virtual_time():
+        tracemalloc.start()
+        start = tracemalloc.take_snapshot()
+        run((timer,))
+        end = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+    growth = sum(stat.size_diff for stat in end.compare_to(start, 'filename'))
+    return {'memory_per_1M_samples [MB]': growth / max(len(timer.times), 1) * 1e6 / 2**20}
+
+
+def drift(dt, n, latency):
+    """
+    Runs E_load.CC_discharge on the real clock for n samples.
+    :return: timing drift and jitter statistics in ms
+    """
+    stop_event = threading.Event()
+    stop = StopAfter(n, stop_event)
+    load = E_load(SIM_LOAD_ID, pool= make_pool(1.0, latency), stop_event= stop_event)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            load.CC_discharge(dt, 0.0, 0.1, return_output= False, sinks= (stop,))
+        except StopRequested:
+            pass
+    t = np.asarray(stop.rows)
+    deviation = (t - t[0]) - dt * np.arange(len(t))
+    stats = load.scheduler.stats()
+    return {'drift_final [ms]': deviation[-1] * 1000, 'drift_max [ms]': np.abs(deviation).max() * 1000,
+            'jitter_mean [ms]': stats['jitter_mean [s]'] * 1000, 'jitter_max [ms]': stats['jitter_max [s]'] * 1000,
+            'missed_deadlines': stats['missed_deadlines']}
+
+
+def run_suite(latency = 0.0, drift_dt = 0.02, drift_samples = 250, cycle_counts = (1, 2, 4)):
+    results = {}
+    for name, run in entry_points(latency).items():
+        results[name] = {**throughput(run), **breakdown(run), **memory_per_million(run)}
+    results['drift'] = drift(drift_dt, drift_samples, latency)
+    for cycles in cycle_counts:
+        run = entry_points(latency, cycles)['Cycling.cycle']
+        timer = WallTimer()
+        with virtual_time():
+            t0 = time.perf_counter()
+            run((timer,))
+            wall = time.perf_counter() - t0
+        results[f'Cycling.cycle cycles={cycles}'] = {'wall [s]': wall, 'wall_per_cycle [s]': wall / cycles,
+                                                     'us_per_sample': wall / len(timer.times) * 1e6}
+    return results
+
+
+# metrics compared against the baseline, and whether higher values are better
+COMPARED_METRICS = {'samples_per_s': True, 'latency_p99 [ms]': False, 'memory_per_1M_samples [MB]': False,
+                    'us_per_sample': False}
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: list of the regressions as strings
+    """
+    regressions = []
+    for section, metrics in baseline.items():
+        for metric, value in metrics.items():
+            if metric not in COMPARED_METRICS or metric not in results.get(section, {}):
+                continue
+            new = results[section][metric]
+            higher_is_better = COMPARED_METRICS[metric]
+            change = (new - value) / value if value else 0.0
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append(f'{section} {metric}: {value:.4g} -> {new:.4g} ({change:+.0%})')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description= __doc__, formatter_class= argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type= float, default= 0.0, help= 'real latency per SCPI exchange in seconds')
+    parser.add_argument('--drift-dt', type= float, default= 0.02, help= 'dt of the real-clock drift run in seconds')
+    parser.add_argument('--drift-samples', type= int, default= 250)
+    parser.add_argument('--cycles', type= int, nargs= '+', default= [1, 2, 4])
+    parser.add_argument('--save-baseline', help= 'write the results to this JSON file')
+    parser.add_argument('--compare', help= 'compare the results with this baseline JSON file')
+    parser.add_argument('--tolerance', type= float, default= 0.2, help= 'allowed relative regression')
+    args = parser.parse_args()
+
+    results = run_suite(args.latency, args.drift_dt, args.drift_samples, tuple(args.cycles))
+    for section, metrics in results.items():
+        print(section)
+        for metric, value in metrics.items():
+            print(f'    {metric:<32} {value}' if not isinstance(value, float) else f'    {metric:<32} {value:.4g}')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent= 2, default= float)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
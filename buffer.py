@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+
+
+class ColumnBuffer:
+    """
+    ------------------------------
+    Preallocated, growable columnar buffer for the sampling loops.
+    ------------------------------
+    Each field is stored in its own NumPy array. The arrays are preallocated and their capacity is doubled
+    when they are full, so appending a row costs O(1) amortized time instead of copying all the earlier
+    data like DataFrame.append/pd.concat in a loop. One pandas DataFrame is built at the end.
+    ------------------------------
+    Usage:
+    buffer = ColumnBuffer(CYCLING_FIELDS)
+    siglent.cycle(dt, V_upper, I_charge, I_cut, sinks= (buffer,))
+    df = add_capacity_columns(buffer.to_dataframe()).rename(columns= CYCLING_COLUMNS)
+    """
+    def __init__(self, fields, capacity = 4096):
+        """
+        Constructor of the buffer.
+        :param fields: dictionary of the field names and their NumPy dtypes, in column order
+        :param capacity: initial number of rows
+        """
+        self.fields = dict(fields)
+        self.capacity = capacity
+        self.n = 0
+        self.columns = {name: np.empty(capacity, dtype= dtype) for name, dtype in self.fields.items()}
+
+    def __len__(self):
+        return self.n
+
+    def _grow(self):
+        self.capacity *= 2
+        for name, column in self.columns.items():
+            grown = np.empty(self.capacity, dtype= column.dtype)
+            grown[:self.n] = column[:self.n]
+            self.columns[name] = grown
+
+    def append(self, row):
+        """
+        Appends one row. Keys of the row that are not fields of the buffer are ignored.
+        :param row: dictionary of the field values
+        """
+        if self.n == self.capacity:
+            self._grow()
+        n = self.n
+        for name, column in self.columns.items():
+            column[n] = row[name]
+        self.n += 1
+
+    def column(self, name):
+        """
+        :param name: field name
+        :return: NumPy view on the filled part of the field's array
+        """
+        return self.columns[name][:self.n]
+
+    def last(self, name):
+        return self.columns[name][self.n - 1]
+
+    def clear(self):
+        self.n = 0
+
+    def to_dataframe(self, columns = None):
+        """
+        Builds a pandas DataFrame from the buffered rows.
+        :param columns: optional dictionary renaming the fields to the DataFrame's column names
+        :return: pandas DataFrame
+        """
+        df = pd.DataFrame({name: self.column(name).copy() for name in self.fields})
+        if columns is not None:
+            df = df.rename(columns= columns)
+        return df
+
+
+# Fields of the raw rows produced by the sampling loops. The capacities are computed afterwards (see capacity.py).
+CYCLING_FIELDS = {
+    'cycle_no': np.int32,
+    'status': object,
+    't': np.float64,
+    'V': np.float64,
+    'I': np.float64,
+}
+
+# Column names of the DataFrame returned by Cycling.cycle
+CYCLING_COLUMNS = {
+    't': 't [s]',
+    'V': 'V [V]',
+    'I': 'I [A]',
+    'cap_charge': 'cap_charge [Ahr]',
+    'cap_discharge': 'cap_discharge [Ahr]',
+}
+
+# Fields of the raw rows buffered by PSU.CC_charge and E_load.CC_discharge
+CC_FIELDS = {
+    't': np.float64,
+    'I': np.float64,
+    'V': np.float64,
+    'status': object,
+}
+
+# Fields of the rows produced by the pulse protocols (see pulse.py)
+PULSE_FIELDS = {
+    'pulse_no': np.int32,
+    'step': object,
+    't': np.float64,
+    'V': np.float64,
+    'I': np.float64,
+}
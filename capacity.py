@@ -0,0 +1,211 @@
+"""
+Vectorized post-hoc capacity and energy integration of the raw t/V/I data of the sampling loops.
+-----------------------------------------------------------------------------------------------
+The integrals restart at every segment start (e.g. every cycle or step), and are computed for all the segments
+at once with NumPy, without a Python loop over the rows or the segments.
+Integration methods:
+* 'rectangle': left-rectangle rule (the rule the sampling loops used to apply while sampling)
+* 'trapezoid': trapezoidal rule
+* 'simpson': composite Simpson's rule for uneven spacing. Each pair of intervals of a segment is integrated
+  with the parabola through its three points. An odd last interval uses the parabola through its previous point.
+"""
+import numpy as np
+import pandas as pd
+
+METHODS = ('rectangle', 'trapezoid', 'simpson')
+
+
+def segment_starts(*keys):
+    """
+    :param keys: arrays of equal length (e.g. cycle numbers, statuses)
+    :return: indices of the rows where any of the keys changes, starting with 0
+    """
+    n = len(keys[0])
+    if n == 0:
+        return np.zeros(0, dtype= np.intp)
+    change = np.zeros(n, dtype= bool)
+    change[0] = True
+    for key in keys:
+        key = np.asarray(key)
+        change[1:] |= key[1:] != key[:-1]
+    return np.flatnonzero(change)
+
+
+def _interval_integrals(t, y, starts, method):
+    """
+    :return: integral over each interval [t[i], t[i+1]], 0 for the intervals crossing a segment start
+    """
+    t = np.asarray(t, dtype= float)
+    y = np.asarray(y, dtype= float)
+    n = len(t)
+    if n < 2:
+        return np.zeros(max(n - 1, 0))
+    h = np.diff(t)
+    if method == 'rectangle':
+        increments = y[:-1] * h
+    elif method == 'trapezoid':
+        increments = 0.5 * (y[:-1] + y[1:]) * h
+    elif method == 'simpson':
+        increments = _simpson_intervals(t, y, starts)
+    else:
+        raise ValueError(f'method should be one of {METHODS}, got {method!r}')
+    crossing = np.asarray(starts)[1:] - 1 # intervals ending on a segment start
+    increments[crossing] = 0.0
+    return increments
+
+
+def _simpson_intervals(t, y, starts):
+    n = len(t)
+    i = np.arange(n - 1) # interval [t[i], t[i+1]]
+    starts = np.asarray(starts)
+    lengths = np.diff(np.append(starts, n))
+    first = np.repeat(starts, lengths)[:-1]
+    last = np.repeat(starts + lengths - 1, lengths)[:-1] # last row of the interval's segment
+    # first point of the parabola: the pair's first point, or the previous point for an unpaired last interval
+    p = i - (i - first) % 2
+    p = np.where(p + 2 > last, i - 1, p)
+    trapezoid = (p < first) | (last - first < 2) # segments with less than three points
+    p = np.clip(p, 0, n - 3) if n >= 3 else np.zeros_like(p)
+
+    increments = 0.5 * (y[:-1] + y[1:]) * np.diff(t)
+    if n < 3:
+        return increments
+    # parabola y0 + d1*u + d2*u*(u - u1), with u = t - t[p]
+    u1 = t[p + 1] - t[p]
+    u2 = t[p + 2] - t[p]
+    d1 = (y[p + 1] - y[p]) / u1
+    d2 = ((y[p + 2] - y[p + 1]) / (u2 - u1) - d1) / u2
+    a = t[i] - t[p]
+    b = t[i + 1] - t[p]
+    parabola = (y[p] * (b - a) + d1 * (b ** 2 - a ** 2) / 2
+                + d2 * ((b ** 3 - a ** 3) / 3 - u1 * (b ** 2 - a ** 2) / 2))
+    return np.where(trapezoid, increments, parabola)
+
+
+def cumulative_integral(t, y, starts = None, method = 'trapezoid'):
+    """
+    Cumulative integral of y over t, restarting from 0 at each segment start.
+    :param t: times
+    :param y: integrand
+    :param starts: segment starts (see segment_starts). One segment if None.
+    :param method: 'rectangle', 'trapezoid', or 'simpson'
+    :return: array of the cumulative integral at each row
+    """
+    starts = np.zeros(1, dtype= np.intp) if starts is None else np.asarray(starts)
+    n = len(t)
+    if n == 0:
+        return np.zeros(0)
+    cumulative = np.concatenate(([0.0], np.cumsum(_interval_integrals(t, y, starts, method))))
+    # subtract the cumulative sum reached at the start of each row's segment
+    offsets = np.repeat(cumulative[starts], np.diff(np.append(starts, n)))
+    return cumulative - offsets
+
+
+def integral(t, y, starts = None, method = 'trapezoid'):
+    """
+    Integral of y over t within each segment.
+    :return: array of the integrals of the segments
+    """
+    starts = np.zeros(1, dtype= np.intp) if starts is None else np.asarray(starts)
+    if len(t) == 0:
+        return np.zeros(0)
+    increments = np.append(_interval_integrals(t, y, starts, method), 0.0)
+    return np.add.reduceat(increments, starts)
+
+
+def _columns(df, columns):
+    names = {'cycle_no': 'cycle_no', 'status': 'status', 't': 't', 'V': 'V', 'I': 'I',
+             'cap_charge': 'cap_charge', 'cap_discharge': 'cap_discharge'}
+    if columns is not None:
+        names.update(columns)
+    return names
+
+
+def _raw(df, names):
+    n = len(df)
+    t = df[names['t']].to_numpy(dtype= float)
+    V = df[names['V']].to_numpy(dtype= float)
+    I = df[names['I']].to_numpy(dtype= float)
+    cycle = df[names['cycle_no']].to_numpy() if names['cycle_no'] in df else np.ones(n, dtype= int)
+    status = df[names['status']].astype(str)
+    charging = status.str.endswith('_charge').to_numpy()
+    return t, V, I, cycle, status.to_numpy(), charging
+
+
+def add_capacity_columns(df, method = 'trapezoid', columns = None):
+    """
+    Computes the charge and discharge capacity columns from the raw t/I/status columns.
+    The charge capacity accumulates over the charging rows (status ending with '_charge') of each cycle and is
+    held on its final value during the cycle's other rows. The discharge capacity accumulates over the other
+    rows of each cycle and is 0 during charging.
+    :param df: pandas DataFrame with the t, I and status columns, and optionally cycle_no
+    :param method: 'rectangle', 'trapezoid', or 'simpson'
+    :param columns: optional dictionary mapping the field names (t, V, I, status, cycle_no, cap_charge,
+    cap_discharge) to the DataFrame's column names (e.g. buffer.CYCLING_COLUMNS)
+    :return: the DataFrame with the capacity columns in Ahr
+    """
+    names = _columns(df, columns)
+    t, V, I, cycle, status, charging = _raw(df, names)
+    starts = segment_starts(cycle, charging)
+    q = cumulative_integral(t, I, starts, method) / 3600
+    cap_charge = pd.Series(np.where(charging, q, np.nan), index= df.index)
+    cap_charge = cap_charge.groupby(cycle).ffill().fillna(0.0)
+    df[names['cap_charge']] = cap_charge.to_numpy()
+    df[names['cap_discharge']] = np.where(charging, 0.0, q)
+    return df
+
+
+def step_summary(df, method = 'trapezoid', columns = None):
+    """
+    Summary of each step (run of rows with the same cycle number and status).
+    :return: pandas DataFrame with the duration, capacity, energy and average voltage of each step
+    """
+    names = _columns(df, columns)
+    t, V, I, cycle, status, charging = _raw(df, names)
+    starts = segment_starts(cycle, status)
+    if len(starts) == 0:
+        return pd.DataFrame(columns= ['cycle_no', 'status', 't_start [s]', 'duration [s]', 'Q [Ahr]', 'E [Whr]',
+                                      'V_mean [V]', 'V_end [V]'])
+    ends = np.append(starts[1:], len(t)) - 1
+    duration = t[ends] - t[starts]
+    area_V = integral(t, V, starts, method)
+    return pd.DataFrame({
+        'cycle_no': cycle[starts],
+        'status': status[starts],
+        't_start [s]': t[starts],
+        'duration [s]': duration,
+        'Q [Ahr]': integral(t, I, starts, method) / 3600,
+        'E [Whr]': integral(t, V * I, starts, method) / 3600,
+        'V_mean [V]': np.divide(area_V, duration, out= V[starts].copy(), where= duration > 0),
+        'V_end [V]': V[ends],
+    })
+
+
+def cycle_summary(df, method = 'trapezoid', columns = None):
+    """
+    Summary of each cycle.
+    :return: pandas DataFrame with the charge and discharge capacities and energies, the coulombic efficiency
+    (Q_discharge / Q_charge) and the energy efficiency (E_discharge / E_charge) of each cycle
+    """
+    names = _columns(df, columns)
+    t, V, I, cycle, status, charging = _raw(df, names)
+    starts = segment_starts(cycle, charging)
+    Q = integral(t, I, starts, method) / 3600
+    E = integral(t, V * I, starts, method) / 3600
+    segment_cycle = cycle[starts]
+    segment_charging = charging[starts]
+    cycles, index = np.unique(segment_cycle, return_inverse= True)
+    Q_charge = np.bincount(index, weights= np.where(segment_charging, Q, 0.0), minlength= len(cycles))
+    Q_discharge = np.bincount(index, weights= np.where(segment_charging, 0.0, Q), minlength= len(cycles))
+    E_charge = np.bincount(index, weights= np.where(segment_charging, E, 0.0), minlength= len(cycles))
+    E_discharge = np.bincount(index, weights= np.where(segment_charging, 0.0, E), minlength= len(cycles))
+    with np.errstate(divide= 'ignore', invalid= 'ignore'):
+        return pd.DataFrame({
+            'cycle_no': cycles,
+            'Q_charge [Ahr]': Q_charge,
+            'Q_discharge [Ahr]': Q_discharge,
+            'E_charge [Whr]': E_charge,
+            'E_discharge [Whr]': E_discharge,
+            'coulombic_efficiency': np.where(Q_charge > 0, Q_discharge / Q_charge, np.nan),
+            'energy_efficiency': np.where(E_charge > 0, E_discharge / E_charge, np.nan),
+        })
@@ -0,0 +1,216 @@
+import os
+import sqlite3
+import threading
+import time
+import pandas as pd
+from cycle_stats import CycleStatistics
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    cell_id TEXT,
+    protocol TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL,
+    psu_id TEXT,
+    e_load_id TEXT,
+    cycles INTEGER,
+    dt REAL,
+    V_upper REAL,
+    I_charge REAL,
+    I_cut REAL,
+    V_cut REAL,
+    I_dis REAL,
+    t_wait REAL,
+    capacity REAL,
+    C_rate_charge REAL,
+    C_rate_discharge REAL,
+    data_path TEXT
+);
+CREATE TABLE IF NOT EXISTS cycles (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    cycle_no INTEGER NOT NULL,
+    Q_charge REAL,
+    Q_discharge REAL,
+    E_charge REAL,
+    E_discharge REAL,
+    coulombic_efficiency REAL,
+    energy_efficiency REAL,
+    duration REAL,
+    samples INTEGER,
+    PRIMARY KEY (run_id, cycle_no)
+);
+CREATE INDEX IF NOT EXISTS runs_cell ON runs(cell_id, started);
+CREATE INDEX IF NOT EXISTS runs_started ON runs(started);
+CREATE INDEX IF NOT EXISTS cycles_Q_discharge ON cycles(Q_discharge);
+"""
+
+RUN_PARAMETERS = ('psu_id', 'e_load_id', 'cycles', 'dt', 'V_upper', 'I_charge', 'I_cut', 'V_cut', 'I_dis', 't_wait',
+                  'capacity')
+
+
+class Catalog:
+    """
+    ------------------------------
+    SQLite catalog of the cycling runs.
+    ------------------------------
+    Holds one row per run (cell, protocol, instrument ids, settings, C-rates, data file) in the runs table and
+    one row per cycle (capacities, energies, efficiencies) in the cycles table. The tables are indexed, so the
+    fleet-level queries run on the catalog without reading the raw data files.
+    Cycling fills the catalog while it runs when it is given one (see Cycling's catalog parameter).
+    The catalog can be shared by the threads of an Orchestrator.
+    ------------------------------
+    Usage:
+    catalog = Catalog('data/catalog.sqlite')
+    cycle1 = Cycling(..., catalog= catalog, cell_id= 'LFP-017', capacity= 1.5)
+    ...
+    faded = catalog.capacity_fade(0.8)
+    """
+    def __init__(self, path = 'data/catalog.sqlite'):
+        """
+        Constructor of the catalog. The database and its tables are created if required.
+        :param path: SQLite database path, or ':memory:'
+        """
+        self.path = path
+        if path != ':memory:' and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok= True)
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread= False)
+        with self._lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _execute(self, sql, parameters = ()):
+        with self._lock, self.connection:
+            return self.connection.execute(sql, parameters)
+
+    def start_run(self, protocol, cell_id = None, data_path = None, **parameters):
+        """
+        Registers a run in the 'running' status.
+        :param protocol: protocol name (e.g. 'cycle', 'discharge_CC')
+        :param cell_id: identifier of the tested cell
+        :param data_path: path of the run's raw data file
+        :param parameters: run settings among RUN_PARAMETERS (psu_id, V_upper, I_charge, ...)
+        :return: run_id
+        """
+        unknown = set(parameters) - set(RUN_PARAMETERS)
+        if unknown:
+            raise ValueError(f'Unknown run parameters {sorted(unknown)}')
+        capacity = parameters.get('capacity')
+        if capacity:
+            if parameters.get('I_charge') is not None:
+                parameters['C_rate_charge'] = parameters['I_charge'] / capacity
+            if parameters.get('I_dis') is not None:
+                parameters['C_rate_discharge'] = parameters['I_dis'] / capacity
+        columns = {'protocol': protocol, 'cell_id': cell_id, 'data_path': data_path, 'status': 'running',
+                   'started': time.time(), **parameters}
+        sql = (f'INSERT INTO runs ({", ".join(columns)}) '
+               f'VALUES ({", ".join("?" * len(columns))})')
+        return self._execute(sql, tuple(columns.values())).lastrowid
+
+    def finish_run(self, run_id, status = 'finished'):
+        """
+        :param status: final status of the run ('finished', 'stopped' or 'failed')
+        """
+        self._execute('UPDATE runs SET status = ?, finished = ? WHERE run_id = ?', (status, time.time(), run_id))
+
+    def add_cycles(self, run_id, summary):
+        """
+        Stores the summary of cycles of a run, replacing the cycles already stored with the same numbers.
+        :param summary: pandas DataFrame returned by capacity.cycle_summary, with optional duration [s] and
+        samples columns, or of CycleStatistics summaries
+        """
+        rows = [(run_id, int(row['cycle_no']), row['Q_charge [Ahr]'], row['Q_discharge [Ahr]'],
+                 row['E_charge [Whr]'], row['E_discharge [Whr]'],
+                 None if pd.isna(row['coulombic_efficiency']) else row['coulombic_efficiency'],
+                 None if pd.isna(row['energy_efficiency']) else row['energy_efficiency'],
+                 row.get('duration [s]'), None if row.get('samples') is None else int(row['samples']))
+                for _, row in summary.iterrows()]
+        with self._lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO cycles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def query(self, sql, parameters = ()):
+        """
+        :param sql: SQL query on the runs and cycles tables
+        :param parameters: query parameters
+        :return: pandas DataFrame
+        """
+        with self._lock:
+            return pd.read_sql_query(sql, self.connection, params= parameters)
+
+    def runs(self, cell_id = None):
+        """
+        :param cell_id: optional cell identifier
+        :return: pandas DataFrame of the runs, the last started first
+        """
+        if cell_id is None:
+            return self.query('SELECT * FROM runs ORDER BY started DESC')
+        return self.query('SELECT * FROM runs WHERE cell_id = ? ORDER BY started DESC', (cell_id,))
+
+    def cycles(self, cell_id = None):
+        """
+        :param cell_id: optional cell identifier
+        :return: pandas DataFrame of the cycles with the cell and run settings
+        """
+        sql = ('SELECT runs.cell_id, runs.protocol, runs.V_upper, runs.I_charge, runs.I_dis, cycles.* '
+               'FROM cycles JOIN runs USING (run_id)')
+        if cell_id is None:
+            return self.query(sql + ' ORDER BY run_id, cycle_no')
+        return self.query(sql + ' WHERE runs.cell_id = ? ORDER BY run_id, cycle_no', (cell_id,))
+
+    def capacity_fade(self, threshold = 0.8, cell_id = None):
+        """
+        Cycles whose discharge capacity dropped below a fraction of the reference capacity of their cell.
+        The reference capacity is the nominal capacity of the run if it was given, otherwise the discharge
+        capacity of the cell's first recorded cycle.
+        :param threshold: fraction of the reference capacity (e.g. 0.8 for 80%)
+        :param cell_id: optional cell identifier
+        :return: pandas DataFrame of the faded cycles with their capacity retention
+        """
+        sql = """
+            WITH first AS (
+                SELECT runs.cell_id, cycles.Q_discharge AS Q_first,
+                       ROW_NUMBER() OVER (PARTITION BY runs.cell_id ORDER BY runs.started, cycles.cycle_no) AS k
+                FROM cycles JOIN runs USING (run_id)
+            )
+            SELECT runs.cell_id, cycles.run_id, cycles.cycle_no, cycles.Q_discharge,
+                   cycles.Q_discharge / COALESCE(runs.capacity, first.Q_first) AS retention
+            FROM cycles
+            JOIN runs USING (run_id)
+            JOIN first ON first.cell_id IS runs.cell_id AND first.k = 1
+            WHERE cycles.Q_discharge < ? * COALESCE(runs.capacity, first.Q_first)
+        """
+        parameters = (threshold,)
+        if cell_id is not None:
+            sql += ' AND runs.cell_id = ?'
+            parameters += (cell_id,)
+        return self.query(sql + ' ORDER BY runs.cell_id, runs.started, cycles.cycle_no', parameters)
+
+
+class CycleRecorder(CycleStatistics):
+    """
+    Sink summarizing each cycle of a run into a catalog. The cycle's summary is updated online (see
+    CycleStatistics), without buffering the rows, and stored when the next cycle starts and on close().
+    """
+    def __init__(self, catalog, run_id):
+        super().__init__()
+        self.catalog = catalog
+        self.run_id = run_id
+
+    def finish_cycle(self):
+        summary = self.summary()
+        super().finish_cycle()
+        if summary is not None and summary['samples'] >= 2:
+            self.catalog.add_cycles(self.run_id, pd.DataFrame([summary]))
+
+    def flush(self):
+        self.finish_cycle()
@@ -0,0 +1,114 @@
+import asyncio
+import threading
+import time
+
+
+class Clock:
+    """
+    ------------------------------
+    Time source of the drivers, schedulers and protocols.
+    ------------------------------
+    All the waiting and time-stamping in the package goes through the current clock (see set_clock), so the
+    real clock can be replaced by an accelerated or virtual one when running against simulated instruments.
+    """
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, duration):
+        time.sleep(duration)
+
+    def wait(self, event, timeout):
+        """
+        Waits for the event for at most timeout seconds.
+        :return: True if the event is set
+        """
+        return event.wait(timeout)
+
+    async def async_sleep(self, duration):
+        await asyncio.sleep(duration)
+
+
+class ScaledClock(Clock):
+    """
+    Clock running factor times faster than real time. Works with threads (e.g. Orchestrator).
+    """
+    def __init__(self, factor):
+        """
+        :param factor: time acceleration (e.g. 1000 runs 1000 simulated seconds per real second)
+        """
+        self.factor = factor
+        self._t0 = time.monotonic()
+
+    def monotonic(self):
+        return self._t0 + (time.monotonic() - self._t0) * self.factor
+
+    def sleep(self, duration):
+        time.sleep(duration / self.factor)
+
+    def wait(self, event, timeout):
+        return event.wait(timeout / self.factor)
+
+    async def async_sleep(self, duration):
+        await asyncio.sleep(duration / self.factor)
+
+
+class VirtualClock(Clock):
+    """
+    Discrete clock whose time only moves when something sleeps: sleep(duration) returns immediately and
+    advances the time by duration. A protocol of any length runs as fast as the code allows.
+    Intended for single-threaded simulations. With several threads, their sleeps add up.
+    """
+    def __init__(self, t0 = 0.0):
+        self.t = t0
+        self._lock = threading.Lock()
+
+    def monotonic(self):
+        return self.t
+
+    def sleep(self, duration):
+        if duration > 0:
+            with self._lock:
+                self.t += duration
+
+    def wait(self, event, timeout):
+        if not event.is_set():
+            self.sleep(timeout)
+        return event.is_set()
+
+    async def async_sleep(self, duration):
+        self.sleep(duration)
+        await asyncio.sleep(0)
+
+
+_clock = Clock()
+
+
+def set_clock(new_clock):
+    """
+    Replaces the clock used by the package.
+    :param new_clock: Clock instance
+    :return: the previous clock
+    """
+    global _clock
+    previous, _clock = _clock, new_clock
+    return previous
+
+
+def get_clock():
+    return _clock
+
+
+def monotonic():
+    return _clock.monotonic()
+
+
+def sleep(duration):
+    _clock.sleep(duration)
+
+
+def wait(event, timeout):
+    return _clock.wait(event, timeout)
+
+
+async def async_sleep(duration):
+    await _clock.async_sleep(duration)
@@ -0,0 +1,150 @@
+"""
+Online per-cycle statistics of the sampling loops.
+-----------------------------------------------------------------------------------------------
+CycleStatistics is a sink updating the aggregates of the current cycle in O(1) per row, without keeping the
+rows: charge and discharge capacities and energies (trapezoidal rule, restarting at every change between
+charging and not charging like capacity.cycle_summary), time spent in CC, CV and rest steps, and the voltage
+at the end of the rests after charging and after discharging. When a row of a new cycle arrives (or on
+close()), the summary of the finished cycle is passed to its sinks at once, so a months-long test can be
+monitored, and stopped on a criterion, while it runs.
+-----------------------------------------------------------------------------------------------
+Usage:
+stats = CycleStatistics(sinks= [default_bus.channel('cycles')], stop_when= lambda s: s['Q_discharge [Ahr]'] < 1.2,
+                        stop_event= event)
+cycle1.cycle(sinks= [stats])
+stats.close() # summary of the last cycle
+stats.to_dataframe()
+"""
+import math
+import pandas as pd
+from records import emit
+
+SUMMARY_COLUMNS = ['cycle_no', 'Q_charge [Ahr]', 'Q_discharge [Ahr]', 'E_charge [Whr]', 'E_discharge [Whr]',
+                   'coulombic_efficiency', 'energy_efficiency', 'V_mean_charge [V]', 'V_mean_discharge [V]',
+                   't_CC [s]', 't_CV [s]', 't_rest [s]', 'V_rest_charged [V]', 'V_rest_discharged [V]',
+                   'duration [s]', 'samples']
+
+
+def step_kind(status):
+    """
+    :return: 'CC', 'CV' or 'rest' (any other status, e.g. 'wait_between')
+    """
+    kind = str(status)[:2]
+    return kind if kind in ('CC', 'CV') else 'rest'
+
+
+class CycleStatistics:
+    """
+    ------------------------------
+    Sink computing the summary of each cycle incrementally.
+    ------------------------------
+    The rows are those of the sampling loops (cycle number, status, t, V, I). A charging row has a status ending
+    with '_charge'. Each interval between two rows is integrated into the segment of its first row, unless the
+    cycle or the charging state changes between them, and its duration is counted in the step kind of its
+    first row (see step_kind) unless the status changes.
+    The summary of a cycle is a dictionary with the SUMMARY_COLUMNS keys. The average voltages are E / Q.
+    """
+    def __init__(self, sinks = (), stop_when = None, stop_event = None, cycle_field = 'cycle_no',
+                 status_field = 'status'):
+        """
+        Constructor of the statistics.
+        :param sinks: objects with an append(summary) method receiving the summary of each finished cycle
+        :param stop_when: optional function of a cycle's summary returning True to stop the run (e.g. on a
+        capacity fade)
+        :param stop_event: threading.Event set when stop_when returns True, e.g. the stop event of the protocol
+        :param cycle_field: name of the cycle number in the rows (e.g. 'pulse_no')
+        :param status_field: name of the status in the rows (e.g. 'step')
+        """
+        self.sinks = tuple(sinks)
+        self.stop_when = stop_when
+        self.stop_event = stop_event
+        self.cycle_field = cycle_field
+        self.status_field = status_field
+        self.summaries = [] # summaries of the finished cycles
+        self.stopped = False # True once stop_when returned True
+        self._last = None # (cycle, status, charging, t, V, I) of the previous row
+        self._reset(None)
+
+    def _reset(self, cycle):
+        self.cycle = cycle
+        self.samples = 0
+        self.t_start = None
+        self.Q = {True: 0.0, False: 0.0} # charging: capacity in As
+        self.E = {True: 0.0, False: 0.0} # charging: energy in Ws
+        self.durations = {'CC': 0.0, 'CV': 0.0, 'rest': 0.0}
+        self.V_rest = {True: math.nan, False: math.nan} # charging: voltage at the end of the following rest
+        self._direction = None # charging state of the last CC or CV step
+
+    def append(self, row):
+        cycle, status = row[self.cycle_field], row[self.status_field]
+        t, V, I = row['t'], row['V'], row['I']
+        charging = str(status).endswith('_charge')
+        if cycle != self.cycle:
+            self.finish_cycle()
+            self._reset(cycle)
+            self._last = None
+        last = self._last
+        if last is not None:
+            _, status_0, charging_0, t_0, V_0, I_0 = last
+            h = t - t_0
+            if charging == charging_0:
+                self.Q[charging_0] += 0.5 * (I_0 + I) * h
+                self.E[charging_0] += 0.5 * (V_0 * I_0 + V * I) * h
+            if status == status_0:
+                self.durations[step_kind(status_0)] += h
+        else:
+            self.t_start = t
+        kind = step_kind(status)
+        if kind == 'rest':
+            if self._direction is not None:
+                self.V_rest[self._direction] = V
+        else:
+            self._direction = charging
+        self.samples += 1
+        self._last = (cycle, status, charging, t, V, I)
+
+    def summary(self):
+        """
+        :return: summary of the current cycle so far, or None before the first row
+        """
+        if self._last is None:
+            return None
+        Q_charge, Q_discharge = self.Q[True] / 3600, self.Q[False] / 3600
+        E_charge, E_discharge = self.E[True] / 3600, self.E[False] / 3600
+        return {'cycle_no': self.cycle,
+                'Q_charge [Ahr]': Q_charge, 'Q_discharge [Ahr]': Q_discharge,
+                'E_charge [Whr]': E_charge, 'E_discharge [Whr]': E_discharge,
+                'coulombic_efficiency': Q_discharge / Q_charge if Q_charge > 0 else math.nan,
+                'energy_efficiency': E_discharge / E_charge if E_charge > 0 else math.nan,
+                'V_mean_charge [V]': E_charge / Q_charge if Q_charge else math.nan,
+                'V_mean_discharge [V]': E_discharge / Q_discharge if Q_discharge else math.nan,
+                't_CC [s]': self.durations['CC'], 't_CV [s]': self.durations['CV'],
+                't_rest [s]': self.durations['rest'],
+                'V_rest_charged [V]': self.V_rest[True], 'V_rest_discharged [V]': self.V_rest[False],
+                'duration [s]': self._last[3] - self.t_start, 'samples': self.samples}
+
+    def finish_cycle(self):
+        """
+        Passes the summary of the current cycle to the sinks and checks stop_when. Called when a row of the
+        next cycle arrives and by close().
+        """
+        summary = self.summary()
+        if summary is None:
+            return
+        self.summaries.append(summary)
+        emit(self.sinks, summary)
+        if self.stop_when is not None and not self.stopped and self.stop_when(summary):
+            self.stopped = True
+            if self.stop_event is not None:
+                self.stop_event.set()
+
+    def close(self):
+        self.finish_cycle()
+        self._reset(None)
+        self._last = None
+
+    def to_dataframe(self):
+        """
+        :return: pandas DataFrame of the summaries of the finished cycles
+        """
+        return pd.DataFrame(self.summaries, columns= SUMMARY_COLUMNS)
@@ -1,15 +1,24 @@
 from psu import PSU
 from e_load import E_load
-import time
-import numpy as np
-import pandas as pd
+from buffer import CC_FIELDS, CYCLING_FIELDS, CYCLING_COLUMNS
+from capacity import add_capacity_columns
+from catalog import CycleRecorder
+from recipe import CC, CCCV, Executor, Loop, Profile, Recipe, Rest
+from scheduler import sleep, StopRequested
+from visa_session import default_pool
+from watchdog import Watchdog
+import contextlib
+import threading
+import warnings
 
 class Cycling:
     """
-    A class object for various cycling protocols.
+    A class object for various cycling protocols. The protocols are recipes (see recipe.py) run by run().
     """
     def __init__(self, t_wait_init, psu_id, e_load_id,
-                 cycles, dt, V_upper, I_charge, I_cut, t_wait, V_cut, I_dis):
+                 cycles, dt, V_upper, I_charge, I_cut, t_wait, V_cut, I_dis, pool = None,
+                 stop_event = None, catalog = None, cell_id = None, capacity = None, telemetry = None,
+                 profiler = None, limits = None, temperature = None, watchdog_period = 0.1):
         """
         Constructor of cycling class.
         :param t_wait_init: The initial wait period
@@ -23,6 +32,19 @@ class Cycling:
         :param t_wait: The wait period between the battery's charging and discharging steps
         :param V_cut: Battery lower terminal voltage
         :param I_dis: Battery discharging current
+        :param pool: SessionPool shared by the instruments. Uses the process-wide default_pool if None.
+        :param stop_event: optional threading.Event. The protocols turn off the instruments and raise
+        StopRequested when it is set.
+        :param catalog: optional Catalog. The protocols register their runs and per-cycle summaries in it.
+        :param cell_id: identifier of the tested cell, stored in the catalog
+        :param capacity: nominal capacity of the cell in Ahr, stored in the catalog with the C-rates
+        :param telemetry: TelemetryBus receiving the samples. Uses the process-wide default_bus if None.
+        :param profiler: optional profiling.Profiler timing the exchanges with the two instruments and the sampling
+        loops. The summary of each run is stored in the profile attribute.
+        :param limits: optional watchdog.Limits. A Watchdog polls the instruments every watchdog_period seconds during
+        the runs, turns off the outputs and stops the run (LimitExceeded) when a limit is exceeded.
+        :param temperature: optional function returning the cell temperature in degC, checked against limits.T_max
+        :param watchdog_period: polling period of the watchdog in seconds
         """
         self.t_wait_init = t_wait_init
         self.psu_id = psu_id
@@ -35,8 +57,116 @@ class Cycling:
         self.t_wait = t_wait
         self.V_cut = V_cut
         self.I_dis = I_dis
+        self.pool = pool
+        self.stop_event = stop_event
+        self.catalog = catalog
+        self.cell_id = cell_id
+        self.capacity = capacity
+        self.telemetry = telemetry
+        self.profiler = profiler
+        self.profile = None # profiler summary of the last run
+        self.limits = limits
+        self.temperature = temperature
+        self.watchdog_period = watchdog_period
+        self.watchdog = None # watchdog of the last run
+        if profiler is not None:
+            (default_pool if pool is None else pool).set_profiler(profiler, ids= (psu_id, e_load_id))
+
+    @contextlib.contextmanager
+    def _catalog_run(self, protocol, sinks):
+        """
+        Registers a run of the protocol in the catalog and adds a CycleRecorder to the sinks. The run's status is
+        set to 'finished', 'stopped' or 'failed' when the block exits. Yields the sinks unchanged without a catalog.
+        :param protocol: protocol name
+        :param sinks: sinks of the protocol. The path of the first sink with one (e.g. a StreamWriter) is stored
+        as the run's data path.
+        """
+        if self.catalog is None:
+            yield sinks
+            return
+        data_path = next((str(sink.path) for sink in sinks if hasattr(sink, 'path')), None)
+        run_id = self.catalog.start_run(protocol, self.cell_id, data_path, psu_id= self.psu_id,
+                                        e_load_id= self.e_load_id, cycles= self.cycles, dt= self.dt,
+                                        V_upper= self.V_upper, I_charge= self.I_charge, I_cut= self.I_cut,
+                                        V_cut= self.V_cut, I_dis= self.I_dis, t_wait= self.t_wait,
+                                        capacity= self.capacity)
+        recorder = CycleRecorder(self.catalog, run_id)
+        status = 'failed'
+        try:
+            yield (*sinks, recorder)
+            status = 'finished'
+        except StopRequested:
+            status = 'stopped'
+            raise
+        finally:
+            recorder.close()
+            self.catalog.finish_run(run_id, status)
+
+    @contextlib.contextmanager
+    def _profiled_run(self, protocol, sinks):
+        """
+        Adds the profiler's loop sink to the sinks. When the block exits, the profiler's summary (covering the
+        exchanges since the previous run, e.g. the opening of the sessions) is stored in the profile attribute
+        and the statistics are reset. The traced events are kept. Yields the sinks unchanged without a profiler.
+        """
+        if self.profiler is None:
+            yield sinks
+            return
+        try:
+            yield (*sinks, self.profiler.loop(protocol))
+        finally:
+            self.profile = self.profiler.summary()
+            self.profiler.reset(events= False)
+
+    @contextlib.contextmanager
+    def _watchdog(self, psu, load):
+        """
+        Runs a Watchdog on the instruments during the block. Yields the stop event of the run: an event set by the
+        watchdog when it trips and relaying the stop_event. A StopRequested raised in the block after a trip is
+        converted to LimitExceeded. Yields the stop_event unchanged without limits.
+        """
+        if self.limits is None:
+            yield self.stop_event
+            return
+        run_event = threading.Event()
+        self.watchdog = Watchdog(psu, load, self.limits, period= self.watchdog_period, temperature= self.temperature,
+                                 stop_event= run_event, follow= self.stop_event)
+        with self.watchdog:
+            try:
+                yield run_event
+            except StopRequested as error:
+                self.watchdog.raise_if_tripped(error)
+                raise
+
+    def run(self, recipe, sinks = (), return_output = True, fields = CYCLING_FIELDS, columns = CYCLING_COLUMNS):
+        """
+        Runs a recipe (see recipe.py) on the psu and the e-load, registering the run in the catalog and
+        profiling it when they are given. The instruments are created if the recipe requires them, and watched
+        by a Watchdog if limits are given.
+        :param recipe: Recipe
+        :param sinks: additional sinks receiving the rows (e.g. a StreamWriter)
+        :param return_output: if True, the rows are also buffered in memory and returned.
+        :param fields: fields of the returned DataFrame (see buffer.py)
+        :param columns: optional dictionary renaming the columns of the returned DataFrame
+        :return: pandas Dataframe with the rows and the capacities
+        """
+        required = recipe.instruments()
+        siglent = rigol = None
+        if 'psu' in required:
+            siglent = PSU(id= self.psu_id, pool= self.pool, stop_event= self.stop_event, telemetry= self.telemetry)
+        if 'load' in required:
+            rigol = E_load(self.e_load_id, pool= self.pool, stop_event= self.stop_event, telemetry= self.telemetry)
+
+        with self._catalog_run(recipe.name, sinks) as sinks, self._profiled_run(recipe.name, sinks) as sinks, \
+                self._watchdog(siglent, rigol) as stop_event:
+            executor = Executor(psu= siglent, load= rigol, dt= self.dt, stop_event= stop_event)
+            df = executor.run(recipe, sinks, return_output, fields)
+
+        if return_output:
+            df = add_capacity_columns(df)
+            return df if columns is None else df.rename(columns= columns)
 
-    def cycle(self):
+    def cycle(self, sinks = (), return_output = True):
         """
         CC-CV cycling
         -----------------------------------------------------------
@@ -47,161 +177,78 @@ class Cycling:
         4. CC-CV discharge
         5. Wait for some time (t_wait)
         6. Repeat steps 2-5 for n cycles
+        :param sinks: additional sinks receiving the rows while cycling (e.g. a StreamWriter)
+        :param return_output: if True, the rows are also buffered in memory and returned.
         :return: pandas Dataframe on the cycling information (potential, current, and capacities).
         """
-        #Define instruments
-        siglent = PSU(id= self.psu_id)
-
-        rigol = E_load(self.e_load_id)
-
         #Step 1
-        time.sleep(self.t_wait_init)
-
-        # initialize empty dataframe
-        df = pd.DataFrame({
-            'cycle_no': [],
-            'status': [],
-            't [s]': [],
-            'V [V]': [],
-            'I [A]': [],
-            'cap_charge [Ahr]': [],
-            'cap_discharge [Ahr]': []
-        })
-        for cycle in range(1,self.cycles + 1):
-
-            t_start = time.time() # Start_timer
-            #Step 2 (CC_CV charging)
-            #----------------------------------------------------------------------------
-            t_list,V_list,I_list,W_list, status_list, cap_charge_list, cap_discharge_list = siglent.cycle(
-                self.dt,
-                self.V_upper,
-                self.I_charge,
-                self.I_cut)
-            df_charge = pd.DataFrame({
-                'cycle_no': cycle * np.ones(len(t_list)),
-                'status': status_list,
-                't [s]': t_list,
-                'V [V]': V_list,
-                'I [A]': I_list,
-                'cap_charge [Ahr]': cap_charge_list,
-                'cap_discharge [Ahr]': cap_discharge_list
-            })
-
-            df = df.append(df_charge, ignore_index= True)
-            del df_charge
+        sleep(self.t_wait_init, self.stop_event)
 
-            time_elapsed = time.time() - t_start  #time elasped since timer was started
-            #Step 3,4,5,6
-            #---------------------------------------------------------------------------
-            t_list, V_list, I_list, status_list, cap_charge_list, cap_discharge_list = rigol.cycle(
-                self.t_wait,
-                self.V_cut,
-                self.I_cut,
-                self.I_dis,
-                self.dt,
-                cap_charge_list[-1])
-            df_discharge = pd.DataFrame({
-                'cycle_no': cycle * np.ones(len(t_list)),
-                'status': status_list,
-                't [s]': t_list,
-                'V [V]': V_list,
-                'I [A]': I_list,
-                'cap_charge [Ahr]': cap_charge_list,
-                'cap_discharge [Ahr]': cap_discharge_list
-            })
-            df_discharge['t [s]'] = df_discharge['t [s]'] + time_elapsed #Add charging time to discharge times
-            df = df.append(df_discharge, ignore_index= True)
-            del df_discharge
-        return df
+        #Steps 2-6, the time restarts at each cycle
+        recipe = Recipe('cycle', [Loop(self.cycles, [CCCV(self.I_charge, self.V_upper, self.I_cut, direction= 'charge'),
+                                                     Rest(self.t_wait, 'wait_between'),
+                                                     CCCV(self.I_dis, self.V_cut, self.I_cut, direction= 'discharge'),
+                                                     Rest(self.t_wait, 'wait_end')])])
+        return self.run(recipe, sinks, return_output)
 
-    def discharge(self, return_ouput = True):
+    def discharge(self, return_output = True, sinks = (), return_ouput = None):
         """
         Battery CC-CV discharge
-        :param return_ouput: if True, the function returns the relevant cycling information.
+        :param return_output: if True, the function returns the relevant cycling information.
+        :param sinks: additional sinks receiving the rows while discharging (e.g. a StreamWriter)
+        :param return_ouput: deprecated misspelling of return_output, still accepted
         :return: pandas Dataframe with relevant cycling information
         """
-        rigol = E_load(self.e_load_id)
-
+        if return_ouput is not None:
+            warnings.warn('return_ouput is deprecated, use return_output', DeprecationWarning, stacklevel= 2)
+            return_output = return_ouput
         # Step 1
-        time.sleep(self.t_wait_init)
-        # Step 2 (CC-CV discharge)
-        t_list, V_list, I_list = rigol.cycle(self.t_wait,
-                                             self.V_cut,
-                                             self.I_cut,
-                                             self.I_dis,
-                                             self.dt)
-        df_discharge = pd.DataFrame({
-            't [s]': t_list,
-            'V [V]': V_list,
-            'I [A]': I_list,
-            'status': status_list
-        })
-        if return_ouput:
-            return df_discharge
-
-    def charge(self, return_output = True):
+        sleep(self.t_wait_init, self.stop_event)
+        # Step 2 (CC-CV discharge between two waits)
+        recipe = Recipe('discharge', [Rest(self.t_wait, 'wait_between'),
+                                      CCCV(self.I_dis, self.V_cut, self.I_cut, direction= 'discharge'),
+                                      Rest(self.t_wait, 'wait_end')])
+        return self.run(recipe, sinks, return_output)
+
+    def charge(self, return_output = True, sinks = ()):
         """
         Battery CC-CV charging
         :param return_output: if True, the function returns the relevant cycling information.
+        :param sinks: additional sinks receiving the rows while charging (e.g. a StreamWriter)
         :return: pandas Dataframe with relevant cycling information
         """
-        siglent = PSU(self.psu_id)
+        recipe = Recipe('charge', [CCCV(self.I_charge, self.V_upper, self.I_cut, direction= 'charge')])
+        return self.run(recipe, sinks, return_output)
 
-        t_list, V_list, I_list, W_list, status_list = siglent.cycle(self.dt,
-                                                                    self.V_upper,
-                                                                    self.I_charge,
-                                                                    self.I_cut)
-        df_charge = pd.DataFrame({
-            't [s]': t_list,
-            'V [V]': V_list,
-            'I [A]': I_list,
-            'status': status_list
-        })
-        if return_output:
-            return df_charge
+    def charge_profile(self, steps, return_output = True, sinks = ()):
+        """
+        Battery charging with a profile sequenced by the psu's timer (see PSU.profile_charge), until I_cut
+        :param steps: list of (voltage, current, duration) groups, duration in seconds
+        :param return_output: if True, the function returns the relevant cycling information.
+        :param sinks: additional sinks receiving the rows while charging (e.g. a StreamWriter)
+        :return: pandas Dataframe with relevant cycling information
+        """
+        recipe = Recipe('charge_profile', [Profile(steps, self.I_cut)])
+        return self.run(recipe, sinks, return_output)
 
-    def charge_CC(self, measuring_instrument, return_output):
+    def charge_CC(self, measuring_instrument, return_output, sinks = ()):
         """
         Battery CC charging
-        :param measuring_instrument: the measurement instrument
+        :param measuring_instrument: the measurement instrument, 'eload' to measure the voltage with the e-load
         :param return_output: if True, the function returns the relevant cycling information.
+        :param sinks: additional sinks receiving the rows while charging (e.g. a StreamWriter)
         :return: pandas Dataframe with relevant cycling information
         """
-        siglent = PSU(self.psu_id)
-
-        if measuring_instrument == 'eload':
-            measuring_instr = self.e_load_id
-        else:
-            measuring_instr = 'same'
+        sense = 'load' if measuring_instrument == 'eload' else 'psu'
+        recipe = Recipe('charge_CC', [CC(self.I_charge, self.V_upper, direction= 'charge', sense= sense)])
+        return self.run(recipe, sinks, return_output, fields= CC_FIELDS, columns= None)
 
-        df = siglent.CC_charge(dt= self.dt,
-                               V_upper= self.V_upper,
-                               I_charge= self.I_charge,
-                               measuring_instr= measuring_instr,
-                               return_output = return_output)
-
-        if return_output:
-            return df
-
-    def discharge_CC(self, return_output):
+    def discharge_CC(self, return_output, sinks = ()):
         """
         Battery CC discharge
         :param return_output: if True, the function returns the relevant cycling information.
+        :param sinks: additional sinks receiving the rows while discharging (e.g. a StreamWriter)
         :return: pandas Dataframe with relevant cycling information
         """
-
-        rigol = E_load(self.e_load_id)
-
-        df = rigol.CC_discharge(dt = self.dt,
-                                V_lower= self.V_cut,
-                                I_dis= self.I_dis,
-                                return_output = return_output)
-
-        if return_output:
-            return df
-
-
-
-
-
-
+        recipe = Recipe('discharge_CC', [CC(self.I_dis, self.V_cut, direction= 'discharge')])
+        return self.run(recipe, sinks, return_output, fields= CC_FIELDS, columns= None)
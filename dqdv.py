@@ -0,0 +1,237 @@
+"""
+Incremental capacity (dQ/dV) and differential voltage (dV/dQ) analysis of the logged data.
+-----------------------------------------------------------------------------------------------
+The charging and discharging rows of each cycle (|I| above I_min, the rests are left out) form a segment. The
+voltage of a segment is made monotonic (running maximum while charging, minimum while discharging) so that
+Q(V) is a function, and all the segments are resampled at once:
+* dQ/dV: Q(V) on a uniform voltage grid of step dV, differentiated along the grid
+* dV/dQ: V(Q) on a uniform capacity grid of step dQ, differentiated along the grid
+The curves are smoothed by a Gaussian kernel of sigma grid points. The segments are processed together as
+rows of 2D arrays (NaN outside the range of a segment), with one batched interpolation for all of them and
+without a Python loop over the rows or the segments. analyze_files runs files in a process pool and caches
+the curves of each file in cache_dir, keyed by the file's size and modification time and the parameters.
+The dQ/dV of a discharge is negative (Q grows while V falls), and so is its dV/dQ.
+-----------------------------------------------------------------------------------------------
+Usage:
+curves = differential_curves(read_stream('data/20211203_ECM_OCV_discharge.csv'), dV= 0.002)
+curves.dQdV.plot(x= 'V [V]', y= 'dQ/dV [Ahr/V]')
+curves = analyze_files(glob.glob('data/*_OCV_*.csv'), cache_dir= 'data/cache')
+"""
+import hashlib
+import itertools
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from capacity import add_capacity_columns, segment_starts
+from ecm_fit import normalize_columns
+from stream_writer import read_stream
+
+DQDV_COLUMNS = ['cycle_no', 'direction', 'V [V]', 'Q [Ahr]', 'dQ/dV [Ahr/V]']
+DVDQ_COLUMNS = ['cycle_no', 'direction', 'Q [Ahr]', 'V [V]', 'dV/dQ [V/Ahr]']
+
+DifferentialCurves = namedtuple('DifferentialCurves', ['dQdV', 'dVdQ'])
+
+
+def _segments(df, I_min):
+    """
+    :return: cycle number, charging state, V, Q (from the start of the segment) and segment index of the rows
+    of the charging and discharging segments
+    """
+    df = normalize_columns(df)
+    if 'cap_charge' not in df or 'cap_discharge' not in df:
+        df = add_capacity_columns(df.copy())
+    I = df['I'].to_numpy(dtype= float)
+    keep = np.abs(I) > I_min
+    cycle = (df['cycle_no'].to_numpy() if 'cycle_no' in df else np.ones(len(df), dtype= int))[keep]
+    charging = df['status'].astype(str).str.endswith('_charge').to_numpy()[keep]
+    V = df['V'].to_numpy(dtype= float)[keep]
+    Q = np.where(charging, df['cap_charge'].to_numpy(dtype= float)[keep],
+                 df['cap_discharge'].to_numpy(dtype= float)[keep])
+    starts = segment_starts(cycle, charging)
+    segment = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(V))))
+    Q = Q - Q[starts][segment]
+    return cycle, charging, V, Q, segment, starts
+
+
+def _running_max(x, segment):
+    """
+    :return: running maximum of x restarting at each segment (segment nondecreasing)
+    """
+    if len(x) == 0:
+        return x
+    span = x.max() - x.min() + 1.0
+    offset = segment * span - x.min()
+    return np.maximum.accumulate(x + offset) - offset
+
+
+def batched_interp(x_query, query_segment, x, y, segment, n_segments):
+    """
+    Linear interpolation of many curves at once. x is nondecreasing within each segment and the segments are
+    sorted. The queries outside the range of their segment are NaN.
+    :param x_query: query points
+    :param query_segment: segment index of each query point
+    :param x: abscissas of the curves, concatenated
+    :param y: ordinates of the curves, concatenated
+    :param segment: segment index of each point of the curves
+    :param n_segments: number of segments
+    :return: interpolated values at the query points
+    """
+    result = np.full(len(x_query), np.nan)
+    if len(x) == 0:
+        return result
+    low = min(x.min(), x_query.min())
+    span = max(x.max(), x_query.max()) - low + 1.0
+    key = segment * span + (x - low)
+    query_key = query_segment * span + (x_query - low)
+    first = np.searchsorted(segment, np.arange(n_segments))
+    last = np.searchsorted(segment, np.arange(n_segments), side= 'right') - 1
+    i = np.searchsorted(key, query_key, side= 'right') - 1 # last point at or before the query
+    first, last = first[query_segment], last[query_segment]
+    interior = (i >= first) & (i < last)
+    i0 = i[interior]
+    dx = x[i0 + 1] - x[i0]
+    with np.errstate(divide= 'ignore', invalid= 'ignore'):
+        w = np.where(dx > 0, (x_query[interior] - x[i0]) / dx, 1.0)
+    result[interior] = y[i0] + w * (y[i0 + 1] - y[i0])
+    end = (i == last) & (i >= first) & (x[i] == x_query) # query on the last point of its segment
+    result[end] = y[i[end]]
+    return result
+
+
+def gaussian_smooth(values, sigma):
+    """
+    Smooths the rows of a 2D array with a Gaussian kernel, ignoring the NaN (normalized convolution).
+    :param values: 2D array, one curve per row
+    :param sigma: standard deviation of the kernel in grid points, 0 for no smoothing
+    :return: smoothed array, NaN where values is NaN
+    """
+    if sigma <= 0:
+        return values
+    half = int(np.ceil(3 * sigma))
+    kernel = np.exp(-0.5 * (np.arange(-half, half + 1) / sigma) ** 2)
+    valid = ~np.isnan(values)
+    padded = np.pad(np.where(valid, values, 0.0), ((0, 0), (half, half)))
+    padded_valid = np.pad(valid.astype(float), ((0, 0), (half, half)))
+    n = values.shape[1]
+    total = np.zeros(values.shape)
+    weights = np.zeros(values.shape)
+    for k, w in enumerate(kernel):
+        total += w * padded[:, k:k + n]
+        weights += w * padded_valid[:, k:k + n]
+    with np.errstate(invalid= 'ignore'):
+        return np.where(valid, total / weights, np.nan)
+
+
+def _resample(x, y, segment, n_segments, step):
+    """
+    :return: uniform grid of step covering all the segments, and the 2D array of y on the grid (one row per
+    segment)
+    """
+    grid = np.arange(np.floor(x.min() / step), np.ceil(x.max() / step) + 1) * step
+    query_segment = np.repeat(np.arange(n_segments), len(grid))
+    values = batched_interp(np.tile(grid, n_segments), query_segment, x, y, segment, n_segments)
+    return grid, values.reshape(n_segments, len(grid))
+
+
+def differential_curves(df, dV = 0.005, dQ = None, sigma = 2.0, I_min = 1e-3, min_points = 10):
+    """
+    Computes the dQ/dV and dV/dQ curves of each charge and discharge of each cycle.
+    :param df: pandas DataFrame with the t, V, I and status columns (field names or CYCLING_COLUMNS names), and
+    optionally cycle_no, cap_charge and cap_discharge (computed from t and I if missing)
+    :param dV: step of the voltage grid in V
+    :param dQ: step of the capacity grid in Ahr. Defaults to 1/500 of the largest segment capacity.
+    :param sigma: standard deviation of the Gaussian smoothing in grid points, 0 for none
+    :param I_min: rows with |I| below I_min (rests) are left out
+    :param min_points: segments with fewer rows are left out
+    :return: DifferentialCurves(dQdV, dVdQ) of pandas DataFrames with the DQDV_COLUMNS and DVDQ_COLUMNS
+    """
+    cycle, charging, V, Q, segment, starts = _segments(df, I_min)
+    counts = np.diff(np.append(starts, len(V)))
+    kept = np.flatnonzero(counts >= min_points)
+    dQdV_parts, dVdQ_parts = [], []
+    for direction in (True, False):
+        selected = kept[charging[starts[kept]] == direction]
+        if len(selected) == 0:
+            continue
+        rows = np.isin(segment, selected)
+        seg = np.searchsorted(selected, segment[rows]) # renumbered 0..n-1
+        n = len(selected)
+        sign = 1.0 if direction else -1.0
+        x = _running_max(sign * V[rows], seg) # voltage made monotonic, increasing in the signed space
+        q = Q[rows]
+        cycles = cycle[starts[selected]]
+        label = 'charge' if direction else 'discharge'
+
+        grid, Q_grid = _resample(x, q, seg, n, dV)
+        dQdV = gaussian_smooth(np.gradient(Q_grid, dV, axis= 1), sigma) * sign
+        valid = ~np.isnan(dQdV)
+        dQdV_parts.append(pd.DataFrame({'cycle_no': np.repeat(cycles, len(grid))[valid.ravel()],
+                                        'direction': label,
+                                        'V [V]': np.tile(sign * grid, n)[valid.ravel()],
+                                        'Q [Ahr]': Q_grid[valid], 'dQ/dV [Ahr/V]': dQdV[valid]}))
+
+        q_monotonic = _running_max(q, seg)
+        step = dQ if dQ is not None else max(q_monotonic.max(), 1e-12) / 500
+        Q_axis, V_grid = _resample(q_monotonic, x, seg, n, step)
+        dVdQ = gaussian_smooth(np.gradient(V_grid, step, axis= 1), sigma) * sign
+        valid = ~np.isnan(dVdQ)
+        dVdQ_parts.append(pd.DataFrame({'cycle_no': np.repeat(cycles, len(Q_axis))[valid.ravel()],
+                                        'direction': label,
+                                        'Q [Ahr]': np.tile(Q_axis, n)[valid.ravel()],
+                                        'V [V]': sign * V_grid[valid], 'dV/dQ [V/Ahr]': dVdQ[valid]}))
+    dQdV = pd.concat(dQdV_parts, ignore_index= True) if dQdV_parts else pd.DataFrame(columns= DQDV_COLUMNS)
+    dVdQ = pd.concat(dVdQ_parts, ignore_index= True) if dVdQ_parts else pd.DataFrame(columns= DVDQ_COLUMNS)
+    return DifferentialCurves(dQdV, dVdQ)
+
+
+def _cache_path(cache_dir, path, parameters):
+    stat = os.stat(path)
+    key = repr((os.path.abspath(path), stat.st_size, stat.st_mtime_ns, parameters)).encode()
+    name = f'{os.path.splitext(os.path.basename(path))[0]}_{hashlib.sha1(key).hexdigest()[:16]}.pkl'
+    return os.path.join(cache_dir, name)
+
+
+def analyze_file(path, cache_dir = None, **parameters):
+    """
+    Reads a file written by a StreamWriter (see read_stream) and computes its curves (see differential_curves).
+    :param cache_dir: optional directory caching the curves. A file is analyzed again when it changes.
+    :param parameters: parameters of differential_curves
+    :return: DifferentialCurves with the file's path in the file column
+    """
+    cache = None
+    if cache_dir is not None:
+        cache = _cache_path(cache_dir, path, sorted(parameters.items()))
+        if os.path.exists(cache):
+            return DifferentialCurves(*pd.read_pickle(cache))
+    curves = differential_curves(read_stream(path), **parameters)
+    for curve in curves:
+        curve.insert(0, 'file', str(path))
+    if cache is not None:
+        os.makedirs(cache_dir, exist_ok= True)
+        pd.to_pickle(tuple(curves), cache)
+    return curves
+
+
+def analyze_files(paths, cache_dir = None, max_workers = None, **parameters):
+    """
+    Computes the curves of many files in a process pool.
+    :param paths: file paths
+    :param cache_dir: optional directory caching the curves of each file
+    :param max_workers: number of processes. Defaults to the number of CPUs.
+    :param parameters: parameters of differential_curves
+    :return: DifferentialCurves of the curves of all the files
+    """
+    paths = list(paths)
+    with ProcessPoolExecutor(max_workers= max_workers) as executor:
+        results = list(executor.map(_analyze_file, paths, itertools.repeat(cache_dir), itertools.repeat(parameters)))
+    curves = []
+    for k, columns in enumerate((DQDV_COLUMNS, DVDQ_COLUMNS)):
+        parts = [result[k] for result in results if len(result[k])]
+        curves.append(pd.concat(parts, ignore_index= True) if parts else pd.DataFrame(columns= ['file', *columns]))
+    return DifferentialCurves(*curves)
+
+
+def _analyze_file(path, cache_dir, parameters):
+    return analyze_file(path, cache_dir, **parameters)
@@ -1,59 +1,198 @@
-import time
-import pyvisa
-import pandas as pd
+import numpy as np
+import clock
+from buffer import CC_FIELDS
+from capacity import add_capacity_columns, cumulative_integral
+from recipe import CC, CCCV, Executor, Recipe, Rest
+from records import Sample, Waveform
+from scheduler import StopRequested
+from telemetry import default_bus
+from visa_session import default_pool, exclusive
 
 
 class E_load:
     """
     The class structure for the electronic load.
     """
-    def __init__(self, id):
+    SAMPLE_QUERIES = ('MEASure:VOLTage?', 'MEASure:CURRent?', 'MEASure:POWer?', ':SOURce:FUNCtion?')
+    FUNCTION_MODES = {'CURRENT': 'CC', 'CURR': 'CC', 'VOLTAGE': 'CV', 'VOLT': 'CV',
+                      'RESISTANCE': 'CR', 'RES': 'CR', 'POWER': 'CP', 'POW': 'CP'}
+    CAPTURE_QUERIES = ('MEASure:VOLTage?', 'MEASure:CURRent?')
+    MAX_LIST_STEPS = 512 # size of the DL3021's list memory
+    MIN_CAPTURE_PERIOD = 1e-3 # shortest USB round trip, the capture clock advances by it if a query takes no time
+
+    def __init__(self, id, pool = None, combined_queries = False, stop_event = None, telemetry = None):
+        """
+        Constructor of the e-load class.
+        :param id: e-load id
+        :param pool: SessionPool holding the e-load's session. Uses the process-wide default_pool if None.
+        :param combined_queries: If True, sample() sends all its queries as one compound SCPI command.
+        Otherwise it only queries the voltage and the current (two round-trips), the power is V * I and the mode
+        is the one set by the last set_CC or set_CV.
+        :param stop_event: optional threading.Event. The sampling loops turn off the load and raise
+        StopRequested when it is set.
+        :param telemetry: TelemetryBus receiving the samples of the loops. Uses the process-wide default_bus if None.
+        """
         self.id = id
+        self.pool = default_pool if pool is None else pool
+        self.lock = self.pool.lock(id)
+        self.combined_queries = combined_queries
+        self.mode = None # mode set by the last set_CC or set_CV
+        self.stop_event = stop_event
+        self.telemetry = default_bus if telemetry is None else telemetry
+        self.scheduler = None # DeadlineScheduler of the last sampling loop, holds its timing statistics
 
     @property
     def load(self):
         """
-        E-load initialization
+        E-load session. The session is opened once and reused from the session pool.
         :return: an e-load object
         """
-        rm = pyvisa.ResourceManager()
-        return rm.open_resource(self.id)
+        return self.pool.open(self.id)
+
+    def open(self):
+        return self.load
+
+    def close(self):
+        self.pool.close(self.id)
+
+    def __enter__(self):
+        self.open()
+        return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @exclusive
     def turn_on_load(self):
         self.load.write(':SOURce:INPut:STATe 1')
 
+    @exclusive
     def turn_off_load(self):
         self.load.write(':SOURce:INPut:STATe 0')
 
+    @exclusive
     def set_CC(self, I_dis):
         self.load.write(':SOURce:FUNCtion CURRent')
         self.load.write(f':SOURce:CURRent:LEVel:IMM {I_dis}')
+        self.mode = 'CC'
 
+    @exclusive
     def set_CV(self, V_cut):
         self.load.write(':SOURce:FUNCtion VOLTage')
         self.load.write(f':SOURce:VOLTage:LEVel:IMM {V_cut}')
+        self.mode = 'CV'
 
+    @exclusive
     def measureV(self):
         return float(self.load.query('MEASure:VOLTage?'))
 
+    @exclusive
     def measureI(self):
         return float(self.load.query('MEASure:CURRent?'))
 
-    def update_lists(self,
-                     t_list, t,
-                     V_list, V,
-                     I_list, I,
-                     status_list, status,
-                     cap_charge_list, cap_charge,
-                     cap_discharge_list, cap_discharge):
-        t_list.append(t)
-        V_list.append(V)
-        I_list.append(I)
-        status_list.append(status)
-        cap_charge_list.append(cap_charge)
-        cap_discharge_list.append(cap_discharge)
-
-    def cycle(self, t_wait, V_cut, I_cut, I_dis, dt, cap_charge_init):
+    @exclusive
+    def sample(self):
+        """
+        Measures the voltage, current, power and operation mode, in one exchange with combined_queries.
+        :return: Sample(V, I, W, status) where status is 'CC', 'CV', 'CR', or 'CP' (None without combined_queries
+        before the first set_CC or set_CV)
+        """
+        load = self.load
+        if not self.combined_queries:
+            V, I = float(load.query('MEASure:VOLTage?')), float(load.query('MEASure:CURRent?'))
+            return Sample(V, I, V * I, self.mode)
+        V, I, W, mode = load.query(';:'.join(self.SAMPLE_QUERIES)).split(';')
+        mode = mode.strip()
+        return Sample(float(V), float(I), float(W), self.FUNCTION_MODES.get(mode.upper(), mode))
+
+    @exclusive
+    def set_list(self, levels, widths, count = 1, mode = 'CC', end = 'OFF'):
+        """
+        Loads a sequence of set points into the load's list memory and arms it on the bus trigger.
+        Once triggered, the load steps through the list with its own timing, so the pulse edges do not
+        depend on the USB round trips.
+        :param levels: set point of each step (A in CC mode, V in CV mode, ...)
+        :param widths: duration of each step in seconds
+        :param count: number of runs through the list (0 repeats it until the input is turned off)
+        :param mode: 'CC', 'CV', 'CR', or 'CP'
+        :param end: state after the last step, 'OFF' (input off) or 'LAST' (keeps the last set point)
+        """
+        if len(levels) != len(widths):
+            raise ValueError('levels and widths should have the same length')
+        if not 0 < len(levels) <= self.MAX_LIST_STEPS:
+            raise ValueError(f'The list should have 1 to {self.MAX_LIST_STEPS} steps, got {len(levels)}')
+        load = self.load
+        load.write(f':SOURce:LIST:MODE {mode}')
+        load.write(f':SOURce:LIST:STEP {len(levels)}')
+        load.write(f':SOURce:LIST:COUNt {count}')
+        for step, (level, width) in enumerate(zip(levels, widths)):
+            load.write(f':SOURce:LIST:LEVel {step},{level}')
+            load.write(f':SOURce:LIST:WIDth {step},{width}')
+        load.write(f':SOURce:LIST:END {end}')
+        load.write(':SOURce:FUNCtion:MODE LIST')
+        load.write(':TRIGger:SOURce BUS')
+
+    @exclusive
+    def clear_list(self):
+        """
+        Returns the load to the fixed set point mode used by set_CC and set_CV.
+        """
+        self.load.write(':SOURce:FUNCtion:MODE FIXed')
+
+    @exclusive
+    def trigger(self):
+        self.load.write('*TRG')
+
+    def capture(self, duration, levels = None, widths = None, count = 1, mode = 'CC', max_samples = None):
+        """
+        High-rate capture of a transient (e.g. a current pulse and the relaxation after it).
+        ------------------------------
+        If levels and widths are given, the sequence is loaded in the load's list memory (see set_list) and
+        run by the load itself from the trigger. Otherwise the current set point is kept (e.g. after set_CC)
+        and the input is turned on at the trigger.
+        The voltage and current are then read back-to-back with one compound query per sample, without
+        pacing, pandas or printing, into NumPy arrays. Each sample is time-stamped at the middle of its
+        query. The DL3021 has no readable sample buffer, so the resolution is one USB round trip (a few ms).
+        ------------------------------
+        :param duration: capture duration in seconds from the trigger
+        :param levels: set points of the list steps, or None
+        :param widths: durations of the list steps in seconds, or None
+        :param count: number of runs through the list
+        :param mode: list mode, 'CC', 'CV', 'CR', or 'CP'
+        :param max_samples: optional maximum number of samples
+        :return: Waveform(t, V, I) of NumPy arrays, t in seconds from the trigger
+        """
+        load = self.load
+        query = ';:'.join(self.CAPTURE_QUERIES)
+        answers, stamps = [], []
+        if levels is not None:
+            self.set_list(levels, widths, count, mode, end= 'OFF')
+        try:
+            self.turn_on_load()
+            if levels is not None:
+                self.trigger()
+            t_trigger = clock.monotonic()
+            t_end = t_trigger + duration
+            t_after = t_trigger
+            while t_after < t_end and (max_samples is None or len(answers) < max_samples):
+                if self.stop_event is not None and self.stop_event.is_set():
+                    raise StopRequested()
+                with self.lock:
+                    t_before = clock.monotonic()
+                    answers.append(load.query(query))
+                    if clock.monotonic() <= t_before: # e.g. a VirtualClock with a simulator without latency
+                        clock.sleep(self.MIN_CAPTURE_PERIOD)
+                    t_after = clock.monotonic()
+                stamps.append(0.5 * (t_before + t_after))
+        finally:
+            self.turn_off_load()
+            if levels is not None:
+                self.clear_list()
+
+        values = np.array([answer.split(';') for answer in answers], dtype= float).reshape(-1, 2)
+        return Waveform(np.asarray(stamps) - t_trigger, values[:, 0], values[:, 1])
+
+    def cycle(self, t_wait, V_cut, I_cut, I_dis, dt, cap_charge_init, sinks = (), cycle_no = 1, t_offset = 0):
         """
         CC-CV discharge
         :param t_wait: the wait period between the charging and the discharging step
@@ -62,172 +201,46 @@ class E_load:
         :param I_dis: Battery discharge current
         :param dt: measurement interval
         :param cap_charge_init: the charge capacity before discharge
+        :param sinks: objects with an append(row) method (e.g. ColumnBuffer) that receive each sample as a row
+        :param cycle_no: cycle number written in the rows passed to the sinks
+        :param t_offset: time offset added to the times written in the rows passed to the sinks
         :return: potential, current, and capacities data during battery discharge
         """
-        t = 0
-        t_list, V_list, I_list, status_list = [], [], [], []
-        cap_charge_list, cap_discharge_list = [], []
-        t_start = time.time()
-        cap_discharge = 0
-        counter = 0
-        # Initial wait
+        recipe = Recipe('discharge', [Rest(t_wait, 'wait_between'),
+                                      CCCV(I_dis, V_cut, I_cut, direction= 'discharge'),
+                                      Rest(t_wait, 'wait_end')])
+        df = Executor(load= self, dt= dt).run(recipe, sinks, cycle_no= cycle_no, t_offset= t_offset)
+        t_list = (df['t'] - t_offset).tolist()
+        I_list = df['I'].tolist()
+
+        # capacities, integrated after the loops
         # -------------------------------------
-        while t < t_wait:
-            if counter == 0:
-                t_last = 0
-            else:
-                t_last = t
-            t = time.time() - t_start
-            V = self.measureV()
-            I = 0
-            cap_charge = cap_charge_init
-            cap_discharge += I*(t - t_last)/3600
-            status = 'wait_between'
-            # Update list
-            print(t, V, I, status, cap_charge, cap_discharge)
-            self.update_lists(t_list, t,
-                              V_list, V,
-                              I_list, I,
-                              status_list, status,
-                              cap_charge_list, cap_charge,
-                              cap_discharge_list, cap_discharge)
-            # Meaurement break
-            time.sleep(dt)
-
-        # CC discharge
-        #-----------------------------------------------
-        self.set_CC(I_dis)
-        self.turn_on_load()
-        while V >= V_cut:
-            t_last = t
-            t = time.time() - t_start
-            V = self.measureV()
-            I = self.measureI()
-            status = 'CC_discharge'
-            cap_charge = cap_charge_init
-            cap_discharge += I*(t - t_last)/3600
-            # Update list
-            print(t, V, I, status, cap_charge, cap_discharge)
-            self.update_lists(t_list, t,
-                              V_list, V,
-                              I_list, I,
-                              status_list, status,
-                              cap_charge_list, cap_charge,
-                              cap_discharge_list, cap_discharge)
-            #Meauring break
-            time.sleep(dt)
-        self.turn_off_load()
-
-        # CV Discharge
-        #----------------------------------------------------------
-        self.set_CV(V_cut)
-        self.turn_on_load()
-
-        while I >= I_cut:
-            t_last = t
-            t = time.time() - t_start
-            V = self.measureV()
-            I = self.measureI()
-            status = 'CV_discharge'
-            cap_charge = cap_charge_init
-            cap_discharge += I*(t - t_last)/3600
-            # Update list
-            print(t, V, I, status, cap_charge, cap_discharge)
-            self.update_lists(t_list, t,
-                              V_list, V,
-                              I_list, I,
-                              status_list, status,
-                              cap_charge_list, cap_charge,
-                              cap_discharge_list, cap_discharge)
-            #Measuring break
-            time.sleep(dt)
-        self.turn_off_load()
-
-        #Last waiting period
-        t_end = t
-        while t < t_wait + t_end:
-            t_last = t
-            t = time.time() - t_start
-            V = self.measureV()
-            I = 0
-            status = 'wait_end'
-            cap_charge = cap_charge_init
-            cap_discharge += I*(t - t_last)/3600
-            # Update list
-            print(t, V, I, cap_charge, cap_discharge)
-            # Measuring break
-            self.update_lists(t_list, t,
-                              V_list, V,
-                              I_list, I,
-                              status_list, status,
-                              cap_charge_list, cap_charge,
-                              cap_discharge_list, cap_discharge)
-            # Measurement break
-            time.sleep(dt)
-
-        return t_list, V_list, I_list, status_list, cap_charge_list, cap_discharge_list
-
-    def CC_discharge(self, dt, V_lower, I_dis,  return_output = True):
+        cap_charge_list = [cap_charge_init] * len(t_list)
+        cap_discharge_list = (cumulative_integral(t_list, I_list) / 3600).tolist()
+
+        return t_list, df['V'].tolist(), I_list, df['status'].tolist(), cap_charge_list, cap_discharge_list
+
+    def CC_discharge(self, dt, V_lower, I_dis,  return_output = True, sinks = (), cycle_no = 1, t_offset = 0,
+                     dt_min = None, dt_max = None):
         """
         Instructs the e-load to perform CC discharge
         :param dt: time increment to take the measurement readings
         :param V_lower: battery's lower terminal voltage
         :param I_dis: battery's discharge current
         :param return_output: If or not to return the CC-charge information
+        :param sinks: objects with an append(row) method (e.g. ColumnBuffer) that receive each sample as a row
+        :param cycle_no: cycle number written in the rows passed to the sinks
+        :param t_offset: time offset added to the times written in the rows passed to the sinks
+        :param dt_min: if given, the sampling is adaptive: the interval shrinks from dt_max down to dt_min as the
+        voltage approaches V_lower, and a row interpolated at the crossing of V_lower is added before the last one
+        :param dt_max: longest interval of the adaptive sampling. Defaults to dt.
         :return: pandas DataFrame containing current, voltage, power, status, and capaciti
         """
+        recipe = Recipe('discharge_CC', [CC(I_dis, V_lower, direction= 'discharge', dt_min= dt_min, dt_max= dt_max,
+                                            interpolate= dt_min is not None)])
+        df = Executor(load= self, dt= dt).run(recipe, sinks, return_output, fields= CC_FIELDS, cycle_no= cycle_no,
+                                              t_offset= t_offset)
 
+        # Create a pandas DataFrame, with the capacities integrated from the raw data
         if return_output:
-            #intialize the lists containing the relevant information
-            #--------------------------------------------------------------------------------
-            t_list, V_list, I_list, status_list = [], [], [], []
-            cap_charge_list, cap_discharge_list = [], []
-
-        self.set_CC(I_dis= I_dis) #set the discharging current
-        self.turn_on_load()
-
-        t_start = time.time() #start timer
-        cap_discharge = 0
-        counter = 0
-        t_prev = 0 # intialize the previous time step time, which is used for capacity measurements
-        V = self.measureV()
-        while V >= V_lower:
-            t = time.time() - t_start
-            I = self.measureI()
-            V = self.measureV()
-            status = "CC_discharge"
-            cap_charge = 0
-            cap_discharge += (t - t_prev) * I / 3600
-
-            # update lists
-            if return_output:
-                t_list.append(t)
-                I_list.append(I)
-                V_list.append(V)
-                status_list.append(status)
-                cap_charge_list.append(cap_charge)
-                cap_discharge_list.append(cap_discharge)
-
-            #Update relevant variables
-            counter += 1
-            t_prev = t
-
-            #print in the console
-            print(t, I, V, status, cap_charge, cap_discharge)
-
-            #wait for the next time delay
-            time.sleep(dt)
-
-        self.turn_off_load() #turn off load
-
-        # Create a pandas DataFrame
-        if return_output:
-            df = pd.DataFrame({
-                't': t_list,
-                'I': I_list,
-                'V': V_list,
-                'status': status_list,
-                'cap_charge': cap_charge_list,
-                'cap_discharge': cap_discharge_list
-            })
-            return df
\ No newline at end of file
+            return add_capacity_columns(df)
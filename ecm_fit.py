@@ -0,0 +1,209 @@
+"""
+Equivalent-circuit model (ECM) parameter extraction from the logged data.
+-----------------------------------------------------------------------------------------------
+1. ocv_soc_curve: OCV-SOC lookup from low-rate (e.g. C/30, ECM_OCV.py) charge and/or discharge data.
+2. fit_pulses: R0 and the RC pairs (1RC or 2RC) of each current step followed by a rest, from the
+   relaxation voltage V(t) = OCV + sum(a_i * exp(-t / tau_i)). For a grid of time constants the model is
+   linear in OCV and a_i, so all the grid points are solved at once with batched least squares and the one
+   with the smallest residual is kept.
+3. fit_files: fit_pulses over many files in a process pool.
+-----------------------------------------------------------------------------------------------
+Usage:
+ocv = ocv_soc_curve(read_stream('data/20211203_ECM_OCV_discharge.csv'))
+params = fit_files(glob.glob('data/*_pulse_discharge.csv'), n_rc= 2, ocv= ocv)
+"""
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from buffer import CYCLING_COLUMNS
+from capacity import cumulative_integral, segment_starts
+from stream_writer import read_stream
+
+STEP_KEYS = ('cycle_no', 'pulse_no', 'status', 'step') # columns whose changes delimit the steps
+
+
+def normalize_columns(df):
+    """
+    :return: the DataFrame with the column names of CYCLING_COLUMNS (e.g. 't [s]') renamed to the field names
+    """
+    return df.rename(columns= {column: name for name, column in CYCLING_COLUMNS.items()})
+
+
+def _is_charge(df):
+    if 'status' not in df:
+        return np.zeros(len(df), dtype= bool)
+    return df['status'].astype(str).str.endswith('_charge').to_numpy()
+
+
+def ocv_soc_curve(discharge, charge = None, n_points = 101):
+    """
+    Builds the OCV-SOC lookup from low-rate data. The SOC is coulomb counted over each file, from 1 to 0 for
+    the discharge and from 0 to 1 for the charge. With both, the OCV is the average of the two curves.
+    :param discharge: pandas DataFrame of a low-rate discharge (t, V, I columns)
+    :param charge: optional pandas DataFrame of a low-rate charge
+    :param n_points: number of SOC points of the lookup
+    :return: pandas DataFrame with the SOC and OCV [V] columns, and the capacity in df.attrs['capacity [Ahr]']
+    """
+    soc = np.linspace(0, 1, n_points)
+    curves, capacities = [], []
+    for df, charging in ((discharge, False), (charge, True)):
+        if df is None:
+            continue
+        df = normalize_columns(df)
+        t = df['t'].to_numpy(dtype= float)
+        q = cumulative_integral(t, df['I'].to_numpy(dtype= float)) / 3600
+        capacities.append(q[-1])
+        soc_data = q / q[-1] if charging else 1 - q / q[-1]
+        order = np.argsort(soc_data, kind= 'stable')
+        curves.append(np.interp(soc, soc_data[order], df['V'].to_numpy(dtype= float)[order]))
+    curve = pd.DataFrame({'SOC': soc, 'OCV [V]': np.mean(curves, axis= 0)})
+    curve.attrs['capacity [Ahr]'] = float(np.mean(capacities))
+    return curve
+
+
+def soc_from_ocv(ocv, V):
+    """
+    :param ocv: OCV-SOC lookup (see ocv_soc_curve)
+    :param V: open circuit voltages
+    :return: SOCs interpolated in the lookup
+    """
+    ocv_V = np.maximum.accumulate(ocv['OCV [V]'].to_numpy()) # the lookup is inverted, keep it monotonic
+    return np.interp(V, ocv_V, ocv['SOC'].to_numpy())
+
+
+def tau_grid(t_min, t_max, n = 60):
+    """
+    :return: logarithmically spaced time constants between t_min and t_max
+    """
+    return np.geomspace(max(t_min, 1e-3), max(t_max, 2 * t_min), n)
+
+
+def fit_relaxation(t, V, n_rc = 1, taus = None, sign = None):
+    """
+    Fits V(t) = OCV + sum(a_i * exp(-t / tau_i)) to a relaxation with n_rc exponentials.
+    For every combination of n_rc time constants of the grid, the linear least squares problem in
+    (OCV, a_1, ..., a_n) is solved from the Gram matrix of the exponentials, all the combinations at once.
+    :param t: times from the start of the relaxation in seconds
+    :param V: voltages
+    :param n_rc: number of RC pairs (1 or 2, higher values work but grow as the grid size to the power n_rc)
+    :param taus: grid of time constants. Defaults to tau_grid(first sample interval, relaxation duration).
+    :param sign: expected sign of the amplitudes (e.g. -1 for the rise after a discharge), or None.
+    The combinations with amplitudes of the other sign are discarded unless no combination is left.
+    :return: OCV, array of the amplitudes a_i, array of the time constants tau_i (increasing), rmse
+    """
+    t = np.asarray(t, dtype= float)
+    V = np.asarray(V, dtype= float)
+    if len(t) < n_rc + 2:
+        raise ValueError(f'{len(t)} samples are not enough to fit {n_rc} RC pairs')
+    if taus is None:
+        taus = tau_grid(np.diff(t).min(initial= t[-1]) if len(t) > 1 else 1.0, t[-1] - t[0])
+    taus = np.asarray(taus, dtype= float)
+    t = t - t[0]
+    E = np.exp(-t[None, :] / taus[:, None]) # (n_tau, n)
+    EE = E @ E.T
+    E1 = E.sum(axis= 1)
+    EV = E @ V
+    combos = np.array(list(itertools.combinations(range(len(taus)), n_rc))) # (n_combo, n_rc)
+
+    # normal equations of the basis (1, exp(-t/tau_i)...) for every combination
+    k = n_rc + 1
+    G = np.empty((len(combos), k, k))
+    G[:, 0, 0] = len(t)
+    G[:, 0, 1:] = G[:, 1:, 0] = E1[combos]
+    G[:, 1:, 1:] = EE[combos[:, :, None], combos[:, None, :]]
+    b = np.empty((len(combos), k))
+    b[:, 0] = V.sum()
+    b[:, 1:] = EV[combos]
+    beta = np.einsum('cij,cj->ci', np.linalg.pinv(G), b)
+    sse = np.maximum(V @ V - np.einsum('ci,ci->c', beta, b), 0.0)
+
+    if sign is not None:
+        valid = np.all(np.sign(beta[:, 1:]) == sign, axis= 1)
+        if valid.any():
+            sse = np.where(valid, sse, np.inf)
+    best = int(np.argmin(sse))
+    return beta[best, 0], beta[best, 1:], taus[combos[best]], float(np.sqrt(sse[best] / len(t)))
+
+
+def _steps(df):
+    keys = [df[key].to_numpy() for key in STEP_KEYS if key in df]
+    if not keys:
+        keys = [np.zeros(len(df))]
+    starts = segment_starts(*keys)
+    ends = np.append(starts[1:], len(df)) - 1
+    return starts, ends
+
+
+def fit_pulses(df, n_rc = 1, ocv = None, I_rest = 0.01, min_rest_samples = 5):
+    """
+    Fits the ECM parameters of each current step that is followed by a rest.
+    The rest is the step after the pulse whose mean current is below I_rest. R0 is the voltage jump between the
+    last sample of the pulse and the first sample of the rest divided by the pulse's final current. R_i comes
+    from the amplitude of the i-th exponential, charged during the pulse: a_i = I * R_i * (1 - exp(-t_pulse/tau_i)).
+    :param df: pandas DataFrame with the t, V, I columns and the step columns (status, step, cycle_no, pulse_no)
+    :param n_rc: number of RC pairs, 1 or 2
+    :param ocv: optional OCV-SOC lookup (see ocv_soc_curve) to estimate the SOC of each pulse
+    :param I_rest: current in A under which a step is a rest
+    :param min_rest_samples: minimum number of samples of a rest to be fitted
+    :return: pandas DataFrame with one row per pulse
+    """
+    df = normalize_columns(df)
+    t = df['t'].to_numpy(dtype= float)
+    V = df['V'].to_numpy(dtype= float)
+    I = df['I'].to_numpy(dtype= float)
+    charging = _is_charge(df)
+    q = cumulative_integral(t, np.where(charging, -I, I)) / 3600 # net discharged capacity
+    starts, ends = _steps(df)
+    I_mean = np.add.reduceat(np.abs(I), starts) / (ends - starts + 1)
+
+    rows = []
+    for k in np.flatnonzero((I_mean[:-1] >= I_rest) & (I_mean[1:] < I_rest)):
+        rest = slice(starts[k + 1], ends[k + 1] + 1)
+        if ends[k + 1] - starts[k + 1] + 1 < min_rest_samples:
+            continue
+        last = ends[k]
+        I_pulse = abs(I[last])
+        jump = V[rest.start] - V[last]
+        ocv_V, amplitudes, taus, rmse = fit_relaxation(t[rest], V[rest], n_rc, sign= -np.sign(jump))
+        t_pulse = t[last] - t[starts[k]]
+        R = np.abs(amplitudes) / (I_pulse * (1 - np.exp(-t_pulse / taus)))
+        row = {key: df[key].iat[starts[k]] for key in STEP_KEYS if key in df}
+        row.update({'t_start [s]': t[starts[k]], 'duration [s]': t_pulse, 'I [A]': I_pulse,
+                    'Q [Ahr]': q[starts[k]], 'V_end [V]': V[last], 'OCV [V]': ocv_V,
+                    'R0 [Ohm]': abs(jump) / I_pulse})
+        for i in range(n_rc):
+            row[f'R{i + 1} [Ohm]'] = R[i]
+            row[f'tau{i + 1} [s]'] = taus[i]
+            row[f'C{i + 1} [F]'] = taus[i] / R[i]
+        row['rmse [V]'] = rmse
+        rows.append(row)
+    params = pd.DataFrame(rows)
+    if ocv is not None and len(params):
+        params['SOC'] = soc_from_ocv(ocv, params['OCV [V]'].to_numpy())
+    return params
+
+
+def fit_file(path, n_rc = 1, ocv = None, I_rest = 0.01):
+    """
+    Reads a file written by a StreamWriter (see read_stream) and fits its pulses (see fit_pulses).
+    :return: pandas DataFrame with one row per pulse and the file's path in the file column
+    """
+    params = fit_pulses(read_stream(path), n_rc, ocv, I_rest)
+    params.insert(0, 'file', str(path))
+    return params
+
+
+def fit_files(paths, n_rc = 1, ocv = None, I_rest = 0.01, max_workers = None):
+    """
+    Fits the pulses of many files in a process pool.
+    :param paths: file paths
+    :param max_workers: number of processes. Defaults to the number of CPUs.
+    :return: pandas DataFrame with the parameters of the pulses of all the files
+    """
+    paths = list(paths)
+    with ProcessPoolExecutor(max_workers= max_workers) as executor:
+        results = list(executor.map(fit_file, paths, itertools.repeat(n_rc), itertools.repeat(ocv),
+                                    itertools.repeat(I_rest)))
+    results = [result for result in results if len(result)]
+    return pd.concat(results, ignore_index= True) if results else pd.DataFrame()
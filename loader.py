@@ -0,0 +1,295 @@
+import csv
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from stream_writer import ColumnarStreamWriter, _scan_columnar
+
+CYCLE_COLUMNS = ('cycle_no', 'pulse_no') # candidate names of the cycle column, in order of preference
+STEP_COLUMNS = ('status', 'step') # candidate names of the step column, in order of preference
+
+
+class BlockCache:
+    """
+    ------------------------------
+    Size-bounded LRU cache of decoded data blocks.
+    ------------------------------
+    Holds the columns of the blocks decoded by RunLoader, keyed by (file, block, column). When the total
+    size of the cached arrays exceeds max_bytes, the least recently used ones are evicted.
+    One cache can be shared by the loaders of many files and by several threads.
+    """
+    def __init__(self, max_bytes = 256 * 2**20):
+        """
+        :param max_bytes: maximum total size of the cached arrays in bytes
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _nbytes(values):
+        if isinstance(values, pd.Categorical):
+            return values.codes.nbytes + sum(len(category) for category in values.categories)
+        return values.nbytes
+
+    def get(self, key):
+        with self._lock:
+            values = self._entries.get(key)
+            if values is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return values
+
+    def put(self, key, values):
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._nbytes(self._entries.pop(key))
+            self._entries[key] = values
+            self.size += self._nbytes(values)
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last= False)
+                self.size -= self._nbytes(evicted)
+
+    def discard(self, path):
+        """
+        Removes the cached blocks of a file.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == path]:
+                self.size -= self._nbytes(self._entries.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+default_cache = BlockCache() # process-wide cache used by the loaders created without an explicit cache
+
+
+class RunLoader:
+    """
+    ------------------------------
+    Lazy loader of a run's raw data file (written by CSVStreamWriter or ColumnarStreamWriter).
+    ------------------------------
+    Opening a loader only indexes the file into blocks: byte ranges of about block_size bytes for CSV files, the
+    chunks for columnar files, with the cycle number of the first row of each block. load() then decodes only
+    the blocks holding the requested cycles, and only the requested columns of them, and keeps the decoded
+    columns in an LRU BlockCache. The cycle numbers of the files are nondecreasing, so the blocks of a cycle
+    are found without decoding the others.
+    The file can still be written (e.g. by a running Cycling protocol): each call checks its size, indexes the
+    appended blocks, and ignores a partially written last row or chunk. is_appending() tells if it is growing.
+    ------------------------------
+    Usage:
+    run = RunLoader('data/ECM_parameter.csv')
+    run.cycles()
+    df = run.load(cycles= [1, 2], steps= ['CC_discharge'], columns= ['t [s]', 'V [V]'])
+    """
+    def __init__(self, path, cache = None, block_size = 8 * 2**20, append_window = 30.0):
+        """
+        Constructor of the loader.
+        :param path: file path
+        :param cache: BlockCache. Uses the process-wide default_cache if None.
+        :param block_size: size in bytes of the blocks of a CSV file
+        :param append_window: a file modified less than append_window seconds ago is considered as being appended to
+        """
+        self.path = os.path.abspath(path)
+        self.cache = default_cache if cache is None else cache
+        self.block_size = block_size
+        self.append_window = append_window
+        self._lock = threading.RLock()
+        with open(self.path, 'rb') as f:
+            self.columnar = f.read(len(ColumnarStreamWriter.MAGIC)) == ColumnarStreamWriter.MAGIC
+        self._reset()
+        self.refresh()
+
+    def _reset(self):
+        self.blocks = [] # (start, end, rows or None) byte ranges of the complete blocks
+        self.first_cycles = [] # cycle number of the first row of each block
+        self.indexed_size = 0
+        self.mtime = 0.0
+        self.cache.discard(self.path)
+        if self.columnar:
+            self.dtypes = None
+            self.categories = {} # categories of the categorical fields
+            self.columns = []
+        else:
+            with open(self.path, 'rb') as f:
+                header = f.readline()
+            self.header_line = header
+            self.columns = next(csv.reader([header.decode().rstrip('\r\n')]))
+            self.indexed_size = len(header)
+        self.cycle_column = next((name for name in CYCLE_COLUMNS if name in self.columns), None)
+        self.step_column = next((name for name in STEP_COLUMNS if name in self.columns), None)
+
+    def refresh(self):
+        """
+        Indexes the blocks appended since the last call. Rebuilds the index if the file was truncated or replaced.
+        :return: True if new blocks were indexed
+        """
+        with self._lock:
+            stat = os.stat(self.path)
+            if stat.st_size < self.indexed_size:
+                self._reset()
+            self.mtime = stat.st_mtime
+            if stat.st_size == self.indexed_size:
+                return False
+            n = len(self.blocks)
+            if self.columnar:
+                self._index_columnar()
+            else:
+                self._index_csv(stat.st_size)
+            return len(self.blocks) > n
+
+    def is_appending(self):
+        """
+        :return: True if the file grew since the last refresh or was modified less than append_window seconds ago
+        """
+        stat = os.stat(self.path)
+        return stat.st_size != self.indexed_size or time.time() - stat.st_mtime < self.append_window
+
+    def _index_csv(self, size):
+        cycle_index = self.columns.index(self.cycle_column) if self.cycle_column else None
+        with open(self.path, 'rb') as f:
+            f.seek(self.indexed_size)
+            start = self.indexed_size
+            while start < size:
+                data = f.read(self.block_size)
+                end = data.rfind(b'\n') + 1
+                if end == 0:
+                    # a block without a complete row: the rest of the file is the row being written
+                    if len(data) < self.block_size:
+                        break
+                    data += f.readline()
+                    end = data.rfind(b'\n') + 1
+                    if end == 0:
+                        break
+                first_row = next(csv.reader([data[:data.find(b'\n')].decode()]))
+                self.blocks.append((start, start + end, None))
+                self.first_cycles.append(int(float(first_row[cycle_index])) if cycle_index is not None else 0)
+                start += end
+                f.seek(start)
+        self.indexed_size = start
+
+    def _index_columnar(self):
+        dtypes, self.categories, offset, chunks = _scan_columnar(self.path)
+        if self.dtypes is None:
+            self.dtypes = dtypes
+            self.columns = list(dtypes)
+            self.cycle_column = next((name for name in CYCLE_COLUMNS if name in self.columns), None)
+            self.step_column = next((name for name in STEP_COLUMNS if name in self.columns), None)
+        with open(self.path, 'rb') as f:
+            for start, n, length in chunks[len(self.blocks):]:
+                first_cycle = 0
+                if self.cycle_column is not None:
+                    column_offset = start + sum(n * dtype.itemsize for name, dtype in self.dtypes.items()
+                                                if self.columns.index(name) < self.columns.index(self.cycle_column))
+                    f.seek(column_offset)
+                    dtype = self.dtypes[self.cycle_column]
+                    first_cycle = int(np.frombuffer(f.read(dtype.itemsize), dtype= dtype)[0])
+                self.blocks.append((start, start + length, n))
+                self.first_cycles.append(first_cycle)
+        self.indexed_size = offset
+
+    def cycles(self):
+        """
+        :return: array of the cycle numbers of the file, decoded from the cycle column
+        """
+        self.refresh()
+        if self.cycle_column is None:
+            return np.array([0])
+        return np.unique(np.concatenate([self._column(k, self.cycle_column) for k in range(len(self.blocks))]
+                                        or [np.empty(0, dtype= int)]))
+
+    def _decode_csv(self, block, columns):
+        start, end, _ = self.blocks[block]
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+        df = pd.read_csv(io.BytesIO(self.header_line + data), usecols= columns)
+        return {column: (pd.Categorical(df[column]) if pd.api.types.is_string_dtype(df[column].dtype)
+                         else df[column].to_numpy()) for column in columns}
+
+    def _decode_columnar(self, block, columns):
+        start, _, n = self.blocks[block]
+        decoded = {}
+        with open(self.path, 'rb') as f:
+            offset = start
+            for name, dtype in self.dtypes.items():
+                if name in columns:
+                    f.seek(offset)
+                    values = np.frombuffer(f.read(n * dtype.itemsize), dtype= dtype)
+                    if name in self.categories:
+                        values = pd.Categorical.from_codes(values, categories= self.categories[name])
+                    elif dtype.kind == 'S':
+                        values = pd.Categorical(np.char.decode(values, 'utf-8'))
+                    decoded[name] = values
+                offset += n * dtype.itemsize
+        return decoded
+
+    def _column(self, block, column):
+        """
+        :return: a column of a block, from the cache or decoded
+        """
+        key = (self.path, self.blocks[block][0], self.blocks[block][1], column)
+        values = self.cache.get(key)
+        if values is None:
+            decode = self._decode_columnar if self.columnar else self._decode_csv
+            values = decode(block, [column])[column]
+            self.cache.put(key, values)
+        return values
+
+    def _blocks_of(self, cycles):
+        """
+        :return: indices of the blocks that can hold rows of the cycles
+        """
+        if cycles is None or self.cycle_column is None:
+            return range(len(self.blocks))
+        first = np.asarray(self.first_cycles)
+        last = np.append(first[1:], np.iinfo(np.int64).max) # a block ends at or before the next one's first cycle
+        cycles = np.asarray(list(cycles))
+        return [k for k in range(len(first)) if np.any((cycles >= first[k]) & (cycles <= last[k]))]
+
+    def load(self, cycles = None, steps = None, columns = None):
+        """
+        Materializes the requested part of the run.
+        :param cycles: optional list of cycle numbers
+        :param steps: optional list of step names (values of the status or step column, e.g. 'CC_discharge')
+        :param columns: optional list of columns. All the columns if None.
+        :return: pandas DataFrame
+        """
+        self.refresh()
+        columns = list(self.columns) if columns is None else list(columns)
+        unknown = set(columns) - set(self.columns)
+        if unknown:
+            raise KeyError(f'{self.path} has no columns {sorted(unknown)}')
+        blocks = self._blocks_of(cycles)
+        parts = []
+        for block in blocks:
+            mask = None
+            if cycles is not None and self.cycle_column is not None:
+                mask = np.isin(self._column(block, self.cycle_column), list(cycles))
+            if steps is not None and self.step_column is not None:
+                step_mask = np.isin(np.asarray(self._column(block, self.step_column)), list(steps))
+                mask = step_mask if mask is None else mask & step_mask
+            if mask is not None and not mask.any():
+                continue
+            part = {}
+            for column in columns:
+                values = self._column(block, column)
+                part[column] = values if mask is None else values[mask]
+            parts.append(pd.DataFrame(part))
+        if not parts:
+            return pd.DataFrame({column: [] for column in columns})
+        df = pd.concat(parts, ignore_index= True)
+        # the blocks' categories differ, concat falls back to strings
+        strings = [column for column in columns if isinstance(parts[0][column].dtype, pd.CategoricalDtype)]
+        return df.astype({column: 'category' for column in strings})
@@ -3,6 +3,10 @@ from e_load import E_load
 import matplotlib.pyplot as plt
 import pandas as pd
 from cycling import Cycling
+from buffer import CYCLING_COLUMNS
+from capacity import add_capacity_columns
+from stream_writer import CSVStreamWriter, read_stream
+from catalog import Catalog
 
 
 #Input parameters
@@ -16,6 +20,8 @@ V_cut = 2
 I_dis = 1.5
 t_wait_init= 1
 cycles = 2
+cell_id = 'cell_1' # identifier of the cell in the run catalog
+capacity = 1.5 # nominal capacity in Ahr
 
 psu_id = 'USB0::0xF4EC::0x1410::SPD13DCQ4R0571::INSTR'
 load_id = 'USB0::0x1AB1::0x0E11::DL3A222600541::INSTR'
@@ -30,6 +36,14 @@ cycle1 = Cycling(t_wait_init= t_wait_init,
                  I_cut= I_cut,
                  t_wait= t_wait,
                  V_cut= V_cut,
-                 I_dis= I_dis)
-df = cycle1.cycle()
-df.to_csv('data/ECM_parameter.csv', index = False)
\ No newline at end of file
+                 I_dis= I_dis,
+                 catalog= Catalog('data/catalog.sqlite'),
+                 cell_id= cell_id,
+                 capacity= capacity)
+# stream the rows to disk while cycling so that a crash does not lose the run
+with CSVStreamWriter('data/ECM_parameter.csv', columns= CYCLING_COLUMNS) as writer:
+    cycle1.cycle(sinks= (writer,), return_output= False)
+# the streamed rows hold the raw t, V, I: the capacity columns are added once the run is over, in a separate
+# file so that the streamed one stays intact
+df = add_capacity_columns(read_stream('data/ECM_parameter.csv'), columns= CYCLING_COLUMNS)
+df.to_csv('data/ECM_parameter_capacity.csv', index = False)
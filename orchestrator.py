@@ -0,0 +1,119 @@
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from scheduler import StopRequested
+
+# Outcome of a channel's protocol. status is 'finished', 'stopped' or 'failed'.
+ChannelResult = namedtuple('ChannelResult', ['name', 'status', 'output', 'error'])
+
+
+class Orchestrator:
+    """
+    ------------------------------
+    Runs the cycling protocols of many PSU/E_load channel pairs at the same time.
+    ------------------------------
+    Each channel runs its Cycling protocol on its own worker thread. The VISA calls release the GIL, so
+    the instrument I/O of the channels overlaps and one process can drive a full rack. All the channels
+    share the orchestrator's stop event: they start together and stop together (outputs turned off).
+    ------------------------------
+    Usage:
+    with SessionPool() as pool:
+        rack = Orchestrator()
+        for name, (psu_id, load_id) in channels.items():
+            rack.add_channel(name, Cycling(..., psu_id= psu_id, e_load_id= load_id, pool= pool), 'cycle')
+        results = rack.run()
+    """
+    def __init__(self, max_workers = None, stop_on_error = False):
+        """
+        Constructor of the orchestrator.
+        :param max_workers: maximum number of channels running at the same time. Defaults to the number of channels.
+        :param stop_on_error: If True, all the channels are stopped when one of them fails.
+        """
+        self.max_workers = max_workers
+        self.stop_on_error = stop_on_error
+        self.stop_event = threading.Event()
+        self.channels = {}
+        self._executor = None
+        self._barrier = None
+        self._futures = {}
+
+    def add_channel(self, name, cycling, protocol = 'cycle', **kwargs):
+        """
+        Adds a channel.
+        :param name: channel name (e.g. cell id)
+        :param cycling: Cycling instance of the channel. Its stop event is replaced by the orchestrator's.
+        :param protocol: name of the Cycling method to run ('cycle', 'charge_CC', 'discharge_CC', ...)
+        :param kwargs: keyword arguments of the Cycling method (e.g. sinks, return_output)
+        """
+        if name in self.channels:
+            raise ValueError(f'Channel {name!r} already exists')
+        cycling.stop_event = self.stop_event
+        self.channels[name] = (cycling, protocol, kwargs)
+
+    def _run_channel(self, name):
+        cycling, protocol, kwargs = self.channels[name]
+        try:
+            self._barrier.wait() # coordinated start
+            output = getattr(cycling, protocol)(**kwargs)
+        except (StopRequested, threading.BrokenBarrierError):
+            return ChannelResult(name, 'stopped', None, None)
+        except Exception as error:
+            if self.stop_on_error:
+                self.stop()
+            return ChannelResult(name, 'failed', None, error)
+        return ChannelResult(name, 'finished', output, None)
+
+    def start(self):
+        """
+        Starts all the channels without blocking.
+        """
+        if self._executor is not None:
+            raise RuntimeError('The orchestrator is already running')
+        if not self.channels:
+            raise ValueError('The orchestrator has no channels (see add_channel)')
+        self.stop_event.clear()
+        workers = min(self.max_workers or len(self.channels), len(self.channels))
+        # the channels start together, unless there are fewer workers than channels.
+        # Then they start as the workers free up.
+        self._barrier = threading.Barrier(len(self.channels) if workers == len(self.channels) else 1)
+        self._executor = ThreadPoolExecutor(max_workers= workers, thread_name_prefix= 'channel')
+        self._futures = {name: self._executor.submit(self._run_channel, name) for name in self.channels}
+
+    def wait(self, timeout = None):
+        """
+        Waits for all the channels to finish. On timeout, all the channels are stopped (see stop) before
+        TimeoutError is raised.
+        :param timeout: maximum waiting time in seconds for each channel
+        :return: dictionary of channel names and ChannelResults
+        """
+        try:
+            results = {name: future.result(timeout= timeout) for name, future in self._futures.items()}
+        except TimeoutError:
+            self.stop()
+            raise
+        finally:
+            self._executor.shutdown(wait= False)
+            self._executor = None
+        return results
+
+    def run(self, timeout = None):
+        """
+        Starts all the channels and waits for them to finish. A KeyboardInterrupt or the timeout stops all the
+        channels.
+        :param timeout: maximum waiting time in seconds for each channel
+        :return: dictionary of channel names and ChannelResults
+        """
+        self.start()
+        try:
+            return self.wait(timeout)
+        except KeyboardInterrupt:
+            self.stop()
+            raise
+
+    def stop(self):
+        """
+        Stops all the channels. Their sampling loops turn off the outputs and return as 'stopped'.
+        """
+        self.stop_event.set()
+        if self._barrier is not None:
+            self._barrier.abort() # release the channels waiting for the coordinated start
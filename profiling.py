@@ -0,0 +1,325 @@
+"""
+Profiling of the instrument exchanges and of the sampling loops.
+-----------------------------------------------------------------------------------------------
+A Profiler attached to a SessionPool (see SessionPool.set_profiler) wraps the pool's sessions in
+ProfiledSession proxies that time every write, read and query, and the opening of the sessions. The
+latencies are accumulated per instrument and SCPI command (arguments stripped) in log-spaced histograms,
+with the timeouts, the other VISA errors and the retries (an exchange repeating a failed one).
+The sink returned by Profiler.loop() splits the wall time between two samples of a loop into the VISA
+exchanges, the sleeps (pacing delays and scheduler waits, timed by the ProfiledClock installed on the clock
+module) and the rest, the host overhead of the loop (parsing, list appends, sinks, ...).
+Recording a measurement costs a few microseconds, so the profiler can stay on in production. With
+trace= True, every exchange and sample is also kept as an event in a bounded trace, which can be exported
+in the Chrome trace format (chrome://tracing, ui.perfetto.dev).
+-----------------------------------------------------------------------------------------------
+Usage:
+profiler = Profiler()
+cycle1 = Cycling(..., profiler= profiler)
+cycle1.cycle()
+cycle1.profile # summary of the run, see Profiler.summary
+"""
+import bisect
+import collections
+import json
+import math
+import threading
+import time
+import pandas as pd
+import pyvisa
+import clock
+
+# upper edges of the latency histogram bins in seconds, 8 bins per decade from 1 us to 100 s
+BIN_EDGES = [10 ** (k / 8) for k in range(-48, 17)]
+
+_accumulated = threading.local() # VISA and sleep time of the current thread, read by the loop sinks
+
+
+def _thread_times():
+    return getattr(_accumulated, 'io', 0.0), getattr(_accumulated, 'sleep', 0.0)
+
+
+def _add_io(duration):
+    _accumulated.io = getattr(_accumulated, 'io', 0.0) + duration
+
+
+def _add_sleep(duration):
+    _accumulated.sleep = getattr(_accumulated, 'sleep', 0.0) + duration
+
+
+def command_key(command):
+    """
+    :return: the SCPI command without its arguments, e.g. 'VOLTage' for 'VOLTage 3.65'
+    """
+    return ';'.join(part.strip().split(' ', 1)[0] for part in command.split(';'))
+
+
+class LatencyHistogram:
+    """
+    Histogram of durations on the log-spaced BIN_EDGES, with their count, sum, minimum and maximum.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BIN_EDGES) + 1) # the last bin holds the durations above the last edge
+        self.n = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def add(self, duration):
+        self.counts[bisect.bisect_left(BIN_EDGES, duration)] += 1
+        self.n += 1
+        self.total += duration
+        if duration < self.min:
+            self.min = duration
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, q):
+        """
+        :param q: percentile between 0 and 100
+        :return: estimated duration in seconds (geometric center of the bin holding the percentile)
+        """
+        if not self.n:
+            return math.nan
+        rank = q / 100 * self.n
+        cumulated = 0
+        for k, count in enumerate(self.counts):
+            cumulated += count
+            if cumulated >= rank and count:
+                lower = BIN_EDGES[k - 1] if k > 0 else self.min
+                upper = BIN_EDGES[k] if k < len(BIN_EDGES) else self.max
+                return min(max(math.sqrt(lower * upper), self.min), self.max)
+        return self.max
+
+
+class CommandStats:
+    """
+    Latency histogram and failure counters of one command of one instrument.
+    """
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.timeouts = 0
+        self.errors = 0
+        self.retries = 0
+
+
+class Profiler:
+    """
+    ------------------------------
+    Collects the timing statistics of the instrument exchanges and of the sampling loops.
+    ------------------------------
+    The statistics are keyed by (source, operation, command): source is an instrument id or a loop name,
+    operation is 'write', 'read', 'query' or 'open' for the exchanges, and 'sample' for the loops, whose
+    commands are 'period', 'io', 'sleep' and 'host'. A read is recorded under the command written before it.
+    One profiler can be shared by several threads.
+    """
+    def __init__(self, trace = False, trace_limit = 1_000_000):
+        """
+        Constructor of the profiler.
+        :param trace: if True, every exchange and sample is also recorded as an event (see trace_dataframe)
+        :param trace_limit: maximum number of events kept, the oldest ones are discarded
+        """
+        self.trace = trace
+        self.stats = {}
+        self.events = collections.deque(maxlen= trace_limit)
+        self._lock = threading.Lock()
+
+    def reset(self, events = True):
+        """
+        Clears the statistics.
+        :param events: if True, the traced events are also cleared
+        """
+        with self._lock:
+            self.stats = {}
+            if events:
+                self.events.clear()
+
+    def record(self, source, operation, command, t_start, duration, error = None, retry = False):
+        """
+        Records a timed operation.
+        :param t_start: start time in seconds (time.perf_counter)
+        :param duration: duration in seconds
+        :param error: exception raised by the operation, or None
+        :param retry: True if the operation repeats a failed one
+        """
+        key = (source, operation, command)
+        with self._lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = CommandStats()
+            stats.latency.add(duration)
+            if error is not None:
+                if (isinstance(error, pyvisa.errors.VisaIOError)
+                        and error.error_code == pyvisa.constants.StatusCode.error_timeout):
+                    stats.timeouts += 1
+                else:
+                    stats.errors += 1
+            stats.retries += retry
+            if self.trace:
+                self.events.append((t_start, duration, threading.current_thread().name, source, operation, command,
+                                    None if error is None else type(error).__name__))
+
+    def wrap(self, id, session):
+        """
+        :return: ProfiledSession timing the exchanges of the session
+        """
+        return ProfiledSession(session, self, id)
+
+    def loop(self, source):
+        """
+        :param source: name of the loop (e.g. the protocol or the instrument id)
+        :return: sink timing the samples of a loop, to add to the loop's sinks
+        """
+        install_clock()
+        return LoopProfiler(self, source)
+
+    def summary(self):
+        """
+        :return: pandas DataFrame with one row per source, operation and command: count, total time, mean,
+        percentiles and maximum of the latency in ms, timeouts, errors and retries
+        """
+        with self._lock:
+            items = list(self.stats.items())
+        rows = []
+        for (source, operation, command), stats in items:
+            latency = stats.latency
+            rows.append({'source': source, 'operation': operation, 'command': command, 'count': latency.n,
+                         'total [s]': latency.total, 'mean [ms]': 1000 * latency.total / latency.n,
+                         'p50 [ms]': 1000 * latency.percentile(50), 'p90 [ms]': 1000 * latency.percentile(90),
+                         'p99 [ms]': 1000 * latency.percentile(99), 'max [ms]': 1000 * latency.max,
+                         'timeouts': stats.timeouts, 'errors': stats.errors, 'retries': stats.retries})
+        columns = ['source', 'operation', 'command', 'count', 'total [s]', 'mean [ms]', 'p50 [ms]', 'p90 [ms]',
+                   'p99 [ms]', 'max [ms]', 'timeouts', 'errors', 'retries']
+        return pd.DataFrame(rows, columns= columns).sort_values('total [s]', ascending= False, ignore_index= True)
+
+    def trace_dataframe(self):
+        """
+        :return: pandas DataFrame of the traced events (trace mode), t_start and duration in seconds
+        """
+        with self._lock:
+            events = list(self.events)
+        return pd.DataFrame(events, columns= ['t_start', 'duration', 'thread', 'source', 'operation', 'command',
+                                              'error'])
+
+    def export_trace(self, path):
+        """
+        Writes the traced events in the Chrome trace format, one track per thread.
+        :param path: JSON file path
+        """
+        with self._lock:
+            events = list(self.events)
+        trace = [{'name': f'{operation} {command}', 'cat': operation, 'ph': 'X', 'ts': 1e6 * t_start,
+                  'dur': 1e6 * duration, 'pid': 0, 'tid': thread, 'args': {'source': source, 'error': error}}
+                 for t_start, duration, thread, source, operation, command, error in events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace}, f)
+
+
+class ProfiledSession:
+    """
+    Proxy of a pyvisa session recording the duration and outcome of its exchanges in a Profiler.
+    The other attributes (timeout, terminations, close, ...) are passed to the session.
+    """
+    def __init__(self, session, profiler, id):
+        object.__setattr__(self, 'wrapped', session) # the pyvisa session
+        object.__setattr__(self, '_profiler', profiler)
+        object.__setattr__(self, '_id', id)
+        object.__setattr__(self, '_last_command', '')
+        object.__setattr__(self, '_failed', None) # (operation, command) of the last failed exchange
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.wrapped, name, value)
+
+    def _timed(self, operation, command, function, *args):
+        key = command_key(command)
+        retry = self._failed == (operation, key)
+        t_start = time.perf_counter()
+        try:
+            result = function(*args)
+        except Exception as error:
+            duration = time.perf_counter() - t_start
+            _add_io(duration)
+            object.__setattr__(self, '_failed', (operation, key))
+            self._profiler.record(self._id, operation, key, t_start, duration, error, retry)
+            raise
+        duration = time.perf_counter() - t_start
+        _add_io(duration)
+        if self._failed is not None:
+            object.__setattr__(self, '_failed', None)
+        self._profiler.record(self._id, operation, key, t_start, duration, None, retry)
+        return result
+
+    def write(self, command):
+        object.__setattr__(self, '_last_command', command)
+        return self._timed('write', command, self.wrapped.write, command)
+
+    def read(self):
+        return self._timed('read', self._last_command, self.wrapped.read)
+
+    def query(self, command):
+        return self._timed('query', command, self.wrapped.query, command)
+
+
+class LoopProfiler:
+    """
+    Sink splitting the wall time between two consecutive samples of a loop into the VISA exchanges (io), the
+    sleeps (sleep) and the rest (host). The loop must run on the thread that calls append.
+    """
+    def __init__(self, profiler, source):
+        self.profiler = profiler
+        self.source = source
+        self._last = None # (wall time, io time, sleep time) at the previous sample
+
+    def append(self, row):
+        now = time.perf_counter()
+        io, sleep = _thread_times()
+        if self._last is not None:
+            t_last, io_last, sleep_last = self._last
+            period = now - t_last
+            io, sleep = io - io_last, sleep - sleep_last
+            record = self.profiler.record
+            record(self.source, 'sample', 'period', t_last, period)
+            record(self.source, 'sample', 'io', t_last, io)
+            record(self.source, 'sample', 'sleep', t_last, sleep)
+            record(self.source, 'sample', 'host', t_last, max(period - io - sleep, 0.0))
+            io, sleep = io + io_last, sleep + sleep_last
+        self._last = (now, io, sleep)
+
+
+class ProfiledClock(clock.Clock):
+    """
+    Wraps a clock and accumulates the wall time spent in its sleeps per thread, for LoopProfiler.
+    """
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+
+    def monotonic(self):
+        return self.wrapped.monotonic()
+
+    def sleep(self, duration):
+        t_start = time.perf_counter()
+        try:
+            self.wrapped.sleep(duration)
+        finally:
+            _add_sleep(time.perf_counter() - t_start)
+
+    def wait(self, event, timeout):
+        t_start = time.perf_counter()
+        try:
+            return self.wrapped.wait(event, timeout)
+        finally:
+            _add_sleep(time.perf_counter() - t_start)
+
+    async def async_sleep(self, duration):
+        await self.wrapped.async_sleep(duration)
+
+
+def install_clock():
+    """
+    Wraps the current clock in a ProfiledClock, if it is not already wrapped.
+    """
+    current = clock.get_clock()
+    if not isinstance(current, ProfiledClock):
+        clock.set_clock(ProfiledClock(current))
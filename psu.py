@@ -1,7 +1,13 @@
+import clock
+import statistics
 import pyvisa
-import time
-import pandas as pd
 from e_load import E_load
+from buffer import CC_FIELDS
+from capacity import add_capacity_columns, cumulative_integral
+from recipe import CC, CCCV, Executor, Profile, Recipe
+from records import Sample
+from telemetry import default_bus
+from visa_session import default_pool, exclusive
 
 
 class PSU:
@@ -21,35 +27,183 @@ class PSU:
     Note:
     The name of the Aglient SPD power supply is 'USB0::0xF4EC::0x1410::SPD13DCQ4R0571::INSTR'.
     The above can be found by using the following command:
-    rm = pyvisa.ResourceManager()
-    print(rm.list_resources())
+    print(default_pool.list_resources())
     """
-    def __init__(self, id, delay = 0.05, init_delay = 0.3):
+    SAMPLE_QUERIES = ('MEASure:VOLTage?', 'MEASure:CURRent?', 'MEASure:POWEr?', 'SYSTem:STATus?')
+    SYNC_QUERIES = ('*OPC?', 'SYSTem:STATus?') # handshake queries tried in order by calibrate()
+    OUTPUT_ON_BIT = 4 # bit of SYSTem:STATus? that is set when the channel output is on
+    TIMER_GROUPS = 5 # number of (voltage, current, duration) groups of the timer sequence
+
+    def __init__(self, id, delay = 0.05, init_delay = 0.3, pool = None, combined_queries = False,
+                 pacing = 'fixed', timeout_factor = 10, min_timeout = 0.1, stop_event = None, telemetry = None):
+        """
+        Constructor of the psu class.
+        :param id: psu id
+        :param delay: delay between the SCPI commands
+        :param init_delay: delay after turning on the psu before the first measurement
+        :param pool: SessionPool holding the psu's session. Uses the process-wide default_pool if None.
+        :param combined_queries: If True, sample() sends all its queries as one compound SCPI command.
+        Otherwise the queries are sent one by one through query(), paced by the pacing mode.
+        :param pacing: 'fixed' waits delay/init_delay seconds between the SCPI commands. 'adaptive' waits
+        for the psu to answer a handshake query (*OPC? or status polling) and moves on as soon as it is ready.
+        The latency of the psu is calibrated on connection in the adaptive mode.
+        :param timeout_factor: In the adaptive mode, the read timeout is set to timeout_factor times
+        the slowest calibrated query latency.
+        :param min_timeout: Lower bound of the adaptive read timeout in seconds.
+        :param stop_event: optional threading.Event. The sampling loops turn off the psu and raise
+        StopRequested when it is set.
+        :param telemetry: TelemetryBus receiving the samples of the loops. Uses the process-wide default_bus if None.
+        """
+        if pacing not in ('fixed', 'adaptive'):
+            raise ValueError(f"pacing should be 'fixed' or 'adaptive', got {pacing!r}")
         self.id = id
         self.delay = delay
         self.init_delay = init_delay
+        self.combined_queries = combined_queries
+        self.pacing = pacing
+        self.timeout_factor = timeout_factor
+        self.min_timeout = min_timeout
+        self.stop_event = stop_event
+        self.latency = None
+        self.scheduler = None # DeadlineScheduler of the last sampling loop, holds its timing statistics
+        self.sync_query = self.SYNC_QUERIES[0]
+        self.pool = default_pool if pool is None else pool
+        self.lock = self.pool.lock(id)
+        self.telemetry = default_bus if telemetry is None else telemetry
+
+        self.supply = self.pool.open(self.id, write_termination= '\n', read_termination= '\n')
+        if self.pacing == 'adaptive':
+            self.calibrate()
+
+    def close(self):
+        self.pool.close(self.id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @exclusive
+    def calibrate(self, n = 5):
+        """
+        Measures the query latency of the psu and sets the read timeout used by the adaptive pacing.
+        Also selects the handshake query: *OPC? if the psu answers it, otherwise status polling.
+        :param n: number of timed queries
+        :return: median query latency in seconds
+        """
+        for sync_query in self.SYNC_QUERIES:
+            try:
+                self.supply.query(sync_query)
+            except pyvisa.errors.VisaIOError:
+                continue
+            self.sync_query = sync_query
+            break
+        else:
+            raise RuntimeError(f'{self.id} did not answer any of the handshake queries {self.SYNC_QUERIES}')
+
+        latencies = []
+        for _ in range(n):
+            t0 = clock.monotonic()
+            self.supply.query(self.sync_query)
+            latencies.append(clock.monotonic() - t0)
+        self.latency = statistics.median(latencies)
+        self.supply.timeout = 1000 * max(self.min_timeout, self.timeout_factor * max(latencies)) # in ms
+        return self.latency
+
+    @exclusive
+    def wait_ready(self):
+        """
+        Waits until the psu is ready for the next command. Sleeps for delay in the fixed pacing mode
+        and returns as soon as the handshake query is answered in the adaptive pacing mode.
+        """
+        if self.pacing == 'adaptive':
+            self.supply.query(self.sync_query)
+        else:
+            clock.sleep(self.delay)
 
-        rm = pyvisa.ResourceManager()
-        self.supply = rm.open_resource(self.id)
-        self.supply.write_termination = '\n'
-        self.supply.read_termination = '\n'
-
+    def wait_output_on(self):
+        """
+        Waits after turning on the psu before the first measurement. Sleeps for init_delay in the fixed
+        pacing mode. In the adaptive pacing mode, the status is polled until the output is on, for at most
+        init_delay.
+        """
+        if self.pacing == 'fixed':
+            clock.sleep(self.init_delay)
+            return
+        t_end = clock.monotonic() + self.init_delay
+        while clock.monotonic() < t_end:
+            if (int(self.readStatus(), 16) >> self.OUTPUT_ON_BIT) & 1:
+                return
+
+    @exclusive
+    def query(self, command):
+        """
+        Sends a query to the psu and returns its answer, paced according to the pacing mode.
+        :param command: SCPI query
+        :return: answer string
+        """
+        if self.pacing == 'adaptive':
+            return self.supply.query(command)
+        self.supply.write(command)
+        clock.sleep(self.delay)
+        answer = self.supply.read()
+        clock.sleep(self.delay)
+        return answer
+
+    @exclusive
     def set_psu_VI(self, V_upper, I_charge):
         # Set the channel's voltage and current
-        time.sleep(0.05)
+        self.wait_ready()
         self.supply.write(f'VOLTage {V_upper}')
-        time.sleep(0.05)
+        self.wait_ready()
         self.supply.write(f'CURRent {I_charge}')
-        time.sleep(0.05)
+        self.wait_ready()
 
+    @exclusive
     def turn_psu_on(self):
-        time.sleep(self.delay)
+        self.wait_ready()
         self.supply.write('OUTP CH1,ON')
 
+    @exclusive
     def turn_psu_off(self):
-        time.sleep(self.delay)
+        self.wait_ready()
         self.supply.write('OUTP CH1,OFF')
 
+    @exclusive
+    def set_timer(self, steps):
+        """
+        Uploads a sequence of set points into the psu's timer memory. Once started (see start_timer), the psu
+        steps through the groups with its own timing, without any command from the host, and turns off its
+        output after the last one. The unused groups are cleared.
+        :param steps: list of (voltage, current, duration) groups, duration in seconds
+        """
+        if not 0 < len(steps) <= self.TIMER_GROUPS:
+            raise ValueError(f'The timer sequence should have 1 to {self.TIMER_GROUPS} groups, got {len(steps)}')
+        for group in range(1, self.TIMER_GROUPS + 1):
+            V, I, duration = steps[group - 1] if group <= len(steps) else (0, 0, 0)
+            self.wait_ready()
+            self.supply.write(f'TIMEr:SET CH1,{group},{V},{I},{duration}')
+        self.wait_ready()
+
+    @exclusive
+    def start_timer(self):
+        """
+        Enables the timer and turns on the output, which starts the uploaded sequence.
+        """
+        self.wait_ready()
+        self.supply.write('TIMEr CH1,ON')
+        self.turn_psu_on()
+
+    @exclusive
+    def stop_timer(self):
+        """
+        Turns off the output and disables the timer, back to the fixed set points of set_psu_VI.
+        """
+        self.turn_psu_off()
+        self.wait_ready()
+        self.supply.write('TIMEr CH1,OFF')
+
     def hex_to_bin(self, hex_string):
         """
         Converts to hex to binary. Used for extracting the operation mode of the instrument
@@ -71,102 +225,70 @@ class PSU:
             return 'CC'
 
     def measureV(self):
-        self.supply.write('MEASure:VOLTage?')
-        time.sleep(self.delay)
-        V = float(self.supply.read())
-        time.sleep(self.delay)
-        return V
+        return float(self.query('MEASure:VOLTage?'))
 
     def measureI(self):
-        self.supply.write('MEASure:CURRent?')
-        time.sleep(self.delay)
-        I = float(self.supply.read())
-        time.sleep(self.delay)
-        return I
+        return float(self.query('MEASure:CURRent?'))
 
     def measureW(self):
-        self.supply.write('MEASure:POWEr?')
-        time.sleep(self.delay)
-        W = float(self.supply.read())
-        time.sleep(self.delay)
-        return W
+        return float(self.query('MEASure:POWEr?'))
 
     def readStatus(self):
-        self.supply.write('SYSTem:STATus?')
-        time.sleep(self.delay)
-        status = self.supply.read()
-        return status
+        return self.query('SYSTem:STATus?').strip()
+
+    @exclusive
+    def read_sample(self):
+        """
+        Queries the voltage, current, power and operation mode. Without combined_queries, each query goes through
+        query() and its pacing delays. The compound query is not followed by the pacing delay of sample().
+        :return: Sample(V, I, W, status) where status is 'CC' or 'CV'
+        """
+        if self.combined_queries:
+            V, I, W, status = self.supply.query(';:'.join(self.SAMPLE_QUERIES)).split(';')
+        else:
+            V, I, W, status = [self.query(command) for command in self.SAMPLE_QUERIES]
+        status = self.CC_or_CV(self.hex_to_bin(status.strip()))
+        return Sample(float(V), float(I), float(W), status)
 
-    def cycle(self, dt, V_upper, I_charge, I_cut):
+    def sample(self):
+        """
+        Measures the voltage, current, power and operation mode, in one exchange with combined_queries. Replaces
+        the four measureV, measureI, measureW, and readStatus round-trips and their delays.
+        :return: Sample(V, I, W, status) where status is 'CC' or 'CV'
+        """
+        sample = self.read_sample()
+        if self.pacing == 'fixed' and self.combined_queries:
+            clock.sleep(self.delay)
+        return sample
+
+    def cycle(self, dt, V_upper, I_charge, I_cut, sinks = (), cycle_no = 1, t_offset = 0):
         """
         CC-CV charging
         :param dt: measurement interval
         :param V_upper: Battery upper terminal voltage
         :param I_charge: Battery charging current
         :param I_cut: Battery cut-off current for the CV step
+        :param sinks: objects with an append(row) method (e.g. ColumnBuffer) that receive each sample as a row
+        :param cycle_no: cycle number written in the rows passed to the sinks
+        :param t_offset: time offset added to the times written in the rows passed to the sinks
         :return: potential, current, status, and capacities during battery CC-CV charging
         """
-        # Set the channel's voltage and current
-        self.set_psu_VI(V_upper, I_charge)
+        recipe = Recipe('charge', [CCCV(I_charge, V_upper, I_cut, direction= 'charge')])
+        df = Executor(psu= self, dt= dt).run(recipe, sinks, cycle_no= cycle_no, t_offset= t_offset)
+        t_list = (df['t'] - t_offset).tolist()
+        I_list = df['I'].tolist()
 
-        # Initialization of measuring parameters
-        t_list, V_list, I_list, W_list, status_list = [],[],[],[],[]
-        cap_charge_list, cap_discharge_list = [], []
-
-        #Turn the power supply on and start charging
-        self.turn_psu_on()
-        t_start = time.time()
-        time.sleep(self.init_delay)
-        I = I_charge
-        cap_charge = 0
-        counter = 0
-        while I >= I_cut:
-            #time
-            if counter == 0:
-                t_last = 0
-            else:
-                t_last = t
-            t = time.time() - t_start
-            #V
-            #----------------------------------------
-            V = self.measureV()
-            #I
-            #------------------------------------------
-            I = self.measureI()
-            # W
-            #---------------------------------------------
-            W = self.measureW()
-            #Status
-            #------------------------------------------------
-            status = self.readStatus()
-            status = self.hex_to_bin(status) #convert hexadecimal number to binary
-            status = self.CC_or_CV(status) #Determine if CC or CV mode
-            status = f'{status}_charge'
-            #capacities
-            #-------------------------------------------------------
-            cap_charge += I * (t - t_last)/3600
-            cap_discharge = 0
-
-            #Update list
-            print(t, V, I, W, status, cap_charge, cap_discharge)
-            t_list.append(t)
-            V_list.append(V)
-            I_list.append(I)
-            W_list.append(W)
-            status_list.append(status)
-            cap_charge_list.append(cap_charge)
-            cap_discharge_list.append(cap_discharge)
-            #Wait for the next time increment
-            time.sleep(dt - 5*self.delay - self.init_delay)
-            counter += 1
-
-        #Turn off the power supply
-        self.turn_psu_off()
+        #capacities, integrated after the loop
+        #-------------------------------------------------------
+        cap_charge_list = (cumulative_integral(t_list, I_list) / 3600).tolist()
+        cap_discharge_list = [0.0] * len(t_list)
 
-        return t_list,V_list,I_list,W_list, status_list, cap_charge_list, cap_discharge_list
+        return (t_list, df['V'].tolist(), I_list, df['W'].tolist(), df['status'].tolist(),
+                cap_charge_list, cap_discharge_list)
 
 
-    def CC_charge(self, dt, V_upper, I_charge, measuring_instr = 'same', return_output = True):
+    def CC_charge(self, dt, V_upper, I_charge, measuring_instr = 'same', return_output = True,
+                  sinks = (), cycle_no = 1, t_offset = 0, dt_min = None, dt_max = None):
         """
         Instructs the psu to perform the CC_charging step
         :param dt: time increment where the measurements should be taken
@@ -175,84 +297,44 @@ class PSU:
         :param measuring_instr: Determines whether the measuring instrument is the psu or another instrument.
         Acceptable arguments are 'same' or other instrument's id.
         :param return_output: If or not to return the charging cycle information
+        :param sinks: objects with an append(row) method (e.g. ColumnBuffer) that receive each sample as a row
+        :param cycle_no: cycle number written in the rows passed to the sinks
+        :param t_offset: time offset added to the times written in the rows passed to the sinks
+        :param dt_min: if given, the sampling is adaptive: the interval shrinks from dt_max down to dt_min as the
+        voltage approaches V_upper, and a row interpolated at the crossing of V_upper is added before the last one
+        :param dt_max: longest interval of the adaptive sampling. Defaults to dt.
         :return: pandas DataFrame containing current, voltage, power, status, and capacities
         """
-
-        # Set channel's charging current and upper battery terminal voltage
-        #-------------------------------------------------------------------------------
-        self.set_psu_VI(V_upper=V_upper, I_charge=I_charge)
-
-        #initialize list containing measuring quantities and an empty pandas DataFrame
-        #-------------------------------------------------------------------------------
-        if return_output:
-            t_list, I_list, V_list, status_list = [],[],[],[]
-            cap_charge_list = []
-            cap_discharge_list = []
-
+        measur_instr = None
         if measuring_instr != 'same':
-            measur_instr = E_load(measuring_instr) # create an instance of the measuring instrument's class
-
-        #turn on the power supply and wait for the initial delay time
-        #-------------------------------------------------------------------------------
-        self.turn_psu_on() # turn on psu
-        time.sleep(self.init_delay) #init delay otherwise there would be some issues reading values from Siglent
-        t_start = time.time()  # start timer
-
-        # Start charging until upper terminal voltage criteria is met
-        #------------------------------------------------------------------------------
-        V_psu = self.measureV() # create a current voltage variable
-        tol = 0.003 # add a voltage tolerance for the stopping criteria in the while loop below.
-        cap_charge = 0 # initialize the charge capacity
-        counter = 0
-        t_prev = 0 # intialize a variable that contains the previous time step's time needed for cap measurements
-        while V_psu < (V_upper - tol):
-            t = time.time() - t_start  # variable that holds the current time in seconds
-            if measuring_instr == 'same':
-                V = V_psu = self.measureV()
-            else:
-                V_psu = self.measureV()
-                V = measur_instr.measureV()
-            I = self.measureI() # Measure current
-            # status
-            status = self.readStatus()
-            status = self.hex_to_bin(status)  # convert hexadecimal number to binary
-            status = self.CC_or_CV(status)  # Determine if CC or CV mode
-            status = f'{status}_charge'
-            #measure capacity
-            cap_charge += (t - t_prev) * I / 3600
-            cap_discharge = 0
-
-            if return_output:
-                #update lists
-                t_list.append(t)
-                V_list.append(V)
-                I_list.append(I)
-                status_list.append(status)
-                cap_charge_list.append(cap_charge)
-                cap_discharge_list.append(cap_discharge)
-
-
-            # Wait for the next time increment
-            time.sleep(dt - 12 * self.delay)
-
-            #Update relevant variables for next iteration
-            t_prev = t  # Update the previous time
-            counter += 1  # Update counter
-
-            # Print on the console
-            print(t, I, V, status, cap_charge, cap_discharge)
-
-        # Turn off the power supply
-        self.turn_psu_off()
+            measur_instr = E_load(measuring_instr, pool= self.pool, stop_event= self.stop_event,
+                                  telemetry= self.telemetry) # create an instance of the measuring instrument's class
+        sense = 'psu' if measur_instr is None else 'load'
+        recipe = Recipe('charge_CC', [CC(I_charge, V_upper, direction= 'charge', sense= sense, dt_min= dt_min,
+                                         dt_max= dt_max, interpolate= dt_min is not None)])
+        df = Executor(psu= self, load= measur_instr, dt= dt).run(recipe, sinks, return_output, fields= CC_FIELDS,
+                                                                 cycle_no= cycle_no, t_offset= t_offset)
+
+        # Create a pandas DataFrame, with the capacities integrated from the raw data
+        if return_output:
+            return add_capacity_columns(df)
 
-        # Create a pandas DataFrame
+    def profile_charge(self, dt, steps, I_cut = None, return_output = True, sinks = (), cycle_no = 1, t_offset = 0):
+        """
+        Charges with a profile run by the psu's timer: the (voltage, current, duration) groups are uploaded
+        TIMER_GROUPS at a time and the psu switches between them itself. The host only starts the sequences and
+        samples every dt seconds, so the step timing does not depend on the host's load.
+        :param dt: time increment where the measurements should be taken
+        :param steps: list of (voltage, current, duration) groups, duration in seconds
+        :param I_cut: optional cut-off current ending the charge early
+        :param return_output: If or not to return the charging information
+        :param sinks: objects with an append(row) method (e.g. ColumnBuffer) that receive each sample as a row
+        :param cycle_no: cycle number written in the rows passed to the sinks
+        :param t_offset: time offset added to the times written in the rows passed to the sinks
+        :return: pandas DataFrame containing current, voltage, power, status, and capacities
+        """
+        recipe = Recipe('charge_profile', [Profile(steps, I_cut)])
+        df = Executor(psu= self, dt= dt).run(recipe, sinks, return_output, fields= CC_FIELDS, cycle_no= cycle_no,
+                                             t_offset= t_offset)
         if return_output:
-            df = pd.DataFrame({
-                't': t_list,
-                'I': I_list,
-                'V': V_list,
-                'status': status_list,
-                'cap_charge': cap_charge_list,
-                'cap_discharge': cap_discharge_list
-            })
-            return df
+            return add_capacity_columns(df)
@@ -0,0 +1,126 @@
+import math
+import numpy as np
+import pandas as pd
+from buffer import PULSE_FIELDS
+from capacity import integral, segment_starts
+from recipe import Executor, Loop, Pulse, Recipe, Rest
+
+
+class PulseDischarge:
+    """
+    ------------------------------
+    Pulse (HPPC-style) discharge protocol on the electronic load.
+    ------------------------------
+    Steps:
+    1. Rest for t_rest_init (pulse_no 0)
+    2. Discharge at I_pulse for t_pulse (step 'pulse')
+    3. Rest for t_rest (step 'rest')
+    4. Repeat steps 2-3 until the voltage falls below V_lower during a pulse, or for n_pulses pulses.
+       The rest after the last pulse is always recorded.
+    ------------------------------
+    Each step is sampled on a dense-then-sparse schedule: every dense_dt seconds during the first
+    dense_duration seconds of the step (the pulse edge or the start of the relaxation), then every sparse_dt
+    seconds. The transients are resolved without recording the long rests at the dense rate.
+    The dense samples are taken as fast as the load answers; the ones it cannot keep up with are skipped.
+    The protocol is a recipe (see recipe()) run by recipe.Executor.
+    ------------------------------
+    Usage:
+    protocol = PulseDischarge(E_load(load_id), I_pulse= 0.5, t_pulse= 15*60, t_rest= 20*60, V_lower= 2.0,
+                              t_rest_init= 5*60)
+    df = protocol.run()
+    summary = pulse_summary(df)
+    """
+    def __init__(self, load, I_pulse, t_pulse, t_rest, V_lower, t_rest_init = 0, n_pulses = None,
+                 dense_dt = 0.01, dense_duration = 1.0, sparse_dt = 10.0):
+        """
+        Constructor of the pulse protocol.
+        :param load: E_load
+        :param I_pulse: discharge current of the pulses in A
+        :param t_pulse: duration of each pulse in seconds
+        :param t_rest: rest after each pulse in seconds
+        :param V_lower: battery's lower terminal voltage, ending the protocol
+        :param t_rest_init: initial rest in seconds
+        :param n_pulses: maximum number of pulses. No maximum if None.
+        :param dense_dt: interval of the dense samples in seconds
+        :param dense_duration: duration of the dense sampling at the start of each step in seconds
+        :param sparse_dt: interval of the sparse samples in seconds
+        """
+        self.load = load
+        self.I_pulse = I_pulse
+        self.t_pulse = t_pulse
+        self.t_rest = t_rest
+        self.V_lower = V_lower
+        self.t_rest_init = t_rest_init
+        self.n_pulses = math.inf if n_pulses is None else n_pulses
+        self.dense_dt = dense_dt
+        self.dense_duration = dense_duration
+        self.sparse_dt = sparse_dt
+        self.scheduler = None # OffsetScheduler of the last step, holds its timing statistics
+
+    def recipe(self):
+        """
+        :return: Recipe of the protocol (see recipe.py). Its cycles are the pulses.
+        """
+        sampling = {'dt': self.sparse_dt, 'dense_dt': self.dense_dt, 'dense_duration': self.dense_duration}
+        steps = []
+        if self.t_rest_init > 0:
+            steps.append(Rest(self.t_rest_init, 'rest', measure_current= True, **sampling))
+        steps.append(Loop(self.n_pulses, [Pulse(self.I_pulse, self.t_pulse, self.t_rest, V_limit= self.V_lower,
+                                                **sampling)], stop_on_limit= True))
+        return Recipe('pulse_discharge', steps)
+
+    def run(self, sinks = (), return_output = True):
+        """
+        Runs the protocol.
+        :param sinks: objects with an append(row) method (e.g. a StreamWriter with PULSE_FIELDS) that receive each
+        sample as a row. The samples are also published to the load's telemetry bus.
+        :param return_output: if True, the rows are also buffered in memory and returned
+        :return: pandas DataFrame with the pulse_no, step, t, V and I of the samples
+        """
+        executor = Executor(load= self.load, cycle_field= 'pulse_no', status_field= 'step', cycle_time= False)
+        try:
+            return executor.run(self.recipe(), sinks, return_output, fields= PULSE_FIELDS,
+                                cycle_no= 0 if self.t_rest_init > 0 else 1)
+        finally:
+            self.scheduler = executor.scheduler
+
+
+def pulse_summary(df):
+    """
+    Summary of each pulse of a pulse protocol's output.
+    * V_rest: voltage at the end of the rest before the pulse
+    * V_start, V_end: voltages at the first and the last sample of the pulse
+    * R0: instantaneous resistance (V_rest - V_start) / I
+    * R_pulse: resistance at the end of the pulse (V_rest - V_end) / I
+    * V_relaxed: voltage at the end of the rest after the pulse
+    * Q: discharged capacity of the pulse
+    :param df: pandas DataFrame returned by PulseDischarge.run
+    :return: pandas DataFrame with one row per pulse
+    """
+    pulse_no = df['pulse_no'].to_numpy()
+    step = df['step'].astype(str).to_numpy()
+    t = df['t'].to_numpy(dtype= float)
+    V = df['V'].to_numpy(dtype= float)
+    I = df['I'].to_numpy(dtype= float)
+    starts = segment_starts(pulse_no, step)
+    ends = np.append(starts[1:], len(df)) - 1
+    Q = integral(t, I, starts) / 3600
+    pulses = np.flatnonzero(step[starts] == 'pulse')
+    # the pulses are preceded by a rest step, except the first one if there is no initial rest
+    has_rest = pulses > 0
+    before = np.where(has_rest, ends[np.maximum(pulses - 1, 0)], starts[pulses])
+    after = np.minimum(pulses + 1, len(starts) - 1)
+    I_pulse = np.add.reduceat(I, starts)[pulses] / (ends - starts + 1)[pulses]
+    with np.errstate(divide= 'ignore', invalid= 'ignore'):
+        return pd.DataFrame({
+            'pulse_no': pulse_no[starts[pulses]],
+            't_start [s]': t[starts[pulses]],
+            'I [A]': I_pulse,
+            'V_rest [V]': np.where(has_rest, V[before], np.nan),
+            'V_start [V]': V[starts[pulses]],
+            'V_end [V]': V[ends[pulses]],
+            'R0 [Ohm]': np.where(has_rest, (V[before] - V[starts[pulses]]) / I_pulse, np.nan),
+            'R_pulse [Ohm]': np.where(has_rest, (V[before] - V[ends[pulses]]) / I_pulse, np.nan),
+            'V_relaxed [V]': V[ends[after]],
+            'Q [Ahr]': Q[pulses],
+        })
@@ -1,4 +1,8 @@
 from cycling import Cycling
+from e_load import E_load
+from pulse import PulseDischarge, pulse_summary
+from buffer import PULSE_FIELDS
+from stream_writer import CSVStreamWriter
 
 
 #Input parameters
@@ -14,6 +18,10 @@ t_wait_init= 5 #intial wait in seconds
 cycles = 1
 filename_charge = "20211203_ECM_OCV_charge"
 filename_discharge = "20211203_ECM_OCV_discharge"
+filename_pulse = "20211203_pulse_discharge"
+t_rest_init = 5*60 # rest before the first pulse
+t_pulse = 15*60 # CC discharge period of each pulse
+t_rest = 20*60 # rest after each pulse
 
 psu_id = 'USB0::0xF4EC::0x1410::SPD13DCQ4R0571::INSTR'
 load_id = 'USB0::0x1AB1::0x0E11::DL3A222600541::INSTR'
@@ -43,5 +51,16 @@ Step 2: Pulse charging
 1. Let cell rest for 5 minutes
 2. Let the cell discharge at constant currrent for 15 miuntes
 3. Let cell rest for 20 minutes
-** potential and current are measured at each steps at suitable intervals
-"""
\ No newline at end of file
+4. Repeat steps 2-3 until the lower terminal voltage is reached
+** potential and current are measured every 10 ms during the first second of each step, then every 10 s
+"""
+rigol = E_load(load_id)
+protocol = PulseDischarge(load= rigol,
+                          I_pulse= I_dis,
+                          t_pulse= t_pulse,
+                          t_rest= t_rest,
+                          V_lower= V_cut,
+                          t_rest_init= t_rest_init)
+with CSVStreamWriter(f'data/{filename_pulse}.csv', fields= PULSE_FIELDS) as writer:
+    df_pulse = protocol.run(sinks= (writer,))
+pulse_summary(df_pulse).to_csv(f'data/{filename_pulse}_summary.csv', index= False)
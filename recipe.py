@@ -0,0 +1,642 @@
+"""
+Declarative cycling protocols (recipes) and their executor.
+-----------------------------------------------------------------------------------------------
+A Recipe is a list of steps:
+* Rest: no current, the voltage is sampled for a duration.
+* CC: constant current until a voltage limit, a duration or other conditions.
+* CV: constant voltage until the current falls below a cut-off.
+* CCCV: CC then CV. The psu does both in one step while charging, the load runs a CC then a CV step.
+* Pulse: a CC pulse of a given duration followed by a rest.
+* Profile: a charge profile of (voltage, current, duration) groups sequenced by the psu's timer.
+* Loop: repeats its steps count times, each repetition being a new cycle.
+Charging steps run on the psu and discharging steps on the electronic load. Each step has its termination
+conditions (until, e.g. [V_below(2.0)], and t_max) and its sampling rule: every dt seconds, dense_dt
+seconds during the first dense_duration seconds of the step and dt seconds afterwards, or adaptively between
+dt_min and dt_max seconds, faster as the samples approach the thresholds of the conditions. When a step ends on
+a condition, the crossing of its threshold is interpolated between the last two samples (Executor.crossings).
+The interpolated rows passed to the sinks are marked by their status (see crossing_status).
+The Executor runs all the recipes with one sampling loop (Executor._run_step). The rows passed to the sinks
+hold the cycle number, the status, and the t, V, I and W of the samples.
+-----------------------------------------------------------------------------------------------
+Usage:
+recipe = Recipe('cycle', [Loop(2, [CCCV(1.5, 3.65, 0.1, direction= 'charge'), Rest(300, 'wait_between'),
+                                   CCCV(1.5, 2.0, 0.1), Rest(300, 'wait_end')])])
+df = Executor(psu= PSU(psu_id), load= E_load(load_id), dt= 10).run(recipe)
+"""
+import itertools
+import math
+import operator
+import numpy as np
+import clock
+from buffer import ColumnBuffer, CYCLING_FIELDS
+from records import emit
+from scheduler import AdaptiveScheduler, DeadlineScheduler, OffsetScheduler, dense_sparse_offsets
+
+V_TOLERANCE = 0.003 # the CC charge ends this close to its voltage limit
+APPROACH_FRACTION = 0.5 # adaptive sampling: the next interval is this fraction of the predicted time to a threshold
+TIMER_GROUPS = 5 # number of groups of the psu's timer sequence (see PSU.set_timer)
+DIRECTIONS = ('charge', 'discharge')
+OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+# Fields of the rows of a recipe, the cycling fields with the power
+RECIPE_FIELDS = {**CYCLING_FIELDS, 'W': np.float64}
+
+
+class Condition:
+    """
+    Termination condition of a step on the voltage or the current of a sample, e.g. Condition('V', '<', 2.0).
+    """
+    def __init__(self, field, op, value):
+        """
+        :param field: 'V' or 'I'
+        :param op: '<', '<=', '>' or '>='
+        :param value: threshold
+        """
+        if field not in ('V', 'I'):
+            raise ValueError(f"The condition's field should be 'V' or 'I', got {field!r}")
+        self.field = field
+        self.op = op
+        self.compare = OPERATORS[op]
+        self.value = value
+
+    def __repr__(self):
+        return f'Condition({self.field!r}, {self.op!r}, {self.value})'
+
+
+def V_below(value):
+    return Condition('V', '<', value)
+
+
+def V_above(value):
+    return Condition('V', '>=', value)
+
+
+def I_below(value):
+    return Condition('I', '<', value)
+
+
+def I_above(value):
+    return Condition('I', '>=', value)
+
+
+def _check_direction(direction):
+    if direction not in DIRECTIONS:
+        raise ValueError(f'direction should be one of {DIRECTIONS}, got {direction!r}')
+
+
+class Step:
+    """
+    Base class of the steps. A step configures its instrument in start(), which returns the function taking a
+    sample, and turns it off in stop(). stop() is also called if start() fails. The sample function returns
+    (V, I, W, status, V_step): the values of the row, and the voltage of the step's instrument on which the
+    conditions are checked.
+    """
+    instrument = None # 'psu', 'load', or None for the measuring instrument (the load if any, else the psu)
+
+    def __init__(self, name = None, t_max = None, until = (), dt = None, dense_dt = None, dense_duration = 0.0,
+                 sinks = (), dt_min = None, dt_max = None, interpolate = False):
+        """
+        :param name: status written in the rows. Defaults to the instrument's operation mode for the psu steps.
+        :param t_max: maximum duration of the step in seconds, or None
+        :param until: Conditions ending the step when one of them is met by a sample
+        :param dt: sampling interval in seconds. Defaults to the executor's dt.
+        :param dense_dt: interval of the dense samples at the start of the step in seconds (requires t_max)
+        :param dense_duration: duration of the dense sampling in seconds
+        :param sinks: sinks receiving only the rows of this step, in addition to the executor's sinks
+        :param dt_min: if given, the step is sampled adaptively: the interval shrinks down to dt_min as the
+        samples approach the thresholds of the conditions, and grows up to dt_max where they do not move
+        :param dt_max: longest interval of the adaptive sampling in seconds. Defaults to dt.
+        :param interpolate: if True, a row interpolated at the crossing of the threshold is passed to the sinks
+        before the sample ending the step on a condition, with the status of crossing_status
+        """
+        if dense_dt is not None and t_max is None:
+            raise ValueError('The dense sampling requires the duration of the step (t_max)')
+        if dense_dt is not None and dt_min is not None:
+            raise ValueError('A step is sampled either densely (dense_dt) or adaptively (dt_min)')
+        self.name = name
+        self.t_max = t_max
+        self.until = list(until)
+        self.dt = dt
+        self.dense_dt = dense_dt
+        self.dense_duration = dense_duration
+        self.sinks = tuple(sinks)
+        self.dt_min = dt_min
+        self.dt_max = dt_max
+        self.interpolate = interpolate
+
+    def expand(self):
+        """
+        :return: the steps run by the executor for this step
+        """
+        return [self]
+
+    def instruments(self):
+        return {self.instrument} - {None}
+
+    def scheduler(self, dt, stop_event):
+        dt = self.dt or dt
+        if self.dense_dt is not None:
+            offsets = dense_sparse_offsets(self.t_max, self.dense_dt, self.dense_duration, dt)
+            return OffsetScheduler(offsets, self.t_max, max_missed= math.inf, stop_event= stop_event)
+        if self.dt_min is not None:
+            return AdaptiveScheduler(self.dt_min, self.dt_max or dt, stop_event= stop_event)
+        return DeadlineScheduler(dt, stop_event= stop_event)
+
+    def start(self, executor):
+        raise NotImplementedError
+
+    def stop(self, executor):
+        pass
+
+    def _kwargs(self):
+        return {'t_max': self.t_max, 'dt': self.dt, 'dense_dt': self.dense_dt,
+                'dense_duration': self.dense_duration, 'sinks': self.sinks, 'dt_min': self.dt_min,
+                'dt_max': self.dt_max, 'interpolate': self.interpolate}
+
+
+class Rest(Step):
+    """
+    Rest with the outputs off. The current is written as 0 unless measure_current is True.
+    """
+    def __init__(self, duration, name = 'rest', measure_current = False, **kwargs):
+        """
+        :param duration: duration in seconds
+        :param name: status written in the rows
+        :param measure_current: if True, the current is measured (one compound query on the load)
+        """
+        super().__init__(name, t_max= duration, **kwargs)
+        self.measure_current = measure_current
+
+    def start(self, executor):
+        instrument = executor.measuring_instrument(self)
+        name = self.name
+        if self.measure_current:
+            def sample():
+                V, I, W, _ = instrument.sample()
+                return V, I, W, name, V
+        else:
+            def sample():
+                V = instrument.measureV()
+                return V, 0, 0.0, name, V
+        return sample
+
+
+class CC(Step):
+    """
+    Constant current step, on the psu while charging and on the load while discharging.
+    """
+    def __init__(self, current, V_limit = None, direction = 'discharge', name = None, sense = 'psu', **kwargs):
+        """
+        :param current: current in A (positive)
+        :param V_limit: voltage limit ending the step (lower limit while discharging, upper limit and psu voltage
+        setting while charging). None for no limit while discharging (e.g. a pulse of a given duration).
+        :param direction: 'charge' or 'discharge'
+        :param name: status. Defaults to 'CC_discharge' while discharging and to the psu mode while charging.
+        :param sense: instrument measuring the voltage while charging, 'psu' or 'load'
+        """
+        _check_direction(direction)
+        if direction == 'charge' and V_limit is None:
+            raise ValueError('A charging step requires the voltage limit of the psu')
+        kwargs.setdefault('until', [])
+        if V_limit is not None:
+            kwargs['until'] = [*kwargs['until'], V_below(V_limit) if direction == 'discharge'
+                               else V_above(V_limit - V_TOLERANCE)]
+        super().__init__(name, **kwargs)
+        self.current = current
+        self.V_limit = V_limit
+        self.direction = direction
+        self.sense = sense
+        self.instrument = 'load' if direction == 'discharge' else 'psu'
+
+    def instruments(self):
+        return {self.instrument, 'load'} if self.sense == 'load' else {self.instrument}
+
+    def start(self, executor):
+        if self.direction == 'discharge':
+            load = executor.load
+            load.set_CC(self.current)
+            load.turn_on_load()
+            return _load_sampler(load, self.name or 'CC_discharge')
+        psu = executor.psu
+        psu.set_psu_VI(self.V_limit, self.current)
+        psu.turn_psu_on()
+        psu.wait_output_on()
+        return _psu_sampler(psu, executor.load if self.sense == 'load' else None, self.name)
+
+    def stop(self, executor):
+        _turn_off(executor, self.direction)
+
+
+class CV(Step):
+    """
+    Constant voltage step, until the current falls below I_cut.
+    """
+    def __init__(self, voltage, I_cut, direction = 'discharge', I_limit = None, name = None, **kwargs):
+        """
+        :param voltage: voltage in V
+        :param I_cut: cut-off current in A
+        :param direction: 'charge' or 'discharge'
+        :param I_limit: current limit of the psu while charging
+        :param name: status. Defaults to 'CV_discharge' while discharging and to the psu mode while charging.
+        """
+        _check_direction(direction)
+        if direction == 'charge' and I_limit is None:
+            raise ValueError('A charging CV step requires the current limit of the psu (I_limit)')
+        kwargs['until'] = [*kwargs.get('until', []), I_below(I_cut)]
+        super().__init__(name, **kwargs)
+        self.voltage = voltage
+        self.I_cut = I_cut
+        self.direction = direction
+        self.I_limit = I_limit
+        self.instrument = 'load' if direction == 'discharge' else 'psu'
+
+    def start(self, executor):
+        if self.direction == 'discharge':
+            load = executor.load
+            load.set_CV(self.voltage)
+            load.turn_on_load()
+            return _load_sampler(load, self.name or 'CV_discharge')
+        psu = executor.psu
+        psu.set_psu_VI(self.voltage, self.I_limit)
+        psu.turn_psu_on()
+        psu.wait_output_on()
+        return _psu_sampler(psu, None, self.name)
+
+    def stop(self, executor):
+        _turn_off(executor, self.direction)
+
+
+class CCCV(Step):
+    """
+    CC step followed by a CV step at the voltage limit, until the current falls below I_cut.
+    While charging, the psu switches from CC to CV by itself and the status follows its mode.
+    """
+    def __init__(self, current, voltage, I_cut, direction = 'discharge', **kwargs):
+        """
+        :param current: current of the CC step in A
+        :param voltage: voltage limit of the CC step and voltage of the CV step
+        :param I_cut: cut-off current of the CV step in A
+        :param direction: 'charge' or 'discharge'
+        """
+        _check_direction(direction)
+        kwargs['until'] = [*kwargs.get('until', []), I_below(I_cut)]
+        super().__init__(kwargs.pop('name', None), **kwargs)
+        self.current = current
+        self.voltage = voltage
+        self.I_cut = I_cut
+        self.direction = direction
+        self.instrument = 'load' if direction == 'discharge' else 'psu'
+
+    def expand(self):
+        if self.direction == 'charge':
+            return [self]
+        kwargs = self._kwargs()
+        return [CC(self.current, self.voltage, 'discharge', **kwargs),
+                CV(self.voltage, self.I_cut, 'discharge', **kwargs)]
+
+    def start(self, executor):
+        psu = executor.psu
+        psu.set_psu_VI(self.voltage, self.current)
+        psu.turn_psu_on()
+        psu.wait_output_on()
+        return _psu_sampler(psu, None, self.name)
+
+    def stop(self, executor):
+        _turn_off(executor, self.direction)
+
+
+class Pulse(Step):
+    """
+    CC pulse of t_pulse seconds followed by a rest of t_rest seconds.
+    """
+    def __init__(self, current, t_pulse, t_rest, V_limit = None, direction = 'discharge', name = 'pulse',
+                 rest_name = 'rest', **kwargs):
+        """
+        :param current: current of the pulse in A
+        :param t_pulse: duration of the pulse in seconds
+        :param t_rest: duration of the rest in seconds
+        :param V_limit: voltage limit ending the pulse early (see CC)
+        :param direction: 'charge' or 'discharge'
+        :param name: status of the pulse
+        :param rest_name: status of the rest
+        :param kwargs: sampling rules of the pulse and the rest (dt, dense_dt, dense_duration, sinks)
+        """
+        _check_direction(direction)
+        super().__init__(name, t_max= t_pulse, **kwargs)
+        self.current = current
+        self.t_pulse = t_pulse
+        self.t_rest = t_rest
+        self.V_limit = V_limit
+        self.direction = direction
+        self.rest_name = rest_name
+        self.instrument = 'load' if direction == 'discharge' else 'psu'
+
+    def expand(self):
+        kwargs = {key: value for key, value in self._kwargs().items() if key != 't_max'}
+        return [CC(self.current, self.V_limit, self.direction, self.name, t_max= self.t_pulse, **kwargs),
+                Rest(self.t_rest, self.rest_name, measure_current= True, **kwargs)]
+
+
+class Profile(Step):
+    """
+    Charge profile run by the psu's timer. The groups are uploaded TIMER_GROUPS at a time (one step per upload)
+    and the psu switches between them by itself: the host only starts the sequence and samples it.
+    """
+    instrument = 'psu'
+
+    def __init__(self, steps, I_cut = None, name = None, **kwargs):
+        """
+        :param steps: list of (voltage, current, duration) groups, duration in seconds
+        :param I_cut: optional cut-off current ending the profile early
+        :param name: status. Defaults to the psu mode.
+        """
+        if not steps:
+            raise ValueError('A profile requires at least one group')
+        if I_cut is not None:
+            kwargs['until'] = [*kwargs.get('until', []), I_below(I_cut)]
+        super().__init__(name, t_max= sum(duration for _, _, duration in steps), **kwargs)
+        self.steps = [tuple(step) for step in steps]
+        self.I_cut = I_cut
+
+    def expand(self):
+        if len(self.steps) <= TIMER_GROUPS:
+            return [self]
+        kwargs = {key: value for key, value in self._kwargs().items() if key != 't_max'}
+        return [Profile(self.steps[k:k + TIMER_GROUPS], name= self.name, until= self.until, **kwargs)
+                for k in range(0, len(self.steps), TIMER_GROUPS)]
+
+    def start(self, executor):
+        psu = executor.psu
+        psu.set_timer(self.steps)
+        psu.start_timer()
+        psu.wait_output_on()
+        return _psu_sampler(psu, None, self.name)
+
+    def stop(self, executor):
+        executor.psu.stop_timer()
+
+
+class Loop:
+    """
+    Repeats its steps count times. Each repetition is a new cycle (the cycle number is incremented, unless no
+    sample was taken yet in the current cycle).
+    """
+    def __init__(self, count, steps, stop_on_limit = False):
+        """
+        :param count: number of repetitions, math.inf to repeat until a limit is reached
+        :param steps: steps (or nested loops) of a repetition
+        :param stop_on_limit: if True, the loop ends after a repetition in which a step ended on one of its
+        conditions (e.g. the voltage limit of a pulse) instead of its duration
+        """
+        self.count = count
+        self.steps = list(steps)
+        self.stop_on_limit = stop_on_limit
+
+    def instruments(self):
+        return set().union(*(step.instruments() for step in self.steps))
+
+
+class Recipe:
+    """
+    Named list of steps and loops.
+    """
+    def __init__(self, name, steps):
+        self.name = name
+        self.steps = list(steps)
+
+    def instruments(self):
+        """
+        :return: set of the instruments required by the steps, among 'psu' and 'load'
+        """
+        return set().union(*(step.instruments() for step in self.steps)) or {'load'}
+
+
+def crossing_status(status):
+    """
+    :return: status of the row interpolated at a crossing, e.g. 'CC_crossing_charge' for 'CC_charge' (the
+    charging rows keep their '_charge' suffix) or 'wait_crossing' for 'wait'
+    """
+    head, _, direction = status.rpartition('_')
+    return f'{head}_crossing_{direction}' if head and direction in DIRECTIONS else f'{status}_crossing'
+
+
+def _load_sampler(load, name):
+    def sample():
+        V, I, W, _ = load.sample()
+        return V, I, W, name, V
+    return sample
+
+
+def _psu_sampler(psu, sense, name):
+    """
+    With a sense instrument, the rows record its voltage while the conditions are checked on the psu's voltage:
+    the voltage at the load is below the psu's by the drop in the leads, and may never reach the psu's limit.
+    """
+    def sample():
+        V_psu, I, W, mode = psu.sample()
+        V = V_psu if sense is None else sense.measureV()
+        return V, I, W, name or f'{mode}_charge', V_psu
+    return sample
+
+
+def _turn_off(executor, direction):
+    if direction == 'discharge':
+        executor.load.turn_off_load()
+    else:
+        executor.psu.turn_psu_off()
+
+
+class Executor:
+    """
+    ------------------------------
+    Runs the recipes on a psu and an electronic load.
+    ------------------------------
+    Every step is sampled by the same loop: take a sample, pass the row to the sinks, end the step if one of
+    its conditions is met, otherwise wait for the next deadline of the step's schedule and end the step when
+    its duration is over. A step ending on a condition stops at once, without waiting for the next deadline.
+    The outputs are turned off when a step ends, also on errors and stop requests.
+    ------------------------------
+    Usage:
+    executor = Executor(load= E_load(load_id), dt= 1.0)
+    df = executor.run(Recipe('discharge_CC', [CC(1.5, 2.0)]))
+    """
+    def __init__(self, psu = None, load = None, dt = 1.0, stop_event = None, cycle_field = 'cycle_no',
+                 status_field = 'status', cycle_time = True):
+        """
+        Constructor of the executor.
+        :param psu: PSU running the charging steps, or None
+        :param load: E_load running the discharging steps and measuring the rests, or None
+        :param dt: default sampling interval of the steps in seconds
+        :param stop_event: optional threading.Event. Defaults to the stop event of the instruments.
+        :param cycle_field: name of the cycle number in the rows (e.g. 'pulse_no')
+        :param status_field: name of the status in the rows (e.g. 'step')
+        :param cycle_time: if True, the time of the rows restarts from 0 at each cycle. Otherwise it runs from the
+        start of the recipe.
+        """
+        self.psu = psu
+        self.load = load
+        self.dt = dt
+        if stop_event is None:
+            stop_event = next((instrument.stop_event for instrument in (psu, load)
+                               if instrument is not None and instrument.stop_event is not None), None)
+        self.stop_event = stop_event
+        self.cycle_field = cycle_field
+        self.status_field = status_field
+        self.cycle_time = cycle_time
+        self.scheduler = None # scheduler of the last step, holds its timing statistics
+        self.crossings = [] # rows interpolated at the thresholds of the steps ended on a condition, see run()
+        self.cycle_no = 1
+        self._samples_in_cycle = 0
+        self._t_origin = 0.0
+        self._t_offset = 0.0
+
+    def measuring_instrument(self, step):
+        return self.load if self.load is not None else self.psu
+
+    def _instrument(self, step):
+        if step.instrument == 'psu':
+            return self.psu
+        if step.instrument == 'load':
+            return self.load
+        return self.measuring_instrument(step)
+
+    def run(self, recipe, sinks = (), return_output = True, fields = RECIPE_FIELDS, cycle_no = 1, t_offset = 0):
+        """
+        Runs a recipe.
+        :param recipe: Recipe
+        :param sinks: objects with an append(row) method (e.g. a StreamWriter) that receive each sample as a row
+        :param return_output: if True, the rows are also buffered in memory and returned
+        :param fields: fields of the returned DataFrame (see buffer.py)
+        :param cycle_no: number of the first cycle
+        :param t_offset: time offset added to the times written in the rows
+        :return: pandas DataFrame of the rows, without the capacities (see capacity.add_capacity_columns). The
+        crossings of the thresholds are kept in the crossings attribute, the rows of the times at which the steps
+        ending on a condition reached its threshold, linearly interpolated, with the field and the threshold.
+        """
+        missing = [name for name in recipe.instruments() if getattr(self, name) is None]
+        if missing:
+            raise ValueError(f'The recipe {recipe.name!r} requires the instruments {missing}')
+        if return_output:
+            buffer = ColumnBuffer(fields)
+            sinks = (*sinks, buffer)
+        self.cycle_no = cycle_no
+        self.crossings = []
+        self._samples_in_cycle = 0
+        self._t_origin = clock.monotonic()
+        self._t_offset = t_offset
+        self._run_steps(recipe.steps, tuple(sinks))
+        if return_output:
+            return buffer.to_dataframe()
+
+    def _new_cycle(self):
+        if self._samples_in_cycle:
+            self.cycle_no += 1
+            self._samples_in_cycle = 0
+            if self.cycle_time:
+                self._t_origin = clock.monotonic()
+                self._t_offset = 0
+
+    def _run_steps(self, steps, sinks):
+        """
+        :return: True if a step ended on one of its conditions
+        """
+        limit = False
+        for item in steps:
+            if isinstance(item, Loop):
+                repetitions = itertools.count() if item.count == math.inf else range(item.count)
+                for _ in repetitions:
+                    self._new_cycle()
+                    repetition_limit = self._run_steps(item.steps, sinks)
+                    limit |= repetition_limit
+                    if repetition_limit and item.stop_on_limit:
+                        break
+            else:
+                for step in item.expand():
+                    limit |= self._run_step(step, sinks)
+        return limit
+
+    def _run_step(self, step, sinks):
+        """
+        Samples one step. This is the sampling loop of all the recipes.
+        :return: True if the step ended on one of its conditions
+        """
+        instrument = self._instrument(step)
+        sinks = (*sinks, *step.sinks, instrument.telemetry.channel(instrument.id))
+        limits = [(condition.field == 'V', condition.compare, condition.value) for condition in step.until]
+        cycle_field, status_field = self.cycle_field, self.status_field
+        try:
+            sample = step.start(self) # inside the try: the output is turned off if the start fails
+            scheduler = self.scheduler = instrument.scheduler = step.scheduler(self.dt, self.stop_event)
+            scheduler.start()
+            t_max = math.inf if step.t_max is None else step.t_max
+            dense = isinstance(scheduler, OffsetScheduler)
+            adaptive = isinstance(scheduler, AdaptiveScheduler)
+            previous = None # (row, measured) of the previous sample
+            while True:
+                now = clock.monotonic()
+                t_step = now - scheduler.t_start
+                V, I, W, status, V_step = sample()
+                row = {cycle_field: self.cycle_no, status_field: status, 't': self._t_offset + now - self._t_origin,
+                       'V': V, 'I': I, 'W': W}
+                measured = (row['t'], V_step, I) # values checked against the conditions
+                for is_V, compare, value in limits:
+                    if compare(V_step if is_V else I, value):
+                        self._end_on_condition(step, sinks, previous, row, measured, is_V, value)
+                        return True
+                emit(sinks, row)
+                self._samples_in_cycle += 1
+                if not dense and t_step >= t_max:
+                    return False
+                if adaptive:
+                    scheduler.set_interval(_approach_time(limits, previous and previous[1], measured)
+                                           * APPROACH_FRACTION)
+                previous = (row, measured)
+                scheduler.wait()
+                if dense and scheduler.finished():
+                    return False
+        finally:
+            step.stop(self)
+
+    def _end_on_condition(self, step, sinks, previous, row, measured, is_V, value):
+        """
+        Records the crossing of the threshold interpolated between the previous sample and the sample meeting the
+        condition, passes it to the sinks if the step interpolates, and then the sample.
+        """
+        if previous is not None:
+            previous_row, previous_measured = previous
+            field = 'V' if is_V else 'I'
+            x_previous, x = previous_measured[1 if is_V else 2], measured[1 if is_V else 2]
+            fraction = min(max((value - x_previous) / (x - x_previous), 0.0), 1.0) if x != x_previous else 1.0
+            crossing = {**row, 'status': crossing_status(row['status']),
+                        **{key: previous_row[key] + fraction * (row[key] - previous_row[key])
+                           for key in ('t', 'V', 'I', 'W')}}
+            self.crossings.append({**crossing, 'field': field, 'threshold': value})
+            if step.interpolate:
+                emit(sinks, crossing)
+                self._samples_in_cycle += 1
+        emit(sinks, row)
+        self._samples_in_cycle += 1
+
+
+def _approach_time(limits, previous, measured):
+    """
+    :param previous: (t, V_step, I) of the previous sample, or None
+    :param measured: (t, V_step, I) of the last sample
+    :return: time in seconds until the first threshold of the conditions is reached at the rate of change
+    between the previous sample and the last one, inf if no threshold is approached or without a previous
+    sample (the first interval stays at dt_max)
+    """
+    if previous is None:
+        return math.inf
+    h = measured[0] - previous[0]
+    if h <= 0:
+        return math.inf
+    t_min = math.inf
+    for is_V, _, value in limits:
+        k = 1 if is_V else 2
+        rate = (measured[k] - previous[k]) / h
+        if rate:
+            t_threshold = (value - measured[k]) / rate
+            if 0 < t_threshold < t_min:
+                t_min = t_threshold
+    return t_min
@@ -0,0 +1,19 @@
+from collections import namedtuple
+
+# One instrument reading returned by PSU.sample() and E_load.sample()
+# V: voltage [V], I: current [A], W: power [W], status: operation mode ('CC', 'CV', ...)
+Sample = namedtuple('Sample', ['V', 'I', 'W', 'status'])
+
+# Burst capture returned by E_load.capture(), as NumPy arrays
+# t: time since the trigger [s], V: voltage [V], I: current [A]
+Waveform = namedtuple('Waveform', ['t', 'V', 'I'])
+
+
+def emit(sinks, row):
+    """
+    Passes a row produced by a sampling loop to the sinks (ColumnBuffer, ...).
+    :param sinks: iterable of objects with an append(row) method
+    :param row: dictionary with the cycle_no, status, t, V and I of a sample
+    """
+    for sink in sinks:
+        sink.append(row)
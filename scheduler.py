@@ -0,0 +1,282 @@
+import math
+import numpy as np
+import clock
+
+
+class DeadlineMissed(RuntimeError):
+    """
+    Raised when the measurements repeatedly take longer than the measurement interval.
+    """
+
+
+class StopRequested(Exception):
+    """
+    Raised in a sampling loop when its stop event is set (e.g. by Orchestrator.stop()).
+    """
+
+
+def sleep(duration, stop_event = None):
+    """
+    Sleeps for the duration, or until the stop event is set.
+    :param duration: time in seconds
+    :param stop_event: optional threading.Event. StopRequested is raised when it is set.
+    """
+    if stop_event is None:
+        clock.sleep(duration)
+    elif clock.wait(stop_event, duration):
+        raise StopRequested()
+
+
+class DeadlineScheduler:
+    """
+    ------------------------------
+    Drift-free scheduler for the sampling loops.
+    ------------------------------
+    The n-th sample is placed on the absolute deadline t_start + n*dt of the monotonic clock, so the time
+    spent on the instrument queries does not accumulate into the sample spacing.
+    The lateness of each wake-up (jitter) and the missed deadlines are recorded.
+    ------------------------------
+    Usage:
+    scheduler = DeadlineScheduler(dt)
+    scheduler.start()
+    while ...:
+        t = scheduler.elapsed()
+        ... measure ...
+        scheduler.wait()
+    """
+    def __init__(self, dt, max_missed = 3, stop_event = None):
+        """
+        Constructor of the scheduler.
+        :param dt: measurement interval in seconds
+        :param max_missed: number of consecutive missed deadlines after which DeadlineMissed is raised.
+        A single late sample (e.g. an USB hiccup) skips to the next deadline instead.
+        :param stop_event: optional threading.Event. wait() raises StopRequested when it is set.
+        """
+        if dt <= 0:
+            raise ValueError(f'The measurement interval should be positive, got dt = {dt}')
+        self.dt = dt
+        self.max_missed = max_missed
+        self.stop_event = stop_event
+        self.t_start = None
+        self.n = 0
+        self.missed = 0
+        self.consecutive_missed = 0
+        self.jitter_n = 0
+        self.jitter_sum = 0.0
+        self.jitter_sum_sq = 0.0
+        self.jitter_max = 0.0
+
+    def start(self):
+        """
+        Starts the schedule. The first deadline is dt seconds after this call.
+        :return: the start time on the monotonic clock (see clock.py)
+        """
+        self.t_start = clock.monotonic()
+        self.n = 0
+        return self.t_start
+
+    def elapsed(self):
+        """
+        :return: time in seconds since the schedule started
+        """
+        return clock.monotonic() - self.t_start
+
+    def _deadline(self, n):
+        return self.t_start + n * self.dt
+
+    def _next_after(self, now):
+        """
+        :return: index of the first deadline after now
+        """
+        return math.floor((now - self.t_start) / self.dt) + 1
+
+    def _next_deadline(self):
+        """
+        Moves the schedule to the next deadline, skipping the deadlines that are already missed.
+        :return: the next deadline on the monotonic clock
+        """
+        self.n += 1
+        deadline = self._deadline(self.n)
+        now = clock.monotonic()
+        if now > deadline:
+            self.missed += 1
+            self.consecutive_missed += 1
+            if self.consecutive_missed >= self.max_missed:
+                raise DeadlineMissed(f'{self.consecutive_missed} consecutive samples took longer than '
+                                     f'dt = {self.dt} s (last one by {now - deadline:.3f} s). '
+                                     f'Increase dt or reduce the number of queries per sample.')
+            # skip to the next deadline in the future
+            self.n = self._next_after(now)
+            deadline = self._deadline(self.n)
+        else:
+            self.consecutive_missed = 0
+        if self.stop_event is not None and self.stop_event.is_set():
+            raise StopRequested()
+        return deadline
+
+    def _record_jitter(self, deadline):
+        jitter = clock.monotonic() - deadline
+        self.jitter_n += 1
+        self.jitter_sum += jitter
+        self.jitter_sum_sq += jitter ** 2
+        self.jitter_max = max(self.jitter_max, jitter)
+        return deadline - self.t_start
+
+    def wait(self):
+        """
+        Sleeps until the next deadline.
+        :return: the deadline's time since the schedule started
+        """
+        deadline = self._next_deadline()
+        remaining = deadline - clock.monotonic()
+        if remaining > 0:
+            sleep(remaining, self.stop_event)
+        return self._record_jitter(deadline)
+
+    async def async_wait(self):
+        """
+        Awaits the next deadline without blocking the event loop.
+        :return: the deadline's time since the schedule started
+        """
+        deadline = self._next_deadline()
+        remaining = deadline - clock.monotonic()
+        if remaining > 0:
+            await clock.async_sleep(remaining)
+        if self.stop_event is not None and self.stop_event.is_set():
+            raise StopRequested()
+        return self._record_jitter(deadline)
+
+    def stats(self):
+        """
+        :return: dictionary with the number of samples, missed deadlines and wake-up jitter statistics in seconds
+        """
+        n = self.jitter_n
+        mean = self.jitter_sum / n if n else 0.0
+        var = self.jitter_sum_sq / n - mean ** 2 if n else 0.0
+        return {
+            'samples': self.n,
+            'missed_deadlines': self.missed,
+            'jitter_mean [s]': mean,
+            'jitter_std [s]': math.sqrt(max(var, 0.0)),
+            'jitter_max [s]': self.jitter_max,
+        }
+
+
+class OffsetScheduler(DeadlineScheduler):
+    """
+    ------------------------------
+    Scheduler placing the samples on a list of offsets from its start instead of a uniform grid.
+    ------------------------------
+    The n-th sample is placed on t_start + offsets[n]. After the last sample, wait() sleeps until
+    t_start + duration, so consecutive schedules (e.g. the steps of a pulse protocol) follow each other
+    without gaps. Late deadlines are skipped like in DeadlineScheduler.
+    ------------------------------
+    Usage:
+    scheduler = OffsetScheduler(dense_sparse_offsets(600, 0.01, 1.0, 10.0), 600)
+    scheduler.start()
+    while not scheduler.finished():
+        t = scheduler.elapsed()
+        ... measure ...
+        scheduler.wait()
+    """
+    def __init__(self, offsets, duration, max_missed = 3, stop_event = None):
+        """
+        Constructor of the scheduler.
+        :param offsets: increasing sample times in seconds from the start, starting with 0
+        :param duration: duration of the schedule in seconds, after the last offset
+        :param max_missed: number of consecutive missed deadlines after which DeadlineMissed is raised
+        :param stop_event: optional threading.Event. wait() raises StopRequested when it is set.
+        """
+        offsets = np.asarray(offsets, dtype= float)
+        if len(offsets) == 0 or duration <= offsets[-1]:
+            raise ValueError('The schedule should have at least one offset, all of them before its duration')
+        intervals = np.diff(np.append(offsets, duration))
+        super().__init__(float(intervals.min()), max_missed, stop_event)
+        self.offsets = offsets
+        self.duration = duration
+
+    def _deadline(self, n):
+        if n >= len(self.offsets):
+            return self.t_start + self.duration
+        return self.t_start + self.offsets[n]
+
+    def _next_after(self, now):
+        return int(np.searchsorted(self.offsets, now - self.t_start, side= 'right'))
+
+    def finished(self):
+        """
+        :return: True when all the samples of the schedule are taken
+        """
+        return self.n >= len(self.offsets)
+
+
+class AdaptiveScheduler(DeadlineScheduler):
+    """
+    ------------------------------
+    Scheduler whose interval can change between the samples, between dt_min and dt_max.
+    ------------------------------
+    The deadlines stay absolute: after set_interval(dt), the schedule continues from the last deadline with
+    the new interval, so the time spent on the queries does not accumulate into the spacing either. Late
+    deadlines are skipped like in DeadlineScheduler.
+    ------------------------------
+    Usage:
+    scheduler = AdaptiveScheduler(0.1, 10.0)
+    scheduler.start()
+    while ...:
+        ... measure ...
+        scheduler.set_interval(... shorter near a threshold ...)
+        scheduler.wait()
+    """
+    def __init__(self, dt_min, dt_max, max_missed = 3, stop_event = None):
+        """
+        Constructor of the scheduler. The first interval is dt_max.
+        :param dt_min: shortest measurement interval in seconds
+        :param dt_max: longest measurement interval in seconds
+        :param max_missed: number of consecutive missed deadlines after which DeadlineMissed is raised
+        :param stop_event: optional threading.Event. wait() raises StopRequested when it is set.
+        """
+        if not 0 < dt_min <= dt_max:
+            raise ValueError(f'The intervals should satisfy 0 < dt_min <= dt_max, got {dt_min} and {dt_max}')
+        super().__init__(dt_max, max_missed, stop_event)
+        self.dt_min = dt_min
+        self.dt_max = dt_max
+        self._origin = None # time of the deadline n_origin, from which the current interval applies
+        self._n_origin = 0
+
+    def start(self):
+        self.dt = self.dt_max
+        self._origin = super().start()
+        self._n_origin = 0
+        return self._origin
+
+    def set_interval(self, dt):
+        """
+        Sets the interval to the next deadline and the following ones, clipped to [dt_min, dt_max].
+        """
+        self._origin = self._deadline(self.n)
+        self._n_origin = self.n
+        self.dt = min(max(dt, self.dt_min), self.dt_max)
+
+    def _deadline(self, n):
+        return self._origin + (n - self._n_origin) * self.dt
+
+    def _next_after(self, now):
+        return self._n_origin + math.floor((now - self._origin) / self.dt) + 1
+
+
+def dense_sparse_offsets(duration, dense_dt, dense_duration, sparse_dt):
+    """
+    Sample times that are dense at the start of a step and sparse afterwards.
+    e.g. dense_sparse_offsets(600, 0.01, 1.0, 10.0) samples every 10 ms during the first second and every 10 s
+    until 600 s.
+    :param duration: duration of the step in seconds
+    :param dense_dt: interval of the dense samples in seconds
+    :param dense_duration: duration of the dense sampling in seconds
+    :param sparse_dt: interval of the sparse samples in seconds
+    :return: NumPy array of the sample times in seconds from the start of the step
+    """
+    dense_end = min(dense_duration, duration)
+    dense = np.arange(0.0, dense_end, dense_dt)
+    # the sparse samples stay on multiples of sparse_dt
+    sparse = np.arange(math.ceil(dense_end / sparse_dt) * sparse_dt, duration, sparse_dt)
+    return np.concatenate((dense, sparse))
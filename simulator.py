@@ -0,0 +1,506 @@
+import math
+import random
+from collections import deque
+import numpy as np
+import pyvisa
+import clock
+from visa_session import SessionPool
+
+SIM_PSU_ID = 'SIM::SPD1168X::INSTR'
+SIM_LOAD_ID = 'SIM::DL3021::INSTR'
+
+
+class LatencyModel:
+    """
+    Latency of a simulated instrument: each SCPI exchange takes a normally distributed time in seconds.
+    """
+    def __init__(self, mean = 0.005, jitter = 0.001, seed = None):
+        """
+        :param mean: mean latency in seconds
+        :param jitter: standard deviation of the latency in seconds
+        :param seed: seed of the random generator, for reproducible runs
+        """
+        self.mean = mean
+        self.jitter = jitter
+        self._random = random.Random(seed)
+
+    def sample(self):
+        if self.jitter == 0:
+            return self.mean
+        return max(0.0, self._random.gauss(self.mean, self.jitter))
+
+
+class SimCell:
+    """
+    ------------------------------
+    Equivalent-circuit (1RC) model of a battery cell.
+    ------------------------------
+    V = OCV(SOC) + V1 + I*R0, where the current I is positive when charging and V1 is the voltage of the
+    R1-C1 pair. The default OCV-SOC curve is a generic LFP curve between 2.0 and 3.65 V.
+    """
+    OCV_SOC = (0.0, 0.02, 0.05, 0.1, 0.2, 0.5, 0.8, 0.9, 0.95, 0.98, 1.0)
+    OCV_V = (2.0, 2.8, 3.0, 3.15, 3.25, 3.3, 3.33, 3.35, 3.4, 3.5, 3.65)
+
+    def __init__(self, capacity = 1.5, soc = 0.5, R0 = 0.03, R1 = 0.015, C1 = 2000, ocv_soc = None, ocv_V = None):
+        """
+        Constructor of the cell.
+        :param capacity: capacity in Ahr
+        :param soc: initial state of charge (0 to 1)
+        :param R0: series resistance in Ohm
+        :param R1: resistance of the RC pair in Ohm
+        :param C1: capacitance of the RC pair in F
+        :param ocv_soc: SOC points of the OCV-SOC curve
+        :param ocv_V: OCV points of the OCV-SOC curve
+        """
+        self.capacity = capacity
+        self.soc = soc
+        self.R0 = R0
+        self.R1 = R1
+        self.C1 = C1
+        self.ocv_soc = np.asarray(self.OCV_SOC if ocv_soc is None else ocv_soc, dtype= float)
+        self.ocv_V = np.asarray(self.OCV_V if ocv_V is None else ocv_V, dtype= float)
+        self.V1 = 0.0
+
+    def ocv(self):
+        return float(np.interp(self.soc, self.ocv_soc, self.ocv_V))
+
+    def voltage(self, I):
+        """
+        :param I: cell current in A (positive when charging)
+        :return: terminal voltage in V
+        """
+        return self.ocv() + self.V1 + I * self.R0
+
+    def current_at(self, V):
+        """
+        :param V: terminal voltage in V
+        :return: cell current in A that gives the terminal voltage
+        """
+        return (V - self.ocv() - self.V1) / self.R0
+
+    def step(self, I, dt):
+        """
+        Advances the cell's state with a constant current.
+        :param I: cell current in A (positive when charging)
+        :param dt: time step in seconds
+        """
+        decay = math.exp(-dt / (self.R1 * self.C1))
+        self.V1 = self.V1 * decay + I * self.R1 * (1 - decay)
+        self.soc = min(1.0, max(0.0, self.soc + I * dt / 3600 / self.capacity))
+
+
+class SimCircuit:
+    """
+    A cell with simulated instruments connected to its terminals. The cell is advanced lazily, in steps of
+    at most max_step seconds, each time an instrument is accessed.
+    """
+    def __init__(self, cell = None, max_step = 1.0):
+        """
+        :param cell: SimCell. A default cell is created if None.
+        :param max_step: maximum time step in seconds of the cell's integration
+        """
+        self.cell = SimCell() if cell is None else cell
+        self.max_step = max_step
+        self.instruments = []
+        self.t = None
+
+    def current(self):
+        """
+        :return: cell current in A, the sum of the instruments' currents (positive when charging)
+        """
+        return sum(instrument.current(self.cell) for instrument in self.instruments)
+
+    def voltage(self):
+        return self.cell.voltage(self.current())
+
+    def advance(self):
+        now = clock.monotonic()
+        if self.t is None:
+            self.t = now
+        while self.t < now:
+            dt = min(self.max_step, now - self.t)
+            self.cell.step(self.current(), dt)
+            self.t += dt
+
+
+def _node_matches(node, pattern_node):
+    node = node.upper()
+    if node.endswith('?') != pattern_node.endswith('?'):
+        return False
+    node, pattern_node = node.rstrip('?'), pattern_node.rstrip('?')
+    short = ''.join(c for c in pattern_node if not c.islower())
+    return node in (short, pattern_node.upper())
+
+
+def scpi_match(header, pattern):
+    """
+    Matches an SCPI command header against a pattern in the manuals' notation, where each node can be given
+    in its short (upper case) or long form and a leading [NODE:] is optional.
+    e.g. scpi_match(':SOUR:CURR:LEV:IMM', '[SOURce:]CURRent:LEVel:IMMediate') is True.
+    :param header: command header, without arguments
+    :param pattern: command pattern
+    :return: True if the header matches
+    """
+    patterns = [pattern.replace('[', '').replace(']', '')]
+    if pattern.startswith('['):
+        patterns.append(pattern[pattern.index(']') + 1:])
+    nodes = header.lstrip(':').split(':')
+    for candidate in patterns:
+        candidate_nodes = candidate.split(':')
+        if len(nodes) == len(candidate_nodes) and all(map(_node_matches, nodes, candidate_nodes)):
+            return True
+    return False
+
+
+class SimInstrument:
+    """
+    ------------------------------
+    Base class of the simulated instruments.
+    ------------------------------
+    Behaves like a pyvisa resource (write, read, query, close) and answers the SCPI commands listed in
+    COMMANDS, a tuple of (pattern, method name). Compound commands separated by ';' are supported.
+    Each exchange takes a time drawn from the latency model, on the package's clock.
+    """
+    IDN = 'SIM'
+    COMMANDS = ()
+
+    def __init__(self, circuit, latency = None):
+        """
+        :param circuit: SimCircuit the instrument is connected to
+        :param latency: LatencyModel. No latency if None.
+        """
+        self.circuit = circuit
+        self.latency = LatencyModel(0, 0) if latency is None else latency
+        self.write_termination = '\n'
+        self.read_termination = '\n'
+        self.timeout = 2000
+        self.on = False
+        self._responses = deque()
+        circuit.instruments.append(self)
+
+    def current(self, cell):
+        raise NotImplementedError
+
+    def _handle(self, header, argument):
+        for pattern, name in self.COMMANDS:
+            if scpi_match(header, pattern):
+                return getattr(self, name)(argument)
+        raise ValueError(f'{type(self).__name__} does not support the command {header!r}')
+
+    def write(self, command):
+        clock.sleep(self.latency.sample())
+        self.circuit.advance()
+        answers = []
+        for part in command.strip().split(';'):
+            header, _, argument = part.strip().partition(' ')
+            answer = self._handle(header, argument.strip())
+            if answer is not None:
+                answers.append(str(answer))
+        if answers:
+            self._responses.append(';'.join(answers))
+
+    def read(self):
+        if not self._responses:
+            raise pyvisa.errors.VisaIOError(pyvisa.constants.StatusCode.error_timeout)
+        return self._responses.popleft()
+
+    def query(self, command):
+        self.write(command)
+        return self.read()
+
+    def close(self):
+        self._responses.clear()
+
+    def idn(self, argument):
+        return self.IDN
+
+    def opc(self, argument):
+        return 1
+
+
+class SimSPD(SimInstrument):
+    """
+    Simulated Siglent SPD1168X power supply (single channel, CC/CV source, with the timer sequence of
+    TIMER_GROUPS (voltage, current, duration) groups run once from the output on).
+    """
+    IDN = 'Siglent Technologies,SPD1168X,SIM0000000000,1.0'
+    COMMANDS = (
+        ('*IDN?', 'idn'),
+        ('*OPC?', 'opc'),
+        ('[CH1:]VOLTage', 'set_voltage'),
+        ('[CH1:]CURRent', 'set_current'),
+        ('OUTPut', 'set_output'),
+        ('MEASure:VOLTage?', 'measure_voltage'),
+        ('MEASure:CURRent?', 'measure_current'),
+        ('MEASure:POWEr?', 'measure_power'),
+        ('SYSTem:STATus?', 'status'),
+        ('TIMEr:SET', 'set_timer_group'),
+        ('TIMEr:SET?', 'timer_group'),
+        ('TIMEr', 'set_timer'),
+    )
+    TIMER_GROUPS = 5
+
+    def __init__(self, circuit, latency = None):
+        super().__init__(circuit, latency)
+        self.V_set = 0.0
+        self.I_set = 0.0
+        self.timer_groups = {} # group: (V, I, duration)
+        self.timer = False
+        self.t_output_on = None
+
+    def set_points(self):
+        """
+        :return: (V, I) set points, those of the timer group running at the circuit's time in the timer mode
+        """
+        if not self.timer or self.t_output_on is None:
+            return self.V_set, self.I_set
+        elapsed = self.circuit.t - self.t_output_on
+        for group in range(1, self.TIMER_GROUPS + 1):
+            V, I, duration = self.timer_groups.get(group, (0.0, 0.0, 0.0))
+            if elapsed < duration:
+                return V, I
+            elapsed -= duration
+        return 0.0, 0.0 # the sequence is over, the output is off
+
+    def is_CC(self, cell):
+        V_set, I_set = self.set_points()
+        return cell.voltage(I_set) <= V_set
+
+    def current(self, cell):
+        if not self.on:
+            return 0.0
+        V_set, I_set = self.set_points()
+        if cell.voltage(I_set) <= V_set:
+            return I_set
+        return min(I_set, max(0.0, cell.current_at(V_set)))
+
+    def set_voltage(self, argument):
+        self.V_set = float(argument)
+
+    def set_current(self, argument):
+        self.I_set = float(argument)
+
+    def set_output(self, argument):
+        channel, _, state = argument.partition(',')
+        self.on = state.strip().upper() in ('ON', '1')
+        self.t_output_on = self.circuit.t if self.on else None
+
+    def set_timer_group(self, argument):
+        channel, group, V, I, duration = argument.split(',')
+        group = int(group)
+        if not 1 <= group <= self.TIMER_GROUPS:
+            raise ValueError(f'The timer groups are numbered 1 to {self.TIMER_GROUPS}, got {group}')
+        self.timer_groups[group] = (float(V), float(I), float(duration))
+
+    def timer_group(self, argument):
+        channel, group = argument.split(',')
+        return ','.join(str(value) for value in self.timer_groups.get(int(group), (0.0, 0.0, 0.0)))
+
+    def set_timer(self, argument):
+        channel, _, state = argument.partition(',')
+        self.timer = state.strip().upper() in ('ON', '1')
+
+    def measure_voltage(self, argument):
+        return self.circuit.voltage()
+
+    def measure_current(self, argument):
+        return self.current(self.circuit.cell)
+
+    def measure_power(self, argument):
+        return self.circuit.voltage() * self.current(self.circuit.cell)
+
+    def status(self, argument):
+        """
+        bit 0: 1 in CC mode, 0 in CV mode. bit 4: 1 if the output is on.
+        """
+        return hex(int(self.is_CC(self.circuit.cell)) | int(self.on) << 4)
+
+
+class SimDL3021(SimInstrument):
+    """
+    Simulated Rigol DL3021 electronic load (CC and CV modes, and CC list mode run from a bus trigger).
+    """
+    IDN = 'RIGOL TECHNOLOGIES,DL3021,SIM0000000000,00.01.00'
+    FUNCTIONS = ('CURRent', 'VOLTage', 'RESistance', 'POWer')
+    COMMANDS = (
+        ('*IDN?', 'idn'),
+        ('*OPC?', 'opc'),
+        ('[SOURce:]INPut:STATe', 'set_input'),
+        ('[SOURce:]FUNCtion', 'set_function'),
+        ('[SOURce:]FUNCtion?', 'function'),
+        ('[SOURce:]CURRent:LEVel:IMMediate', 'set_current'),
+        ('[SOURce:]VOLTage:LEVel:IMMediate', 'set_voltage'),
+        ('MEASure:VOLTage?', 'measure_voltage'),
+        ('MEASure:CURRent?', 'measure_current'),
+        ('MEASure:POWer?', 'measure_power'),
+        ('[SOURce:]FUNCtion:MODE', 'set_function_mode'),
+        ('[SOURce:]LIST:MODE', 'set_list_mode'),
+        ('[SOURce:]LIST:STEP', 'set_list_steps'),
+        ('[SOURce:]LIST:COUNt', 'set_list_count'),
+        ('[SOURce:]LIST:LEVel', 'set_list_level'),
+        ('[SOURce:]LIST:WIDth', 'set_list_width'),
+        ('[SOURce:]LIST:END', 'set_list_end'),
+        ('TRIGger:SOURce', 'set_trigger_source'),
+        ('*TRG', 'trigger'),
+        ('TRIGger', 'trigger'),
+    )
+
+    def __init__(self, circuit, latency = None, I_max = 40.0):
+        """
+        :param I_max: maximum sink current in A
+        """
+        super().__init__(circuit, latency)
+        self.I_max = I_max
+        self.mode = 'CURRent'
+        self.I_set = 0.0
+        self.V_set = 0.0
+        self.function_mode = 'FIXED'
+        self.list_levels = {}
+        self.list_widths = {}
+        self.list_steps = 0
+        self.list_count = 1
+        self.list_end = 'OFF'
+        self.t_trigger = None
+
+    def list_current(self):
+        """
+        :return: set point of the list step running at the circuit's time, or None after the end of the list
+        """
+        if self.t_trigger is None:
+            return 0.0
+        widths = [self.list_widths.get(step, 0.0) for step in range(self.list_steps)]
+        period = sum(widths)
+        elapsed = self.circuit.t - self.t_trigger
+        if period <= 0 or (self.list_count > 0 and elapsed >= period * self.list_count):
+            return None
+        elapsed %= period
+        for step, width in enumerate(widths):
+            if elapsed < width:
+                return self.list_levels.get(step, 0.0)
+            elapsed -= width
+        return self.list_levels.get(self.list_steps - 1, 0.0)
+
+    def sink_current(self, cell):
+        if not self.on:
+            return 0.0
+        if self.function_mode == 'LIST':
+            I = self.list_current()
+            if I is None:
+                I = self.list_levels.get(self.list_steps - 1, 0.0) if self.list_end == 'LAST' else 0.0
+            return I if cell.voltage(-I) > 0 else 0.0
+        if self.mode == 'CURRent':
+            return self.I_set if cell.voltage(-self.I_set) > 0 else 0.0
+        return min(self.I_max, max(0.0, -cell.current_at(self.V_set)))
+
+    def current(self, cell):
+        return -self.sink_current(cell)
+
+    def set_input(self, argument):
+        self.on = argument.upper() in ('1', 'ON')
+        if not self.on:
+            self.t_trigger = None
+
+    def set_function_mode(self, argument):
+        for function_mode in ('FIXed', 'LIST'):
+            if _node_matches(argument, function_mode):
+                self.function_mode = function_mode.upper()
+                return
+        raise ValueError(f'The simulated load does not support the function mode {argument!r}')
+
+    def set_list_mode(self, argument):
+        if argument.upper() != 'CC':
+            raise ValueError(f'The simulated list mode only supports CC, got {argument!r}')
+
+    def set_list_steps(self, argument):
+        self.list_steps = int(argument)
+
+    def set_list_count(self, argument):
+        self.list_count = int(argument)
+
+    def set_list_level(self, argument):
+        step, value = argument.split(',')
+        self.list_levels[int(step)] = float(value)
+
+    def set_list_width(self, argument):
+        step, value = argument.split(',')
+        self.list_widths[int(step)] = float(value)
+
+    def set_list_end(self, argument):
+        self.list_end = argument.upper()
+
+    def set_trigger_source(self, argument):
+        pass
+
+    def trigger(self, argument):
+        if self.function_mode == 'LIST' and self.on:
+            self.t_trigger = self.circuit.t
+
+    def set_function(self, argument):
+        for function in self.FUNCTIONS:
+            if _node_matches(argument, function):
+                self.mode = function
+                return
+        raise ValueError(f'Unknown function {argument!r}')
+
+    def function(self, argument):
+        return self.mode.upper()
+
+    def set_current(self, argument):
+        self.I_set = float(argument)
+
+    def set_voltage(self, argument):
+        self.V_set = float(argument)
+
+    def measure_voltage(self, argument):
+        return self.circuit.voltage()
+
+    def measure_current(self, argument):
+        return self.sink_current(self.circuit.cell)
+
+    def measure_power(self, argument):
+        return self.circuit.voltage() * self.sink_current(self.circuit.cell)
+
+
+class SimResourceManager:
+    """
+    Replacement of the pyvisa ResourceManager serving simulated instruments. Pass it to a SessionPool.
+    """
+    def __init__(self, resources):
+        """
+        :param resources: dictionary of instrument ids and simulated instruments
+        """
+        self.resources = dict(resources)
+
+    def list_resources(self):
+        return tuple(self.resources)
+
+    def open_resource(self, id):
+        if id not in self.resources:
+            raise pyvisa.errors.VisaIOError(pyvisa.constants.StatusCode.error_resource_not_found)
+        return self.resources[id]
+
+    def close(self):
+        pass
+
+
+def simulated_pool(cell = None, latency = None, psu_id = SIM_PSU_ID, load_id = SIM_LOAD_ID, max_step = 1.0):
+    """
+    Creates a session pool serving a simulated SPD1168X and DL3021 connected to one simulated cell.
+    ------------------------------
+    Usage (a 30-hour C/30 protocol runs in seconds with the virtual clock):
+    clock.set_clock(clock.VirtualClock())
+    pool = simulated_pool(SimCell(soc= 1.0), LatencyModel(0.005, 0.001, seed= 0))
+    cycle1 = Cycling(..., psu_id= SIM_PSU_ID, e_load_id= SIM_LOAD_ID, pool= pool)
+    df = cycle1.discharge_CC(return_output= True)
+    ------------------------------
+    :param cell: SimCell. A default cell is created if None.
+    :param latency: LatencyModel shared by both instruments. No latency if None.
+    :param psu_id: id of the simulated psu
+    :param load_id: id of the simulated e-load
+    :param max_step: maximum time step in seconds of the cell's integration
+    :return: SessionPool
+    """
+    circuit = SimCircuit(cell, max_step)
+    resource_manager = SimResourceManager({psu_id: SimSPD(circuit, latency),
+                                           load_id: SimDL3021(circuit, latency)})
+    return SessionPool(resource_manager= resource_manager)
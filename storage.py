@@ -0,0 +1,175 @@
+"""
+Compact columnar storage of the cycling results.
+-----------------------------------------------------------------------------------------------
+compact() converts a result DataFrame to compact dtypes: categorical status/step, int32 cycle and pulse
+numbers, float32 voltages, currents and capacities (float32 keeps 7 significant digits, below the
+instruments' resolution), and float64 times (multi-week runs need millisecond resolution).
+Formats, selected by the file extension:
+* '.parquet': Parquet with compression and row groups (requires pyarrow). Column-pruned reading.
+* '.h5', '.hdf5': HDF5 table with blosc compression (requires PyTables). Column-pruned reading.
+* '.cols': directory with one .npy file per column and a JSON schema, no extra dependency and no
+  compression. Column-pruned and memory-mapped reading.
+-----------------------------------------------------------------------------------------------
+Usage:
+write_table(df, 'data/run.parquet')
+df = read_table('data/run.parquet', columns= ['t', 'V'])
+convert('data/ECM_parameter.csv', 'data/ECM_parameter.parquet') # archive a streamed CSV file
+"""
+import json
+import os
+import numpy as np
+import pandas as pd
+from buffer import CYCLING_COLUMNS
+
+# compact dtypes of the fields of the sampling loops' rows
+COMPACT_DTYPES = {
+    'cycle_no': 'int32',
+    'pulse_no': 'int32',
+    'status': 'category',
+    'step': 'category',
+    't': 'float64',
+    'V': 'float32',
+    'I': 'float32',
+    'W': 'float32',
+    'cap_charge': 'float32',
+    'cap_discharge': 'float32',
+}
+COMPACT_DTYPES.update({column: COMPACT_DTYPES[name] for name, column in CYCLING_COLUMNS.items()})
+
+FORMATS = {'.parquet': 'parquet', '.h5': 'hdf5', '.hdf5': 'hdf5', '.cols': 'cols'}
+
+
+def _format(path):
+    extension = os.path.splitext(str(path).rstrip('/\\'))[1].lower()
+    if extension not in FORMATS:
+        raise ValueError(f'Unknown storage format {extension!r}, use one of {tuple(FORMATS)}')
+    return FORMATS[extension]
+
+
+def compact(df):
+    """
+    Converts the known columns of a result DataFrame to the compact dtypes of COMPACT_DTYPES.
+    The cycle numbers stored as floats (e.g. 1.0) are converted to integers.
+    :param df: pandas DataFrame (field names or CYCLING_COLUMNS names)
+    :return: new pandas DataFrame
+    """
+    dtypes = {column: dtype for column, dtype in COMPACT_DTYPES.items() if column in df}
+    return df.astype(dtypes)
+
+
+def write_table(df, path, compression = 'zstd', row_group_size = 1_000_000):
+    """
+    Writes a result DataFrame in compact dtypes.
+    :param df: pandas DataFrame
+    :param path: file path. The format is selected by the extension ('.parquet', '.h5', '.hdf5' or '.cols').
+    :param compression: Parquet codec (e.g. 'zstd', 'snappy') or blosc codec for HDF5. Ignored for '.cols'.
+    :param row_group_size: number of rows per Parquet row group (chunk)
+    """
+    df = compact(df)
+    fmt = _format(path)
+    if fmt == 'parquet':
+        df.to_parquet(path, engine= 'pyarrow', compression= compression, row_group_size= row_group_size,
+                      index= False)
+    elif fmt == 'hdf5':
+        df.to_hdf(path, key= 'data', mode= 'w', format= 'table', complevel= 5, complib= f'blosc:{compression}',
+                  index= False)
+    else:
+        _write_cols(df, path)
+
+
+def _write_cols(df, path):
+    os.makedirs(path, exist_ok= True)
+    schema = []
+    for i, column in enumerate(df.columns):
+        values = df[column]
+        categories = None
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            categories = [str(category) for category in values.cat.categories]
+            values = values.cat.codes
+        np.save(os.path.join(path, f'{i}.npy'), np.ascontiguousarray(values.to_numpy()))
+        schema.append({'name': column, 'file': f'{i}.npy', 'categories': categories})
+    with open(os.path.join(path, 'schema.json'), 'w') as f:
+        json.dump({'rows': len(df), 'columns': schema}, f, indent= 1)
+
+
+def read_columns(path, columns = None, mmap = True):
+    """
+    Reads the columns of a '.cols' directory without copying them.
+    :param path: directory path
+    :param columns: optional list of columns to read
+    :param mmap: if True, the arrays are memory-mapped and only the pages used are read from the disk
+    :return: dictionary of column names and NumPy arrays (pandas Categorical for the categorical columns)
+    """
+    with open(os.path.join(path, 'schema.json')) as f:
+        schema = json.load(f)['columns']
+    selected = {entry['name']: entry for entry in schema}
+    names = list(selected) if columns is None else list(columns)
+    arrays = {}
+    for name in names:
+        entry = selected[name]
+        values = np.load(os.path.join(path, entry['file']), mmap_mode= 'r' if mmap else None)
+        if entry['categories'] is not None:
+            values = pd.Categorical.from_codes(values, categories= entry['categories'])
+        arrays[name] = values
+    return arrays
+
+
+def read_table(path, columns = None, mmap = True):
+    """
+    Reads a file written by write_table.
+    :param path: file path
+    :param columns: optional list of columns to read, the others are not read from the disk
+    :param mmap: memory-maps the file ('.parquet' and '.cols')
+    :return: pandas DataFrame
+    """
+    fmt = _format(path)
+    if fmt == 'parquet':
+        return pd.read_parquet(path, engine= 'pyarrow', columns= columns, memory_map= mmap)
+    if fmt == 'hdf5':
+        return compact(pd.read_hdf(path, key= 'data', columns= columns))
+    return pd.DataFrame(read_columns(path, columns, mmap), copy= False)
+
+
+def convert(csv_path, path, chunksize = 1_000_000, compression = 'zstd'):
+    """
+    Converts a CSV result file (e.g. written by CSVStreamWriter) to a compact columnar file, chunk by chunk for
+    Parquet and HDF5 so that files larger than the memory can be converted.
+    :param csv_path: CSV file path
+    :param path: output path, see write_table
+    :param chunksize: number of rows converted at once
+    :return: number of rows
+    """
+    fmt = _format(path)
+    chunks = pd.read_csv(csv_path, chunksize= chunksize)
+    if fmt == 'cols':
+        df = pd.concat(chunks, ignore_index= True)
+        _write_cols(compact(df), path)
+        return len(df)
+
+    n = 0
+    writer = None
+    try:
+        for chunk in chunks:
+            chunk = compact(chunk)
+            if fmt == 'parquet':
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                table = pa.Table.from_pandas(chunk, preserve_index= False)
+                if writer is None:
+                    # the categories differ between chunks, so the dictionary index type is fixed to int32
+                    schema = pa.schema([pa.field(field.name, pa.dictionary(pa.int32(), pa.string()))
+                                        if pa.types.is_dictionary(field.type) else field for field in table.schema])
+                    writer = pq.ParquetWriter(path, schema, compression= compression)
+                writer.write_table(table.cast(writer.schema))
+            else:
+                # the categories differ between chunks, so the HDF5 table stores fixed-width strings
+                strings = [column for column in chunk.columns if isinstance(chunk[column].dtype, pd.CategoricalDtype)]
+                chunk = chunk.astype({column: object for column in strings})
+                chunk.to_hdf(path, key= 'data', mode= 'w' if n == 0 else 'a', format= 'table', append= True,
+                             complevel= 5, complib= f'blosc:{compression}', index= False,
+                             min_itemsize= {column: 24 for column in strings} or None)
+            n += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return n
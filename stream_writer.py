@@ -0,0 +1,289 @@
+import csv
+import io
+import json
+import os
+import struct
+import time
+import zlib
+import numpy as np
+import pandas as pd
+from buffer import ColumnBuffer, CYCLING_FIELDS
+
+
+class StreamWriter:
+    """
+    ------------------------------
+    Streaming, append-only writer for the rows produced by the sampling loops.
+    ------------------------------
+    The writer is a sink: the loops push their rows with append(row) and the rows are written to disk in
+    batches of batch_size rows. The file is fsync-ed at most every fsync_interval seconds, so a crash loses at
+    most the rows of the current batch and of the last fsync_interval seconds.
+    An existing file is overwritten unless resume = True is passed explicitly, e.g. to continue a crashed run:
+    then a partially written last batch (left by the crash) is truncated and the new rows are appended after
+    the last complete one. Resuming with the file of another run would mix the two runs in one file.
+    ------------------------------
+    Usage:
+    with CSVStreamWriter('data/run.csv') as writer:
+        cycle1.cycle(sinks= (writer,), return_output= False)
+    """
+    def __init__(self, path, fields = CYCLING_FIELDS, batch_size = 256, fsync_interval = 10.0, resume = False):
+        """
+        Constructor of the writer.
+        :param path: file path
+        :param fields: dictionary of the field names and their NumPy dtypes, in column order
+        :param batch_size: number of rows written to the file at once
+        :param fsync_interval: minimum time in seconds between two fsync calls. 0 fsyncs every batch.
+        :param resume: If True, an existing file of the same run is repaired and appended to. Otherwise it is
+        overwritten.
+        """
+        self.path = path
+        self.fields = dict(fields)
+        self.batch_size = batch_size
+        self.fsync_interval = fsync_interval
+        self.rows_written = 0
+        self._t_fsync = time.monotonic()
+        self._batch = ColumnBuffer(self.fields, capacity= batch_size)
+        if resume and os.path.exists(path) and os.path.getsize(path) > 0:
+            self.rows_written = self._repair()
+            self.file = open(path, 'ab')
+        else:
+            self.file = open(path, 'wb')
+            self._write_header()
+            self._sync(force= True)
+
+    def _write_header(self):
+        raise NotImplementedError
+
+    def _write_batch(self, batch):
+        raise NotImplementedError
+
+    def _repair(self):
+        """
+        Truncates a partially written last batch.
+        :return: number of complete rows in the file
+        """
+        raise NotImplementedError
+
+    def _sync(self, force = False):
+        self.file.flush()
+        if force or time.monotonic() - self._t_fsync >= self.fsync_interval:
+            os.fsync(self.file.fileno())
+            self._t_fsync = time.monotonic()
+
+    def append(self, row):
+        """
+        Buffers one row and writes the batch when it is full.
+        :param row: dictionary of the field values. Keys that are not fields are ignored.
+        """
+        self._batch.append(row)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self, fsync = False):
+        """
+        Writes the buffered rows to the file.
+        :param fsync: If True, the file is fsync-ed regardless of fsync_interval.
+        """
+        if len(self._batch):
+            self._write_batch(self._batch)
+            self.rows_written += len(self._batch)
+            self._batch.clear()
+        self._sync(force= fsync)
+
+    def close(self):
+        if not self.file.closed:
+            self.flush(fsync= True)
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CSVStreamWriter(StreamWriter):
+    """
+    Streaming writer for CSV files. A crash can leave an incomplete last line, which is removed on resume.
+    """
+    def __init__(self, path, fields = CYCLING_FIELDS, columns = None, **kwargs):
+        """
+        :param columns: optional dictionary renaming the fields in the CSV header (e.g. CYCLING_COLUMNS)
+        """
+        self.header = [columns.get(name, name) if columns else name for name in fields]
+        super().__init__(path, fields, **kwargs)
+
+    def _write_header(self):
+        self.file.write((','.join(self.header) + '\n').encode())
+
+    def _write_batch(self, batch):
+        lines = []
+        writer = csv.writer(_LineCollector(lines), lineterminator= '\n')
+        writer.writerows(zip(*(batch.column(name).tolist() for name in self.fields)))
+        self.file.write(''.join(lines).encode())
+
+    def _repair(self):
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            header = data.split(b'\n', 1)[0].decode()
+            if header != ','.join(self.header):
+                raise ValueError(f'Cannot resume {self.path}: its header {header!r} does not match the fields')
+            end = data.rfind(b'\n') + 1 # end of the last complete line
+            if end < len(data):
+                f.truncate(end)
+        return data[:end].count(b'\n') - 1
+
+
+class _LineCollector:
+    def __init__(self, lines):
+        self.write = lines.append
+
+
+class ColumnarStreamWriter(StreamWriter):
+    """
+    ------------------------------
+    Streaming writer for an append-only binary columnar format.
+    ------------------------------
+    Layout:
+    header: MAGIC, uint32 schema length, JSON schema (list of [field, dtype], [field, dtype, 'category'] for the
+    categorical fields)
+    chunks: b'CHNK', uint32 rows, uint32 payload length, uint32 crc32 of the payload, payload
+    categories: b'CATS', uint32 number of new categories, uint32 payload length, uint32 crc32, JSON payload
+    (dictionary of the categorical fields and their new categories)
+    The payload of a chunk holds the columns one after the other. Object (string) fields are categorical, like
+    the status in storage.py: they are stored as int32 codes into the categories of the field, in the order of
+    the categories records, which are written before the first chunk using them. Strings of any length and
+    encoding are stored as such. A record whose length or crc32 does not match is removed on resume.
+    Files with fixed-width string fields (older versions, STRING_DTYPE) are still read.
+    """
+    MAGIC = b'BTCOL1\n'
+    CHUNK = b'CHNK'
+    CATEGORIES = b'CATS'
+    CHUNK_HEADER = struct.Struct('<4sIII')
+    STRING_DTYPE = 'S24'
+    CODE_DTYPE = np.dtype('<i4')
+
+    def __init__(self, path, fields = CYCLING_FIELDS, **kwargs):
+        self.categorical = [name for name, dtype in fields.items() if np.dtype(dtype) == object]
+        self.dtypes = {name: self.CODE_DTYPE if name in self.categorical else np.dtype(dtype).newbyteorder('<')
+                       for name, dtype in fields.items()}
+        self._codes = {name: {} for name in self.categorical} # category: code, for each categorical field
+        super().__init__(path, fields, **kwargs)
+
+    def _schema(self):
+        return json.dumps([[name, dtype.str, 'category'] if name in self.categorical else [name, dtype.str]
+                           for name, dtype in self.dtypes.items()]).encode()
+
+    def _write_header(self):
+        schema = self._schema()
+        self.file.write(self.MAGIC + struct.pack('<I', len(schema)) + schema)
+
+    def _encode(self, name, values):
+        """
+        :return: codes of the values, and the new categories (added to the field's categories)
+        """
+        codes = self._codes[name]
+        new = []
+        for value in dict.fromkeys(values):
+            value = str(value)
+            if value not in codes:
+                codes[value] = len(codes)
+                new.append(value)
+        return np.fromiter((codes[str(value)] for value in values), dtype= self.CODE_DTYPE, count= len(values)), new
+
+    def _write_batch(self, batch):
+        n = len(batch)
+        columns, new_categories = [], {}
+        for name, dtype in self.dtypes.items():
+            if name in self.categorical:
+                codes, new = self._encode(name, batch.column(name))
+                if new:
+                    new_categories[name] = new
+                columns.append(codes.tobytes())
+            else:
+                columns.append(np.ascontiguousarray(batch.column(name), dtype= dtype).tobytes())
+        payload = b''.join(columns)
+        record = b''
+        if new_categories:
+            categories = json.dumps(new_categories).encode()
+            record = self.CHUNK_HEADER.pack(self.CATEGORIES, sum(map(len, new_categories.values())),
+                                            len(categories), zlib.crc32(categories)) + categories
+        self.file.write(record + self.CHUNK_HEADER.pack(self.CHUNK, n, len(payload), zlib.crc32(payload)) + payload)
+
+    def _repair(self):
+        dtypes, categories, offset, chunks = _scan_columnar(self.path)
+        if dtypes != self.dtypes or sorted(categories) != sorted(self.categorical):
+            raise ValueError(f'Cannot resume {self.path}: its schema does not match the fields')
+        self._codes = {name: {category: code for code, category in enumerate(categories[name])}
+                       for name in self.categorical}
+        with open(self.path, 'rb+') as f:
+            f.truncate(offset)
+        return sum(n for _, n, _ in chunks)
+
+
+def _scan_columnar(path):
+    """
+    Reads the schema, the categories and the complete chunks of a columnar stream file.
+    :return: dictionary of field dtypes, dictionary of the categorical fields and their categories, offset after
+    the last complete record, list of (offset, rows, payload length) of the chunks
+    """
+    header = ColumnarStreamWriter.CHUNK_HEADER
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic = ColumnarStreamWriter.MAGIC
+    if not data.startswith(magic):
+        raise ValueError(f'{path} is not a columnar stream file')
+    (schema_length,) = struct.unpack_from('<I', data, len(magic))
+    offset = len(magic) + 4 + schema_length
+    schema = json.loads(data[len(magic) + 4:offset])
+    dtypes = {entry[0]: np.dtype(entry[1]) for entry in schema}
+    categories = {entry[0]: [] for entry in schema if entry[2:] == ['category']}
+    chunks = []
+    while offset + header.size <= len(data):
+        tag, n, length, crc = header.unpack_from(data, offset)
+        payload = data[offset + header.size:offset + header.size + length]
+        if tag not in (ColumnarStreamWriter.CHUNK, ColumnarStreamWriter.CATEGORIES) or len(payload) != length \
+                or zlib.crc32(payload) != crc:
+            break
+        if tag == ColumnarStreamWriter.CATEGORIES:
+            for name, new in json.loads(payload).items():
+                categories[name].extend(new)
+        else:
+            chunks.append((offset + header.size, n, length))
+        offset += header.size + length
+    return dtypes, categories, offset, chunks
+
+
+def read_stream(path, columns = None):
+    """
+    Reads a file written by CSVStreamWriter or ColumnarStreamWriter, ignoring a partially written last batch.
+    :param path: file path
+    :param columns: optional list of fields to read
+    :return: pandas DataFrame
+    """
+    with open(path, 'rb') as f:
+        is_columnar = f.read(len(ColumnarStreamWriter.MAGIC)) == ColumnarStreamWriter.MAGIC
+    if not is_columnar:
+        with open(path, 'rb') as f:
+            data = f.read()
+        data = data[:data.rfind(b'\n') + 1]
+        return pd.read_csv(io.BytesIO(data), usecols= columns)
+
+    dtypes, categories, _, chunks = _scan_columnar(path)
+    names = list(dtypes) if columns is None else list(columns)
+    parts = {name: [] for name in names}
+    with open(path, 'rb') as f:
+        data = f.read()
+    for offset, n, _ in chunks:
+        for name, dtype in dtypes.items():
+            if name in parts:
+                parts[name].append(np.frombuffer(data, dtype= dtype, count= n, offset= offset))
+            offset += n * dtype.itemsize
+    df = pd.DataFrame({name: np.concatenate(parts[name]) if parts[name] else np.empty(0, dtype= dtypes[name])
+                       for name in names})
+    for name in names:
+        if name in categories:
+            df[name] = np.asarray(categories[name], dtype= object)[df[name].to_numpy()]
+        elif dtypes[name].kind == 'S':
+            df[name] = df[name].str.decode('utf-8')
+    return df
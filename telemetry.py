@@ -0,0 +1,283 @@
+"""
+Live telemetry of the sampling loops.
+-----------------------------------------------------------------------------------------------
+The loops publish each sample to a TelemetryBus instead of printing it. publish() only puts the sample in a
+bounded queue and never blocks: when the queue is full the sample is dropped and counted. A background thread
+drains the queue into the bus's sinks, so a slow console, a stalled network or a busy plot can never delay the
+sampling.
+Sinks (any object with an append(message) method, like the sinks of the loops):
+* ConsoleSink: prints at most one line per source every interval seconds, and every step change.
+* UDPPublisher: sends each message as a JSON datagram (e.g. to a dashboard on the same machine).
+* ZMQPublisher: publishes each message as JSON on a ZeroMQ PUB socket (requires pyzmq).
+* RingBuffer: keeps the last samples in NumPy arrays for a live plot.
+The messages are the loops' rows with the source (instrument id) and the wall time of publication.
+-----------------------------------------------------------------------------------------------
+Usage:
+ring = RingBuffer(10_000)
+default_bus.add_sink(ring)
+default_bus.add_sink(UDPPublisher(port= 5555))
+...
+df = ring.snapshot() # from the plotting thread
+"""
+import atexit
+import json
+import queue
+import socket
+import sys
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+STEP_KEYS = ('cycle_no', 'pulse_no', 'status', 'step') # fields whose changes are always printed by ConsoleSink
+
+
+class TelemetryBus:
+    """
+    ------------------------------
+    Non-blocking publish/subscribe bus of the samples.
+    ------------------------------
+    publish() puts the message in a bounded queue with put_nowait and returns; the messages that do not fit
+    are dropped and counted in dropped. The drain thread is started on the first publish and passes the
+    messages to the sinks in order. A sink raising an exception is counted in errors and does not stop the
+    other sinks.
+    """
+    def __init__(self, sinks = (), maxsize = 10_000):
+        """
+        Constructor of the bus.
+        :param sinks: objects with an append(message) method
+        :param maxsize: capacity of the queue in messages
+        """
+        self.sinks = list(sinks)
+        self.published = 0
+        self.dropped = 0
+        self.errors = 0
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink):
+        with self._lock:
+            self.sinks = [*self.sinks, sink]
+
+    def remove_sink(self, sink):
+        with self._lock:
+            self.sinks = [s for s in self.sinks if s is not sink]
+
+    def channel(self, source):
+        """
+        :param source: name of the publisher (e.g. an instrument id)
+        :return: sink publishing the rows it receives from source, to add to a sampling loop's sinks
+        """
+        return Channel(self, source)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target= self._drain, name= 'telemetry', daemon= True)
+                self._thread.start()
+
+    def publish(self, source, row):
+        """
+        Publishes a row without blocking.
+        :param source: name of the publisher
+        :param row: dictionary (e.g. a sampling loop's row)
+        :return: False if the message was dropped because the queue was full
+        """
+        if self._thread is None:
+            self.start()
+        try:
+            self._queue.put_nowait({**row, 'source': source, 'wall_time': time.time()})
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.published += 1
+        return True
+
+    def _drain(self):
+        while True:
+            message = self._queue.get()
+            if message is None:
+                self._queue.task_done()
+                return
+            for sink in self.sinks:
+                try:
+                    sink.append(message)
+                except Exception:
+                    self.errors += 1
+            self._queue.task_done()
+
+    def flush(self, timeout = None):
+        """
+        Waits until the queued messages are passed to the sinks.
+        :param timeout: maximum wait in seconds, or None
+        :return: True if the queue was drained
+        """
+        if self._thread is None:
+            return True
+        t_end = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if t_end is not None and time.monotonic() > t_end:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stop(self, timeout = 1.0):
+        """
+        Drains the queue, stops the drain thread and closes the sinks that have a close method.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            try:
+                self._queue.put(None, timeout= timeout)
+                thread.join(timeout)
+            except queue.Full:
+                pass # a sink is stalled, the daemon thread is abandoned
+        for sink in self.sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+
+    def stats(self):
+        return {'published': self.published, 'dropped': self.dropped, 'errors': self.errors,
+                'queued': self._queue.qsize()}
+
+
+class Channel:
+    """
+    Sink publishing the rows of a sampling loop to a TelemetryBus under a source name.
+    """
+    def __init__(self, bus, source):
+        self.bus = bus
+        self.source = source
+
+    def append(self, row):
+        self.bus.publish(self.source, row)
+
+
+class ConsoleSink:
+    """
+    Rate-limited console output. Prints a message when its source has not printed for interval seconds, or
+    when its step (cycle_no, pulse_no, status or step) changed.
+    """
+    def __init__(self, interval = 1.0, stream = None):
+        """
+        :param interval: minimum time between two lines of a source in seconds (wall clock)
+        :param stream: file object. Defaults to sys.stdout at the time of printing.
+        """
+        self.interval = interval
+        self.stream = stream
+        self._last = {} # source: (wall time, step) of the last printed line
+
+    @staticmethod
+    def format(message):
+        fields = [f'{key}={value:.6g}' if isinstance(value, float) else f'{key}={value}'
+                  for key, value in message.items() if key not in ('source', 'wall_time')]
+        return f"{message['source']} " + ' '.join(fields)
+
+    def append(self, message):
+        step = tuple(message.get(key) for key in STEP_KEYS)
+        last = self._last.get(message['source'])
+        if last is not None and last[1] == step and message['wall_time'] - last[0] < self.interval:
+            return
+        self._last[message['source']] = (message['wall_time'], step)
+        print(self.format(message), file= self.stream or sys.stdout)
+
+
+class UDPPublisher:
+    """
+    Sends each message as a JSON datagram. UDP never waits for the receiver: the datagrams are lost if nobody
+    listens.
+    """
+    def __init__(self, host = '127.0.0.1', port = 5555):
+        self.address = (host, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def append(self, message):
+        try:
+            self.socket.sendto(json.dumps(message, default= str).encode(), self.address)
+        except (BlockingIOError, ConnectionRefusedError):
+            pass
+
+    def close(self):
+        self.socket.close()
+
+
+class ZMQPublisher:
+    """
+    Publishes each message as JSON on a ZeroMQ PUB socket, under the topic of its source. Subscribers connect
+    to the address (e.g. 'tcp://localhost:5556'). Requires pyzmq.
+    """
+    def __init__(self, address = 'tcp://127.0.0.1:5556', hwm = 10_000):
+        """
+        :param address: address bound by the PUB socket
+        :param hwm: maximum number of messages queued per subscriber, the others are dropped
+        """
+        try:
+            import zmq
+        except ImportError as error:
+            raise ImportError('ZMQPublisher requires pyzmq (pip install pyzmq)') from error
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.PUB)
+        self.socket.setsockopt(zmq.SNDHWM, hwm)
+        self.socket.bind(address)
+        self._noblock = zmq.NOBLOCK
+        self._again = zmq.Again
+
+    def append(self, message):
+        try:
+            self.socket.send_multipart([str(message['source']).encode(),
+                                        json.dumps(message, default= str).encode()], flags= self._noblock)
+        except self._again:
+            pass
+
+    def close(self):
+        self.socket.close(linger= 0)
+
+
+class RingBuffer:
+    """
+    Keeps the last capacity samples in NumPy arrays, for a live plot. snapshot() can be called from any thread.
+    """
+    NUMERIC_FIELDS = ('t', 'V', 'I')
+
+    def __init__(self, capacity = 10_000, source = None):
+        """
+        :param capacity: number of samples kept
+        :param source: keeps only the messages of this source if given
+        """
+        self.capacity = capacity
+        self.source = source
+        self.values = np.full((len(self.NUMERIC_FIELDS), capacity), np.nan)
+        self.sources = np.empty(capacity, dtype= object)
+        self.steps = np.empty(capacity, dtype= object)
+        self.n = 0 # number of samples received
+        self._lock = threading.Lock()
+
+    def append(self, message):
+        if self.source is not None and message['source'] != self.source:
+            return
+        with self._lock:
+            k = self.n % self.capacity
+            for i, field in enumerate(self.NUMERIC_FIELDS):
+                self.values[i, k] = message.get(field, np.nan)
+            self.sources[k] = message['source']
+            self.steps[k] = message.get('status', message.get('step'))
+            self.n += 1
+
+    def snapshot(self):
+        """
+        :return: pandas DataFrame of the kept samples, oldest first, with the source, step, t, V and I columns
+        """
+        with self._lock:
+            n = min(self.n, self.capacity)
+            order = np.arange(self.n - n, self.n) % self.capacity
+            df = pd.DataFrame({'source': self.sources[order], 'step': self.steps[order]})
+            for i, field in enumerate(self.NUMERIC_FIELDS):
+                df[field] = self.values[i, order]
+        return df
+
+
+default_bus = TelemetryBus([ConsoleSink()]) # process-wide bus used by the instruments created without one
+atexit.register(default_bus.stop)
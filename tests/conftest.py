@@ -0,0 +1,27 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clock
+from simulator import LatencyModel, SimCell, simulated_pool
+
+
+@pytest.fixture
+def virtual_clock():
+    """
+    Runs the test on a VirtualClock, restoring the previous clock afterwards.
+    """
+    virtual = clock.VirtualClock()
+    previous = clock.set_clock(virtual)
+    yield virtual
+    clock.set_clock(previous)
+
+
+@pytest.fixture
+def pool(virtual_clock):
+    """
+    Session pool of the simulated psu and e-load, with a non-zero latency.
+    """
+    return simulated_pool(SimCell(soc= 0.5), LatencyModel(0.005, 0.001, seed= 0))
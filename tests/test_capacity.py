@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+from capacity import add_capacity_columns, cumulative_integral, cycle_summary, segment_starts
+from cycle_stats import CycleStatistics
+from cycling import Cycling
+from simulator import SIM_LOAD_ID, SIM_PSU_ID
+
+
+def test_integration_methods():
+    t = np.linspace(0.0, 2.0, 21)
+    y = t ** 2
+    for method, tolerance in (('rectangle', 0.5), ('trapezoid', 1e-2), ('simpson', 1e-12)):
+        assert cumulative_integral(t, y, method= method)[-1] == pytest.approx(8 / 3, abs= tolerance)
+
+
+def test_integral_restarts_at_segments():
+    t = np.arange(6, dtype= float)
+    starts = segment_starts(np.array([1, 1, 1, 2, 2, 2]))
+    np.testing.assert_allclose(cumulative_integral(t, np.ones(6), starts), [0, 1, 2, 0, 1, 2])
+
+
+def test_capacity_columns():
+    df = pd.DataFrame({'cycle_no': [1] * 6,
+                       'status': ['CC_charge'] * 3 + ['CC_discharge'] * 3,
+                       't': [0.0, 1800.0, 3600.0, 3700.0, 5500.0, 7300.0],
+                       'V': 3.3, 'I': [1.0, 1.0, 1.0, 2.0, 2.0, 2.0]})
+    df = add_capacity_columns(df)
+    np.testing.assert_allclose(df['cap_charge'], [0.0, 0.5, 1.0, 1.0, 1.0, 1.0])
+    np.testing.assert_allclose(df['cap_discharge'], [0.0, 0.0, 0.0, 0.0, 1.0, 2.0])
+    summary = cycle_summary(df)
+    assert summary['Q_charge [Ahr]'].iloc[0] == pytest.approx(1.0)
+    assert summary['Q_discharge [Ahr]'].iloc[0] == pytest.approx(2.0)
+
+
+def test_cycle_capacities_match_the_cell(pool):
+    cell = pool.open(SIM_LOAD_ID).circuit.cell
+    cycling = Cycling(t_wait_init= 1, psu_id= SIM_PSU_ID, e_load_id= SIM_LOAD_ID, cycles= 1, dt= 10,
+                      V_upper= 3.6, I_charge= 1.0, I_cut= 0.1, t_wait= 60, V_cut= 2.5, I_dis= 1.0, pool= pool)
+    soc_start = cell.soc
+    stats = CycleStatistics()
+    df = cycling.charge(sinks= (stats,))
+    soc_charged = cell.soc
+    assert df['cap_charge [Ahr]'].iloc[-1] == pytest.approx((soc_charged - soc_start) * cell.capacity, rel= 0.02)
+    df = cycling.discharge()
+    assert df['cap_discharge [Ahr]'].iloc[-1] == pytest.approx((soc_charged - cell.soc) * cell.capacity, rel= 0.02)
+    stats.close()
+    assert stats.summaries[0]['Q_charge [Ahr]'] == pytest.approx((soc_charged - soc_start) * cell.capacity, rel= 0.02)
@@ -0,0 +1,20 @@
+import numpy as np
+from e_load import E_load
+from simulator import SIM_LOAD_ID, SimCell, simulated_pool
+
+
+def test_capture_ends_without_latency(virtual_clock):
+    # the queries of a simulator without latency take no time on the virtual clock
+    load = E_load(SIM_LOAD_ID, pool= simulated_pool(SimCell(soc= 0.5)))
+    load.set_CC(1.0)
+    waveform = load.capture(0.5)
+    assert len(waveform.t) == round(0.5 / E_load.MIN_CAPTURE_PERIOD)
+    assert np.all(np.diff(waveform.t) > 0)
+
+
+def test_capture_list(pool):
+    load = E_load(SIM_LOAD_ID, pool= pool)
+    waveform = load.capture(0.3, levels= [1.0, 0.0], widths= [0.1, 0.1])
+    assert waveform.t[-1] >= 0.3 - 0.02
+    assert np.isclose(waveform.I[waveform.t < 0.09], 1.0).all()
+    assert np.isclose(waveform.I[(waveform.t > 0.11) & (waveform.t < 0.19)], 0.0).all()
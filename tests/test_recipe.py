@@ -0,0 +1,93 @@
+import threading
+import pytest
+from e_load import E_load
+from psu import PSU
+from recipe import CC, CCCV, Executor, Loop, Recipe, Rest, V_TOLERANCE, V_below
+from scheduler import StopRequested
+from simulator import SIM_LOAD_ID, SIM_PSU_ID
+
+
+@pytest.fixture
+def executor(pool):
+    return Executor(psu= PSU(SIM_PSU_ID, pool= pool), load= E_load(SIM_LOAD_ID, pool= pool), dt= 10)
+
+
+def outputs_on(pool):
+    return pool.open(SIM_PSU_ID).on or pool.open(SIM_LOAD_ID).on
+
+
+def test_cc_discharge_ends_on_the_cut_off(executor, pool):
+    df = executor.run(Recipe('discharge', [CC(1.0, 3.2, direction= 'discharge')]))
+    assert (df['V'].iloc[:-1] >= 3.2).all()
+    assert df['V'].iloc[-1] < 3.2
+    assert (df['status'] == 'CC_discharge').all()
+    assert not outputs_on(pool)
+
+
+def test_cccv_charge_and_loop(executor, pool):
+    recipe = Recipe('cycle', [Loop(2, [CCCV(1.0, 3.45, 0.5, direction= 'charge'), Rest(30, 'wait'),
+                                       CC(1.0, 3.25, direction= 'discharge')])])
+    df = executor.run(recipe)
+    assert df['cycle_no'].unique().tolist() == [1, 2]
+    first = df[df['cycle_no'] == 1]
+    assert first['status'].unique().tolist() == ['CC_charge', 'CV_charge', 'wait', 'CC_discharge']
+    assert first[first['status'] == 'CV_charge']['I'].iloc[-1] < 0.5
+    assert first['t'].iloc[0] < 1.0 # the time restarts at each cycle
+    assert not outputs_on(pool)
+
+
+def test_charge_limit_on_the_psu_voltage(executor, pool, monkeypatch):
+    # the load measures the cell behind leads dropping 50 mV
+    measureV = executor.load.measureV
+    monkeypatch.setattr(executor.load, 'measureV', lambda: measureV() - 0.05)
+    df = executor.run(Recipe('charge', [CC(1.0, 3.4, direction= 'charge', sense= 'load')]))
+    # the rows hold the load's voltage, the charge ended when the psu's one reached the limit
+    assert df['V'].iloc[-1] < 3.4 - V_TOLERANCE
+    assert df['V'].iloc[-1] + 0.05 >= 3.4 - V_TOLERANCE
+    assert not outputs_on(pool)
+
+
+def test_failed_start_turns_the_output_off(executor, pool, monkeypatch):
+    def fail():
+        raise RuntimeError('lost connection')
+    monkeypatch.setattr(executor.psu, 'wait_output_on', fail)
+    with pytest.raises(RuntimeError):
+        executor.run(Recipe('charge', [CC(1.0, 3.6, direction= 'charge')]))
+    assert not outputs_on(pool)
+
+
+def test_stop_event_turns_the_output_off(executor, pool):
+    event = threading.Event()
+    executor.stop_event = event
+    rows = []
+
+    class StopAfter:
+        def append(self, row):
+            rows.append(row)
+            if len(rows) == 3:
+                event.set()
+    with pytest.raises(StopRequested):
+        executor.run(Recipe('discharge', [CC(1.0, 2.5, direction= 'discharge')]), sinks= (StopAfter(),))
+    assert len(rows) == 3
+    assert not outputs_on(pool)
+
+
+def test_adaptive_sampling(executor):
+    cell = executor.load.pool.open(SIM_LOAD_ID).circuit.cell
+    step = CC(1.0, 2.9, direction= 'discharge', dt_min= 1, dt_max= 60, interpolate= True)
+    adaptive = executor.run(Recipe('discharge', [step]))
+    crossings = executor.crossings
+    cell.soc = 0.5
+    fixed = executor.run(Recipe('discharge', [CC(1.0, 2.9, direction= 'discharge', dt= 1)]))
+    assert len(adaptive) < len(fixed) / 20
+    assert adaptive['t'].iloc[1] - adaptive['t'].iloc[0] == pytest.approx(60, abs= 1) # first interval dt_max
+    assert adaptive['V'].iloc[-1] > 2.9 - 0.005 # dense near the threshold, the overshoot is small
+    crossing = adaptive.iloc[-2]
+    assert crossing['status'] == 'CC_crossing_discharge'
+    assert crossing['V'] == pytest.approx(2.9)
+    assert [crossing['threshold'] for crossing in crossings] == [2.9]
+
+
+def test_rest_with_condition(executor):
+    df = executor.run(Recipe('rest', [Rest(600, 'wait', until= [V_below(10.0)])]))
+    assert len(df) == 1
@@ -0,0 +1,66 @@
+import threading
+import pytest
+import clock
+from scheduler import (AdaptiveScheduler, DeadlineMissed, DeadlineScheduler, OffsetScheduler, StopRequested,
+                       dense_sparse_offsets)
+
+
+def test_deadlines_do_not_drift(virtual_clock):
+    scheduler = DeadlineScheduler(1.0)
+    scheduler.start()
+    times = []
+    for _ in range(5):
+        clock.sleep(0.3) # time spent on the queries
+        times.append(scheduler.wait())
+    assert times == [1.0, 2.0, 3.0, 4.0, 5.0]
+    assert scheduler.stats()['missed_deadlines'] == 0
+
+
+def test_late_sample_skips_to_next_deadline(virtual_clock):
+    scheduler = DeadlineScheduler(1.0)
+    scheduler.start()
+    clock.sleep(1.5)
+    assert scheduler.wait() == 2.0
+    assert scheduler.missed == 1
+
+
+def test_consecutive_missed_deadlines_raise(virtual_clock):
+    scheduler = DeadlineScheduler(1.0, max_missed= 2)
+    scheduler.start()
+    clock.sleep(1.5)
+    scheduler.wait()
+    clock.sleep(1.5)
+    with pytest.raises(DeadlineMissed):
+        scheduler.wait()
+
+
+def test_stop_event(virtual_clock):
+    event = threading.Event()
+    scheduler = DeadlineScheduler(1.0, stop_event= event)
+    scheduler.start()
+    event.set()
+    with pytest.raises(StopRequested):
+        scheduler.wait()
+
+
+def test_offset_scheduler_ends_on_duration(virtual_clock):
+    offsets = dense_sparse_offsets(10.0, 0.5, 2.0, 4.0)
+    scheduler = OffsetScheduler(offsets, 10.0)
+    t_start = scheduler.start()
+    times = [0.0]
+    while True:
+        times.append(scheduler.wait())
+        if scheduler.finished():
+            break
+    assert times[:len(offsets)] == list(offsets)
+    assert clock.monotonic() - t_start == pytest.approx(10.0)
+
+
+def test_adaptive_scheduler_intervals(virtual_clock):
+    scheduler = AdaptiveScheduler(0.1, 10.0)
+    scheduler.start()
+    assert scheduler.wait() == pytest.approx(10.0) # the first interval is dt_max
+    scheduler.set_interval(0.01) # clipped to dt_min
+    assert scheduler.wait() == pytest.approx(10.1)
+    scheduler.set_interval(100.0) # clipped to dt_max
+    assert scheduler.wait() == pytest.approx(20.1)
@@ -0,0 +1,67 @@
+import pytest
+from buffer import CYCLING_FIELDS
+from loader import RunLoader
+from stream_writer import ColumnarStreamWriter, CSVStreamWriter, read_stream
+
+STATUSES = ['CC_charge', 'a user-named recipe step longer than 24 bytes', 'Entladung über Nacht']
+
+
+def rows(n, t0 = 0):
+    return [{'cycle_no': 1 + (t0 + k) // 10, 'status': STATUSES[(t0 + k) % 3], 't': float(t0 + k), 'V': 3.0 + k * 1e-3,
+             'I': 1.0} for k in range(n)]
+
+
+@pytest.mark.parametrize('writer_class', [CSVStreamWriter, ColumnarStreamWriter])
+def test_round_trip(tmp_path, writer_class):
+    path = tmp_path / 'run.bin'
+    with writer_class(path, batch_size= 4) as writer:
+        for row in rows(10):
+            writer.append(row)
+    df = read_stream(path)
+    assert df['status'].tolist() == [row['status'] for row in rows(10)]
+    assert df['t'].tolist() == [row['t'] for row in rows(10)]
+
+
+@pytest.mark.parametrize('writer_class', [CSVStreamWriter, ColumnarStreamWriter])
+def test_resume_truncates_partial_batch(tmp_path, writer_class):
+    path = tmp_path / 'run.bin'
+    with writer_class(path, batch_size= 4) as writer:
+        for row in rows(8):
+            writer.append(row)
+    with open(path, 'ab') as f:
+        f.write(b'CHNK\x04\x00garbage' if writer_class is ColumnarStreamWriter else b'1,CC_charge,8.0,3.0')
+    with writer_class(path, batch_size= 4, resume= True) as writer:
+        assert writer.rows_written == 8
+        for row in rows(4, t0= 8):
+            writer.append(row)
+    df = read_stream(path)
+    assert df['t'].tolist() == [float(k) for k in range(12)]
+    assert df['status'].tolist() == [row['status'] for row in rows(12)]
+
+
+@pytest.mark.parametrize('writer_class', [CSVStreamWriter, ColumnarStreamWriter])
+def test_overwrites_by_default(tmp_path, writer_class):
+    path = tmp_path / 'run.bin'
+    for _ in range(2):
+        with writer_class(path) as writer:
+            for row in rows(3):
+                writer.append(row)
+    assert len(read_stream(path)) == 3
+
+
+def test_resume_checks_schema(tmp_path):
+    path = tmp_path / 'run.bin'
+    with ColumnarStreamWriter(path) as writer:
+        writer.append(rows(1)[0])
+    fields = {name: dtype for name, dtype in CYCLING_FIELDS.items() if name != 'status'}
+    with pytest.raises(ValueError):
+        ColumnarStreamWriter(path, fields= fields, resume= True)
+
+
+def test_loader_decodes_categories(tmp_path):
+    path = tmp_path / 'run.bin'
+    with ColumnarStreamWriter(path, batch_size= 4) as writer:
+        for row in rows(20):
+            writer.append(row)
+    df = RunLoader(path).load()
+    assert df['status'].astype(str).tolist() == [row['status'] for row in rows(20)]
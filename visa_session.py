@@ -0,0 +1,151 @@
+import functools
+import threading
+import time
+import pyvisa
+
+
+class SessionPool:
+    """
+    ------------------------------
+    Pool of pyvisa sessions shared by the instrument classes.
+    ------------------------------
+    One pyvisa ResourceManager is created per pool and one session is kept open per instrument address,
+    so repeated SCPI calls (measureV, set_CC, ...) reuse the same USB session instead of reopening it.
+    ------------------------------
+    Usage:
+    with SessionPool() as pool:
+        siglent = PSU(psu_id, pool= pool)
+        rigol = E_load(load_id, pool= pool)
+        ...
+    The sessions are closed when the with-block exits. Instruments created without a pool use the
+    process-wide default_pool, which can be closed explicitly with default_pool.close_all().
+    The exchanges of the sessions can be timed by a profiler (see set_profiler and profiling.py).
+    """
+    def __init__(self, backend = '', resource_manager = None):
+        """
+        Constructor of the session pool.
+        :param backend: pyvisa backend passed to the ResourceManager (e.g. '@py'). The default uses the system backend.
+        :param resource_manager: object replacing the pyvisa ResourceManager, with the open_resource,
+        list_resources and close methods (e.g. simulator.SimResourceManager)
+        """
+        self.backend = backend
+        self._given_rm = resource_manager
+        self._rm = resource_manager
+        self._sessions = {}
+        self._profilers = {} # instrument address (or None for all of them): Profiler
+        self._locks = {} # instrument address: lock serializing the exchanges of the threads
+        self._lock = threading.RLock()
+
+    @property
+    def resource_manager(self):
+        """
+        The pool's pyvisa ResourceManager. It is created on first use.
+        :return: pyvisa ResourceManager
+        """
+        with self._lock:
+            if self._rm is None:
+                self._rm = pyvisa.ResourceManager(self.backend)
+            return self._rm
+
+    def list_resources(self):
+        return self.resource_manager.list_resources()
+
+    def set_profiler(self, profiler, ids = None):
+        """
+        Times the exchanges of the sessions with a profiler. The instruments keeping a reference to their session
+        (e.g. PSU) should be created after this call.
+        :param profiler: profiling.Profiler, or None to stop profiling
+        :param ids: instrument addresses to profile. All of them if None.
+        """
+        with self._lock:
+            for id in (None,) if ids is None else ids:
+                if profiler is None:
+                    self._profilers.pop(id, None)
+                else:
+                    self._profilers[id] = profiler
+            for id, session in self._sessions.items():
+                session = getattr(session, 'wrapped', session) # unwrap a ProfiledSession
+                profiler = self._profilers.get(id, self._profilers.get(None))
+                self._sessions[id] = session if profiler is None else profiler.wrap(id, session)
+
+    def lock(self, id):
+        """
+        :param id: instrument address
+        :return: reentrant lock of the instrument's session, shared by all the instrument objects using it
+        (see exclusive)
+        """
+        with self._lock:
+            return self._locks.setdefault(id, threading.RLock())
+
+    def is_open(self, id):
+        return id in self._sessions
+
+    def open(self, id, write_termination = None, read_termination = None):
+        """
+        Returns the open session for the instrument address, opening it if required.
+        :param id: instrument address (e.g. 'USB0::0x1AB1::0x0E11::DL3A222600541::INSTR')
+        :param write_termination: write termination set when the session is first opened
+        :param read_termination: read termination set when the session is first opened
+        :return: pyvisa resource
+        """
+        session = self._sessions.get(id)
+        if session is not None:
+            return session
+        with self._lock:
+            session = self._sessions.get(id)
+            if session is None:
+                profiler = self._profilers.get(id, self._profilers.get(None))
+                t_start = time.perf_counter()
+                session = self.resource_manager.open_resource(id)
+                if profiler is not None:
+                    profiler.record(id, 'open', '', t_start, time.perf_counter() - t_start)
+                    session = profiler.wrap(id, session)
+                if write_termination is not None:
+                    session.write_termination = write_termination
+                if read_termination is not None:
+                    session.read_termination = read_termination
+                self._sessions[id] = session
+            return session
+
+    def close(self, id):
+        """
+        Closes the session of an instrument address. Does nothing if the session is not open.
+        :param id: instrument address
+        """
+        with self._lock:
+            session = self._sessions.pop(id, None)
+            if session is not None:
+                session.close()
+
+    def close_all(self):
+        """
+        Closes all the open sessions and the ResourceManager.
+        """
+        with self._lock:
+            for id in list(self._sessions):
+                self.close(id)
+            if self._rm is not None:
+                self._rm.close()
+                self._rm = self._given_rm
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_all()
+
+
+def exclusive(method):
+    """
+    Decorator of the instrument methods exchanging with the instrument. The method runs while holding the
+    session's lock (the instrument's lock attribute, see SessionPool.lock), so the exchanges of several threads
+    (e.g. a sampling loop and a watchdog) on one session do not interleave.
+    """
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+
+default_pool = SessionPool() # process-wide pool used by instruments created without an explicit pool
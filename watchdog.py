@@ -0,0 +1,187 @@
+import threading
+import time
+from collections import namedtuple
+import clock
+from scheduler import StopRequested
+
+# Safety limits checked by the Watchdog, None for no limit
+# V_min, V_max: cell voltage [V], I_max: charge or discharge current [A], T_max: temperature [degC],
+# t_max: duration of the run [s]
+Limits = namedtuple('Limits', ['V_min', 'V_max', 'I_max', 'T_max', 't_max'], defaults= (None,) * 5)
+
+
+class LimitExceeded(StopRequested):
+    """
+    Raised in a protocol stopped by its Watchdog.
+    """
+
+
+class Watchdog:
+    """
+    ------------------------------
+    Safety watchdog polling the cell at a high rate on its own thread, independently of the sampling loop.
+    ------------------------------
+    Every period seconds, the watchdog reads the voltage and current of the instruments (the voltage of the load
+    if there is one, as it measures the cell even with its input off, otherwise of the psu) and the temperature,
+    and checks them against the limits. After consecutive violations (or max_errors consecutive failed readings)
+    it trips:
+    1. the outputs are turned off at once (turn_psu_off, turn_off_load)
+    2. its stop event is set, so the sampling loop stops (StopRequested) at its next wait instead of its next dt
+    3. on_trip(reason) is called
+    The exchanges are serialized with the sampling loop's by the session locks (see visa_session.exclusive), so
+    the reaction time is bounded by period plus one exchange of each instrument, whatever dt is.
+    The VISA calls release the GIL, so the watchdog thread is not delayed by the host work of the loop.
+    ------------------------------
+    Usage:
+    with Watchdog(psu, load, Limits(V_min= 1.9, V_max= 3.7, I_max= 2.0), period= 0.1, stop_event= event):
+        ... protocol using the stop event ...
+    """
+    def __init__(self, psu = None, load = None, limits = Limits(), period = 0.1, temperature = None,
+                 consecutive = 1, max_errors = 3, stop_event = None, follow = None, on_trip = None):
+        """
+        Constructor of the watchdog.
+        :param psu: PSU, or None
+        :param load: E_load, or None
+        :param limits: Limits
+        :param period: polling period in seconds (wall clock)
+        :param temperature: optional function returning the cell temperature in degC (e.g. a thermocouple reader)
+        :param consecutive: number of consecutive violations that trip the watchdog (filters single noisy readings)
+        :param max_errors: number of consecutive failed readings that trip the watchdog (lost communication)
+        :param stop_event: threading.Event set when the watchdog trips. A new one is created if None.
+        :param follow: optional threading.Event (e.g. an Orchestrator's) relayed to stop_event when it is set
+        :param on_trip: optional function called with the reason when the watchdog trips
+        """
+        if psu is None and load is None:
+            raise ValueError('The watchdog needs at least one instrument')
+        self.psu = psu
+        self.load = load
+        self.limits = limits
+        self.period = period
+        self.temperature = temperature
+        self.consecutive = consecutive
+        self.max_errors = max_errors
+        self.stop_event = threading.Event() if stop_event is None else stop_event
+        self.follow = follow
+        self.on_trip = on_trip
+        self.tripped = False
+        self.reason = None
+        self.readings = {} # last readings
+        self.polls = 0
+        self.poll_time_max = 0.0 # longest poll in seconds, including the waits for the session locks
+        self._violations = 0
+        self._errors = 0
+        self._t_start = None
+        self._done = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._t_start = clock.monotonic()
+        self._done.clear()
+        self._thread = threading.Thread(target= self._run, name= 'watchdog', daemon= True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._done.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def read(self):
+        """
+        :return: dictionary of the readings (V, I_psu, I_load, T, t)
+        """
+        readings = {}
+        if self.load is not None:
+            V, I, _, _ = self.load.sample()
+            readings['V'] = V
+            readings['I_load'] = I
+        if self.psu is not None:
+            V, I, _, _ = self.psu.read_sample()
+            readings.setdefault('V', V)
+            readings['I_psu'] = I
+        if self.temperature is not None:
+            readings['T'] = self.temperature()
+        readings['t'] = clock.monotonic() - self._t_start
+        return readings
+
+    def violation(self, readings):
+        """
+        :return: description of the first limit exceeded by the readings, or None
+        """
+        limits = self.limits
+        V = readings.get('V')
+        I = max(abs(readings.get('I_psu', 0.0)), abs(readings.get('I_load', 0.0)))
+        T = readings.get('T')
+        if limits.V_max is not None and V is not None and V > limits.V_max:
+            return f'V = {V} V > V_max = {limits.V_max} V'
+        if limits.V_min is not None and V is not None and V < limits.V_min:
+            return f'V = {V} V < V_min = {limits.V_min} V'
+        if limits.I_max is not None and I > limits.I_max:
+            return f'I = {I} A > I_max = {limits.I_max} A'
+        if limits.T_max is not None and T is not None and T > limits.T_max:
+            return f'T = {T} degC > T_max = {limits.T_max} degC'
+        if limits.t_max is not None and readings['t'] > limits.t_max:
+            return f"t = {readings['t']:.1f} s > t_max = {limits.t_max} s"
+        return None
+
+    def check(self):
+        """
+        Polls the instruments once and trips the watchdog if required.
+        :return: True if the watchdog tripped
+        """
+        if self.follow is not None and self.follow.is_set():
+            self.stop_event.set()
+        t0 = time.perf_counter()
+        try:
+            readings = self.read()
+        except Exception as error:
+            self._errors += 1
+            if self._errors >= self.max_errors:
+                self.trip(f'{self._errors} failed readings ({type(error).__name__}: {error})')
+            return self.tripped
+        finally:
+            self.polls += 1
+            self.poll_time_max = max(self.poll_time_max, time.perf_counter() - t0)
+        self._errors = 0
+        self.readings = readings
+        reason = self.violation(readings)
+        self._violations = self._violations + 1 if reason else 0
+        if reason and self._violations >= self.consecutive:
+            self.trip(reason)
+        return self.tripped
+
+    def trip(self, reason):
+        """
+        Turns off the outputs, sets the stop event and calls on_trip.
+        """
+        self.tripped = True
+        self.reason = reason
+        for turn_off in (getattr(self.psu, 'turn_psu_off', None), getattr(self.load, 'turn_off_load', None)):
+            if turn_off is not None:
+                try:
+                    turn_off()
+                except Exception:
+                    pass # the other output is still turned off
+        self.stop_event.set()
+        if self.on_trip is not None:
+            self.on_trip(reason)
+
+    def _run(self):
+        while not self._done.is_set() and not self.tripped:
+            self.check()
+            self._done.wait(self.period)
+
+    def raise_if_tripped(self, error = None):
+        """
+        Raises LimitExceeded if the watchdog tripped.
+        :param error: exception raised by the protocol, chained to LimitExceeded
+        """
+        if self.tripped:
+            raise LimitExceeded(self.reason) from error